@@ -0,0 +1,308 @@
+"""
+    Author: Davide Rosa
+    Description: asyncio client application for KUKAVARPROXY for KRC4.
+                 Many requests can be in flight on the same connection: a single reader task
+                 resolves the pending futures by message ID.
+"""
+
+import asyncio
+import traceback
+
+import py_kukavarproxy4_codec as codec
+from py_kukavarproxy4_client import TransportProfile, _encode
+
+class AsyncKukaVarProxyClient():
+    host = None
+    port = None
+
+    sock_timeout = 3.0
+
+    #optional coroutine function f(client) called on every connection (and reconnection) before any other request,
+    #i.e. to set the robot IP again. The requests it sends are the only ones allowed until it returns;
+    #if it returns False the connection is closed
+    on_connect = None
+
+    def __init__(self, _host, _port, _sockTimeout = 3.0, _transportProfile = None):
+        self.host = _host
+        self.port = _port
+        self.sock_timeout = _sockTimeout
+        self.transport = _transportProfile if not _transportProfile is None else TransportProfile()
+
+        #message id
+        self.KVP_IDCOUNTER = 0
+
+        self._reader = None
+        self._writer = None
+        self._readerTask = None
+        self._pending = {} #message id -> (kvp_func, future)
+        self._connectLock = asyncio.Lock()
+        self._ready = False #connected and on_connect done
+        self._handshakeTask = None #the task running on_connect
+
+    async def connect(self):
+        """ Opens the connection and starts the reader task, returns True if success """
+        if not self._handshakeTask is None and asyncio.current_task() is self._handshakeTask:
+            #connection lost during on_connect
+            return False
+        async with self._connectLock:
+            if self._ready:
+                return True
+            try:
+                self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.sock_timeout)
+                try:
+                    self.transport.apply(self._writer.get_extra_info("socket"))
+                except:
+                    #the connection is open, it must not be leaked
+                    self._writer.close()
+                    raise
+            except:
+                traceback.print_exc()
+                self._reader = self._writer = None
+                return False
+            self._readerTask = asyncio.get_running_loop().create_task(self._readLoop())
+
+            if not self.on_connect is None:
+                self._handshakeTask = asyncio.current_task()
+                try:
+                    _success = await self.on_connect(self)
+                except asyncio.CancelledError:
+                    self._disconnect()
+                    raise
+                except:
+                    traceback.print_exc()
+                    _success = False
+                finally:
+                    self._handshakeTask = None
+                if _success is False or self._writer is None:
+                    print("AsyncKukaVarProxyClient - on_connect failed")
+                    self._disconnect()
+                    return False
+            self._ready = True
+            return True
+
+    def _usable(self):
+        """ Returns True if a request can be sent now: connected, or sent by on_connect """
+        if self._ready:
+            return True
+        return not self._writer is None and not self._handshakeTask is None and asyncio.current_task() is self._handshakeTask
+
+    async def close(self):
+        """ Closes the connection, the pending requests fail """
+        _writer = self._writer
+        self._disconnect()
+        if not self._readerTask is None:
+            self._readerTask.cancel()
+            try:
+                await self._readerTask
+            except asyncio.CancelledError:
+                pass
+            self._readerTask = None
+        if not _writer is None:
+            try:
+                await _writer.wait_closed()
+            except:
+                pass
+
+    def _disconnect(self):
+        self._ready = False
+        if not self._writer is None:
+            self._writer.close()
+        self._reader = self._writer = None
+        for kvp_func, future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection closed"))
+        self._pending.clear()
+
+    def _nextMessageID(self):
+        """ Returns a message id that is not used by a pending request """
+        while True:
+            self.KVP_IDCOUNTER = self.KVP_IDCOUNTER + 1
+            if self.KVP_IDCOUNTER==0xffff:
+                self.KVP_IDCOUNTER = 0
+            if not self.KVP_IDCOUNTER in self._pending:
+                return self.KVP_IDCOUNTER
+
+    async def _readLoop(self):
+        _reader = self._reader
+        try:
+            while True:
+                _header = await _reader.readexactly(codec.KVP_HEADERSIZE) #msg_id + msg_size
+                _msgID, _msgSize = codec.unpackHeader(_header)
+                _body = await _reader.readexactly(_msgSize)
+
+                _request = self._pending.pop(_msgID, None)
+                if _request is None:
+                    print("AsyncKukaVarProxyClient - unexpected message id %d"%_msgID)
+                    continue
+
+                kvp_func, future = _request
+                if future.done(): #cancelled by timeout
+                    continue
+                if kvp_func is None: #raw request
+                    future.set_result(_body)
+                    continue
+                try:
+                    future.set_result(codec.unpackReply(kvp_func, _body))
+                except codec.KvpProtocolError as e:
+                    future.set_exception(e)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            print("AsyncKukaVarProxyClient - connection closed by server")
+        except:
+            traceback.print_exc()
+        if self._reader is _reader:
+            self._disconnect()
+
+    async def transact(self, kvp_func, dataToSend, funcName):
+        """ Sends a request and waits for its reply
+
+            Returns (True, value) if success otherwise (False, None),
+            the value depends on the function (see codec.unpackReply)
+        """
+        #encoded first: a request that can't be encoded fails alone, the connection is kept
+        _msg = _encode(funcName, codec.packMessage, 0, kvp_func, dataToSend)
+        if _msg is None:
+            return False, None
+        if not self._usable():
+            if not await self.connect():
+                return False, None
+
+        _msgID = self._nextMessageID()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            codec.stampMessageID(_msg, _msgID)
+            self._pending[_msgID] = (kvp_func, future)
+            self._writer.write(_msg)
+            await self._writer.drain()
+
+            _value, result = await asyncio.wait_for(future, self.sock_timeout)
+            if result == codec.KVP_RESULTOK:
+                return True, _value
+            print("%s - result not OK"%funcName)
+            return False, None
+        except asyncio.TimeoutError:
+            #the late reply will be discarded by the reader task
+            print("%s - timeout"%funcName)
+            return False, None
+        except (codec.KvpProtocolError, ConnectionError) as e:
+            print("%s - %s"%(funcName, e))
+        except asyncio.CancelledError:
+            raise
+        except:
+            print("%s - exception"%funcName)
+            traceback.print_exc()
+        finally:
+            self._pending.pop(_msgID, None)
+
+        #after a protocol error the stream can't be trusted anymore
+        self._disconnect()
+        return False, None
+
+    async def transact_raw(self, kvp_func, dataToSend, funcName):
+        """ Sends a request and waits for its reply without decoding it
+
+            Returns the reply body (function byte included) if received otherwise None
+        """
+        _msg = _encode(funcName, codec.packMessage, 0, kvp_func, dataToSend)
+        if _msg is None:
+            return None
+        if not self._usable():
+            if not await self.connect():
+                return None
+
+        _msgID = self._nextMessageID()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            codec.stampMessageID(_msg, _msgID)
+            self._pending[_msgID] = (None, future)
+            self._writer.write(_msg)
+            await self._writer.drain()
+
+            _body = await asyncio.wait_for(future, self.sock_timeout)
+            if len(_body) < codec.KVP_FUNCTIONSIZE or not _body[0] == kvp_func:
+                raise codec.KvpProtocolError("invalid packet, the returned function doesn't match")
+            return _body
+        except asyncio.TimeoutError:
+            print("%s - timeout"%funcName)
+            return None
+        except (codec.KvpProtocolError, ConnectionError) as e:
+            print("%s - %s"%(funcName, e))
+        except asyncio.CancelledError:
+            raise
+        except:
+            print("%s - exception"%funcName)
+            traceback.print_exc()
+        finally:
+            self._pending.pop(_msgID, None)
+
+        self._disconnect()
+        return None
+
+    async def read_var(self, varName):
+        """ Returns the variable value if success otherwise None """
+        _funcName = "read_var(%s)"%varName
+        _request = _encode(_funcName, codec.packReadRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValue = await self.transact(codec.KVP_FUNCTION_READ, _request, _funcName)
+        return _varValue
+
+    async def read_array(self, varName):
+        """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            Returns the array('H') of shorts (2 bytes) if success otherwise None """
+        _funcName = "read_array(%s)"%varName
+        _request = _encode(_funcName, codec.packReadArrayRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValues = await self.transact(codec.KVP_FUNCTION_READARRAY, _request, _funcName)
+        return _varValues
+
+    async def write_var(self, varName, varValue):
+        """ Returns True if success """
+        _funcName = "write_var(%s)"%varName
+        _request = _encode(_funcName, codec.packWriteRequest, varName, varValue)
+        if _request is None:
+            return False
+        _success, _varValue = await self.transact(codec.KVP_FUNCTION_WRITE, _request, _funcName)
+        return _success
+
+    async def write_array(self, varName, varValues):
+        """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            varValues (list of shorts (2bytes)): the array values
+            Returns True if success
+        """
+        _funcName = "write_array(%s)"%varName
+        _request = _encode(_funcName, codec.packWriteArrayRequest, varName, varValues)
+        if _request is None:
+            return False
+        _success, _varValue = await self.transact(codec.KVP_FUNCTION_WRITEARRAY, _request, _funcName)
+        return _success
+
+    async def discover_robots(self):
+        """ Returns the IPs of the available robots  """
+        _success, ipList = await self.transact(codec.KVP_FUNCTION_DISCOVER, codec.packDiscoverRequest(), "discover_robots")
+        if not _success:
+            return []
+        return ipList
+
+    async def set_robot_ip(self, ip):
+        """ Sets the ip of the server robot
+            Args:
+                ip (list) = list of 4 ip bytes
+        """
+        _success, _value = await self.transact(codec.KVP_FUNCTION_SETROBOTIP, codec.packSetRobotIPRequest(ip), "set_robot_ip")
+        return _success
+
+
+if __name__ == '__main__':
+    async def main():
+        kvp = AsyncKukaVarProxyClient('127.0.0.1', 7000)
+        await kvp.set_robot_ip([172,17,255,1])
+        #the requests are sent together and the replies are matched by message id
+        values = await asyncio.gather(kvp.read_var("$OV_PRO"), kvp.read_var("$POS_ACT"), kvp.read_var("$AXIS_ACT"))
+        for value in values:
+            print(value)
+        await kvp.close()
+
+    asyncio.run(main())
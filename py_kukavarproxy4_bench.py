@@ -0,0 +1,230 @@
+"""
+    Author: Davide Rosa
+    Description: Benchmarks of KukaVarProxyClient
+                 - round trip latency percentiles of readVar, writeVar, readArray, writeArray and readMany
+                 - throughput (vars/s) with an increasing number of concurrent clients
+                 - client CPU time per request
+                 - cost of the KRL parsers and serializer on E6POS/E6AXIS values
+
+    By default the stand-in server (py_kukavarproxy4_server.py) is started in a subprocess on the loopback,
+    so that its CPU time is not accounted to the client. The results are written to JSON, to be compared across commits.
+
+    i.e.
+        python py_kukavarproxy4_bench.py --output bench.json
+        python -m py_kukavarproxy4_bench --host 192.168.1.10 --port 7000 --iterations 2000
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import py_kukavarproxy4_client as client
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_server import DEFAULT_VARIABLES
+
+E6POS_VALUE = DEFAULT_VARIABLES["$POS_ACT"]
+E6AXIS_VALUE = DEFAULT_VARIABLES["$AXIS_ACT"]
+
+BENCH_ARRAY = "BENCH_ARRAY[]"
+BENCH_ARRAY_SIZE = 64
+BENCH_VAR = "BENCH_VAR"
+MANY_VARS = ["$AXIS_ACT", "$POS_ACT", "$OV_PRO", "$MODE_OP", "$TOOL", "$BASE"] * 5
+
+
+def percentiles(samples):
+    """ Returns the statistics of a list of durations in seconds, reported in microseconds """
+    if len(samples) == 0:
+        return {"count": 0}
+    _sorted = sorted(samples)
+    def at(fraction):
+        return _sorted[min(len(_sorted) - 1, int(fraction * len(_sorted)))] * 1e6
+    return {
+        "count": len(_sorted),
+        "mean_us": sum(_sorted) / len(_sorted) * 1e6,
+        "min_us": _sorted[0] * 1e6,
+        "p50_us": at(0.50),
+        "p99_us": at(0.99),
+        "p999_us": at(0.999),
+        "max_us": _sorted[-1] * 1e6,
+    }
+
+def _freePort(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def startServer(host = "127.0.0.1", latency = 0.0, jitter = 0.0, timeout = 10.0):
+    """ Starts the stand-in server in a subprocess, returns (process, port) """
+    port = _freePort(host)
+    _script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "py_kukavarproxy4_server.py")
+    process = subprocess.Popen([sys.executable, _script, "--host", host, "--port", str(port), "--latency", str(latency), "--jitter", str(jitter)],
+                               stdout = subprocess.DEVNULL)
+    _deadline = time.monotonic() + timeout
+    while time.monotonic() < _deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the stand-in server did not start")
+
+def _operations(kvp):
+    """ Returns the benchmarked operations: name -> (callable, variables per call) """
+    _arrayValues = list(range(BENCH_ARRAY_SIZE))
+    return {
+        "readVar": (lambda: kvp.readVar("$POS_ACT"), 1),
+        "writeVar": (lambda: kvp.writeVar(BENCH_VAR, "123.456"), 1),
+        "readArray": (lambda: kvp.readArray(BENCH_ARRAY), 1),
+        "writeArray": (lambda: kvp.writeArray(BENCH_ARRAY, _arrayValues), 1),
+        "readMany": (lambda: kvp.readMany(MANY_VARS), len(MANY_VARS)),
+    }
+
+def benchLatency(host, port, iterations, warmup = 100):
+    """ Round trip latency and client CPU time of every operation """
+    kvp = client.KukaVarProxyClient(host, port, _transportProfile = client.TransportProfile.lowLatency())
+    kvp.writeArray(BENCH_ARRAY, list(range(BENCH_ARRAY_SIZE)))
+    results = {}
+    for name, (operation, varsPerCall) in _operations(kvp).items():
+        for i in range(warmup):
+            operation()
+        samples = []
+        _cpu = time.process_time()
+        for i in range(iterations):
+            _start = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - _start)
+        _cpu = time.process_time() - _cpu
+        results[name] = percentiles(samples)
+        results[name]["vars_per_call"] = varsPerCall
+        results[name]["cpu_us_per_call"] = _cpu / iterations * 1e6
+        results[name]["cpu_us_per_var"] = _cpu / (iterations * varsPerCall) * 1e6
+    kvp.disconnect()
+    return results
+
+def benchThroughput(host, port, clientCounts, duration, pipelined = False):
+    """ Variables read per second with N clients, each one on its own connection and thread """
+    results = {}
+    for clientCount in clientCounts:
+        clients = [client.KukaVarProxyClient(host, port, _transportProfile = client.TransportProfile.lowLatency()) for i in range(clientCount)]
+        counts = [0] * clientCount
+        _stop = threading.Event()
+
+        def worker(index):
+            kvp = clients[index]
+            while not _stop.is_set():
+                if pipelined:
+                    kvp.readMany(MANY_VARS)
+                    counts[index] += len(MANY_VARS)
+                else:
+                    kvp.readVar("$AXIS_ACT")
+                    counts[index] += 1
+
+        threads = [threading.Thread(target = worker, args = (i,)) for i in range(clientCount)]
+        _start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        _stop.set()
+        for thread in threads:
+            thread.join()
+        _elapsed = time.perf_counter() - _start
+        for kvp in clients:
+            kvp.disconnect()
+        results[str(clientCount)] = {"vars_per_s": sum(counts) / _elapsed, "clients": clientCount}
+    return results
+
+def benchParsers(iterations):
+    """ Cost per call in microseconds of the KRL parsers and serializer """
+    kvp = client.KukaVarProxyClient.__new__(client.KukaVarProxyClient) #no connection needed
+    cases = {}
+    for typeName, value in (("E6POS", E6POS_VALUE), ("E6AXIS", E6AXIS_VALUE)):
+        _inner = value[value.index('{')+1: value.rindex('}')]
+        _dict = client.toPythonDict(_inner)
+        cases["toPythonDict_%s"%typeName] = lambda _inner = _inner: client.toPythonDict(_inner)
+        cases["parseStructure_%s"%typeName] = lambda value = value: kvp.parseStructure(value)
+        cases["packStructure_%s"%typeName] = lambda typeName = typeName, _dict = _dict: kvp.packStructure(typeName, _dict)
+        cases["parseKrl_bytes_%s"%typeName] = lambda value = value.encode(): krl.parseKrl(value)
+
+    results = {}
+    for name, case in cases.items():
+        _times = timeit.repeat(case, number = iterations, repeat = 5)
+        results[name] = {"us_per_call": min(_times) / iterations * 1e6}
+    return results
+
+def _gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def runBenchmarks(args):
+    results = {
+        "revision": _gitRevision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "iterations": args.iterations,
+    }
+
+    process = None
+    host, port = args.host, args.port
+    if port is None:
+        process, port = startServer(host, args.latency, args.jitter)
+        results["server"] = {"kind": "stand-in subprocess", "latency": args.latency, "jitter": args.jitter}
+    else:
+        results["server"] = {"kind": "external", "host": host, "port": port}
+
+    try:
+        if not args.skip_network:
+            results["latency"] = benchLatency(host, port, args.iterations)
+            results["throughput"] = benchThroughput(host, port, args.clients, args.duration)
+            results["throughput_pipelined"] = benchThroughput(host, port, args.clients, args.duration, pipelined = True)
+        results["parsers"] = benchParsers(args.parser_iterations)
+    finally:
+        if not process is None:
+            process.terminate()
+            process.wait()
+    return results
+
+def printSummary(results):
+    for name, stats in results.get("latency", {}).items():
+        print("%-12s p50 %9.1f us  p99 %9.1f us  p999 %9.1f us  cpu %7.1f us/var"%(name, stats["p50_us"], stats["p99_us"], stats["p999_us"], stats["cpu_us_per_var"]))
+    for key in ("throughput", "throughput_pipelined"):
+        for clientCount, stats in results.get(key, {}).items():
+            print("%-21s %3s clients %10.0f vars/s"%(key, clientCount, stats["vars_per_s"]))
+    for name, stats in results.get("parsers", {}).items():
+        print("%-28s %8.2f us/call"%(name, stats["us_per_call"]))
+
+
+def addArguments(parser):
+    """ Adds the benchmark options to an argparse parser (shared with the command line tool) """
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = None, help = "external server port, if not given the stand-in server is started")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "stand-in server reply latency in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "stand-in server reply jitter in seconds")
+    parser.add_argument("--iterations", type = int, default = 1000, help = "round trips per operation")
+    parser.add_argument("--clients", type = int, nargs = "+", default = [1, 2, 4, 8], help = "concurrent clients counts")
+    parser.add_argument("--duration", type = float, default = 2.0, help = "seconds per throughput measure")
+    parser.add_argument("--parser-iterations", type = int, default = 2000)
+    parser.add_argument("--skip-network", action = "store_true", help = "run only the parsers benchmarks")
+    parser.add_argument("--output", default = None, help = "JSON output file")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "KukaVarProxyClient benchmarks")
+    addArguments(parser)
+    args = parser.parse_args()
+
+    results = runBenchmarks(args)
+    printSummary(results)
+    if not args.output is None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
@@ -0,0 +1,160 @@
+"""
+    Author: Davide Rosa
+    Description: Read-through cache of the variables that change slowly.
+
+    The client looks up readVar/readArray in the cache before sending the request, and stores the values read.
+    The time to live of the values is given per variable or per pattern (* and ?, case insensitive like KRL names),
+    the variables without a time to live are not cached. The number of entries is bounded, the least recently used
+    ones are evicted. writeVar/writeArray of the same client invalidate the cached values of the variable
+    (and of its fields, i.e. writing $TOOL invalidates $TOOL.X and the other way around).
+
+    i.e.
+        cache = ReadCache({"$ROBNAME[]": float("inf"), "$TOOL*": 5.0, "$BASE*": 5.0, "$MACHINE_*": 60.0})
+        kvp = KukaVarProxyClient('127.0.0.1', 7000, _cache = cache)
+        kvp.readVar("$TOOL") #network
+        kvp.readVar("$TOOL") #cache
+        print(cache.statistics())
+"""
+
+import collections
+import fnmatch
+import re
+import threading
+import time
+
+
+def baseName(varName):
+    """ Returns the name of the variable without fields and indexes, upper case. i.e. $tool.x -> $TOOL """
+    return re.split(r"[.\[]", varName, 1)[0].strip().upper()
+
+
+class ReadCache():
+    """ LRU cache of the values read, thread safe
+
+        ttls (dict): variable name or pattern -> time to live in seconds (float("inf") never expires).
+            The exact names take precedence over the patterns, the patterns are tried in order
+        defaultTTL (float): time to live of the variables not listed, None doesn't cache them
+        maxEntries (int): the least recently used values are evicted above this size
+    """
+
+    def __init__(self, ttls = None, defaultTTL = None, maxEntries = 1024):
+        self.defaultTTL = defaultTTL
+        self.maxEntries = maxEntries
+        self._exact = {}
+        self._patterns = []
+        for name, ttl in (ttls or {}).items():
+            self.setTTL(name, ttl)
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() #(kvp function, NAME) -> (expiry time, value)
+        self._byBase = {} #BASE NAME -> set of keys
+        self._ttlCache = {}
+        self._generation = 0 #incremented by every invalidation
+
+        #statistics
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def setTTL(self, name, ttl):
+        """ Sets the time to live of a variable name or pattern (containing * or ?, the brackets are literal) """
+        name = name.upper()
+        if "*" in name or "?" in name:
+            name = name.replace("[", "[[]")
+            self._patterns = [(pattern, _ttl) for pattern, _ttl in self._patterns if pattern != name]
+            self._patterns.append((name, ttl))
+        else:
+            self._exact[name] = ttl
+        self._ttlCache = {}
+
+    def ttl(self, varName):
+        """ Returns the time to live of a variable, None if it is not cached """
+        name = varName.upper()
+        try:
+            return self._ttlCache[name]
+        except KeyError:
+            pass
+        _ttl = self._exact.get(name, self.defaultTTL)
+        if not name in self._exact:
+            for pattern, ttl in self._patterns:
+                if fnmatch.fnmatchcase(name, pattern):
+                    _ttl = ttl
+                    break
+        if len(self._ttlCache) < 4096:
+            self._ttlCache[name] = _ttl
+        return _ttl
+
+    def lookup(self, kvp_func, varName):
+        """ Returns (hit, value, token), token is passed to store() after reading the value.
+            The variables that are not cached are not counted as misses
+        """
+        if self.ttl(varName) is None:
+            return False, None, self._generation
+        key = (kvp_func, varName.upper())
+        with self._lock:
+            _entry = self._entries.get(key)
+            if not _entry is None:
+                if _entry[0] >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, _entry[1], self._generation
+                self._remove(key)
+                self.expired += 1
+            self.misses += 1
+            return False, None, self._generation
+
+    def store(self, kvp_func, varName, value, token):
+        """ Stores a value read, unless the variable isn't cached or an invalidation happened since the lookup """
+        _ttl = self.ttl(varName)
+        if _ttl is None or _ttl <= 0:
+            return
+        key = (kvp_func, varName.upper())
+        with self._lock:
+            if token != self._generation:
+                #a write may have happened while reading, the value could be stale
+                return
+            if not key in self._entries:
+                self._byBase.setdefault(baseName(varName), set()).add(key)
+            self._entries[key] = (time.monotonic() + _ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._entries[key]
+        _base = baseName(key[1])
+        _keys = self._byBase.get(_base)
+        if not _keys is None:
+            _keys.discard(key)
+            if len(_keys) == 0:
+                del self._byBase[_base]
+
+    def invalidate(self, varName):
+        """ Removes the cached values of the variable and of all its fields and indexes """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            for key in list(self._byBase.get(baseName(varName), ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._byBase.clear()
+
+    def statistics(self):
+        with self._lock:
+            _lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / _lookups if _lookups > 0 else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,322 @@
+"""
+    Author: Davide Rosa
+    Description: Command line tool: read, write, poll and export variables, run the benchmarks.
+
+    poll reads the variables at a fixed rate with pipelined requests (AcquisitionPipeline): the reads, the decoding
+    and the writing of the output run in separate threads, so a slow disk doesn't slow the sampling.
+    Every tick is a row: the time, the read latency and the decoded values, the structs flattened in one column
+    per field (i.e. $AXIS_ACT.A1). The rows are written in batches, to stdout, CSV or Parquet (needs pyarrow),
+    the memory is bounded by the queue capacity and the batch size. The live rate and latency statistics
+    are printed to stderr.
+
+    i.e.
+        python py_kukavarproxy4_cli.py get --host 192.168.1.10 $OV_PRO $POS_ACT
+        python py_kukavarproxy4_cli.py set --host 192.168.1.10 $OV_PRO 50
+        python py_kukavarproxy4_cli.py poll --host 192.168.1.10 --rate 250 --duration 60 --format parquet -o trace.parquet $AXIS_ACT $POS_ACT
+        python py_kukavarproxy4_cli.py bench --iterations 2000
+
+    With an alias the commands become i.e. kvp poll --rate 250 $AXIS_ACT
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_client import KukaVarProxyClient, TransportProfile
+from py_kukavarproxy4_instrumentation import LatencyHistogram
+from py_kukavarproxy4_pipeline import AcquisitionPipeline, POLICY_DROP_OLDEST
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def _text(value):
+    return bytes(value).decode("utf-8", "replace")
+
+def flatten(name, value, row):
+    """ Adds a decoded value to a row, the struct fields become name.FIELD columns """
+    if isinstance(value, dict):
+        for fieldName, fieldValue in value.items():
+            flatten("%s.%s"%(name, fieldName), fieldValue, row)
+    else:
+        row[name] = value
+    return row
+
+
+class TextSink():
+    """ Tab separated lines, for the terminal """
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+        self.stream.write("\t".join(columns) + "\n")
+
+    def write(self, rows):
+        self.stream.write("".join("\t".join("" if row.get(column) is None else str(row.get(column)) for column in self.columns) + "\n" for row in rows))
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is sys.stdout:
+            self.stream.flush()
+        else:
+            self.stream.close()
+
+
+class CsvSink():
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+        self._writer = csv.writer(stream)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows([row.get(column) for column in self.columns] for row in rows)
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is sys.stdout:
+            self.stream.flush()
+        else:
+            self.stream.close()
+
+
+class ParquetSink():
+    """ Every batch is written as a row group, the schema is inferred from the first batch """
+
+    def __init__(self, path, columns):
+        if pyarrow is None:
+            raise RuntimeError("the parquet format needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.columns = columns
+        self._writer = None
+
+    def write(self, rows):
+        _data = {column: [row.get(column) for row in rows] for column in self.columns}
+        if self._writer is None:
+            table = pyarrow.table(_data)
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        else:
+            table = pyarrow.table(_data, schema = self._writer.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if not self._writer is None:
+            self._writer.close()
+
+
+class RowWriter():
+    """ Pipeline consumer assembling the samples of a tick into a row and writing the rows in batches """
+
+    def __init__(self, sink, batchSize, flushInterval):
+        self.sink = sink
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self._rows = []
+        self._row = None
+        self._tick = None
+        self._lastFlush = time.monotonic()
+        self.latency = LatencyHistogram()
+        self.rows = 0
+
+    def __call__(self, samples):
+        for sample in samples:
+            if sample.tick != self._tick:
+                self._endRow()
+                self._tick = sample.tick
+                self._row = {"timestamp": sample.timestamp, "latency": sample.latency}
+                self.latency.record(sample.latency)
+            flatten(sample.name, sample.value, self._row)
+        if len(self._rows) >= self.batchSize or time.monotonic() - self._lastFlush >= self.flushInterval:
+            self.flush()
+
+    def _endRow(self):
+        if not self._row is None:
+            self._rows.append(self._row)
+            self._row = None
+
+    def flush(self):
+        if len(self._rows) > 0:
+            self.sink.write(self._rows)
+            self.rows += len(self._rows)
+            self._rows = []
+        self._lastFlush = time.monotonic()
+
+    def close(self):
+        self._endRow()
+        self.flush()
+        self.sink.close()
+
+
+def connect(args):
+    """ Returns the client of the command line options, with the robot IP set if given """
+    kvp = KukaVarProxyClient(args.host, args.port, _sockTimeout = args.timeout, _transportProfile = TransportProfile.lowLatency())
+    if not args.robot_ip is None:
+        from py_kukavarproxy4_discovery import robotAddress
+        if not kvp.setRobotIP(list(robotAddress(args.robot_ip).packed)):
+            raise SystemExit("setRobotIP %s failed"%args.robot_ip)
+    return kvp
+
+def commandGet(args):
+    kvp = connect(args)
+    try:
+        values = kvp.readMany(args.variables)
+        _failed = 0
+        for varName, value in zip(args.variables, values):
+            if value is None:
+                _failed += 1
+                print("%s\tREAD FAILED"%varName, file = sys.stderr)
+            elif args.json:
+                try:
+                    _decoded = krl.parseKrl(value)
+                except krl.KrlParseError:
+                    #written as received
+                    _decoded = _text(value)
+                print(json.dumps({varName: _decoded}))
+            else:
+                print("%s\t%s"%(varName, _text(value)))
+    finally:
+        kvp.disconnect()
+    return 1 if _failed > 0 else 0
+
+def commandSet(args):
+    if len(args.pairs) % 2 != 0:
+        raise SystemExit("set expects VARIABLE VALUE pairs")
+    pairs = list(zip(args.pairs[0::2], args.pairs[1::2]))
+    kvp = connect(args)
+    try:
+        results = kvp.writeMany(pairs)
+        for (varName, varValue), success in zip(pairs, results):
+            print("%s\t%s"%(varName, "OK" if success else "WRITE FAILED"), file = sys.stdout if success else sys.stderr)
+    finally:
+        kvp.disconnect()
+    return 0 if all(results) else 1
+
+def _openSink(args, columns):
+    if args.format == "parquet":
+        if args.output is None:
+            raise SystemExit("the parquet format needs --output")
+        if pyarrow is None:
+            raise SystemExit("the parquet format needs pyarrow (pip install pyarrow)")
+        return ParquetSink(args.output, columns)
+    stream = sys.stdout if args.output is None else open(args.output, "w", newline = "")
+    if args.format == "csv":
+        return CsvSink(stream, columns)
+    return TextSink(stream, columns)
+
+def _printStatistics(pipeline, writer, elapsed):
+    _reader = pipeline.statistics()
+    _dropped = _reader["decoder"]["input"]["dropped"] + sum(consumer["input"]["dropped"] for consumer in _reader["consumers"].values())
+    _rates = [subscription["achieved_rate"] or 0.0 for subscription in _reader["reader"].values()]
+    _latency = writer.latency.summary()
+    print("%7.1f s  %9d rows  %8.1f Hz  latency p50 %7.0f us  p99 %7.0f us  max %7.0f us  dropped %d"%(
+        elapsed, writer.rows, min(_rates), _latency.get("p50_us") or 0, _latency.get("p99_us") or 0, _latency.get("max_us") or 0, _dropped),
+        file = sys.stderr)
+    writer.latency = LatencyHistogram()
+
+def commandPoll(args):
+    kvp = connect(args)
+    decode = _text if args.raw else krl.parseKrl
+
+    #the columns are fixed by a first read of all the variables
+    values = kvp.readMany(args.variables)
+    _failed = [varName for varName, value in zip(args.variables, values) if value is None]
+    if len(_failed) > 0:
+        raise SystemExit("can't read %s"%", ".join(_failed))
+    _first = {}
+    for varName, value in zip(args.variables, values):
+        flatten(varName, decode(value), _first)
+    columns = ["timestamp", "latency"] + list(_first)
+
+    writer = RowWriter(_openSink(args, columns), args.batch, args.flush_interval)
+    pipeline = AcquisitionPipeline(kvp, capacity = args.queue, policy = POLICY_DROP_OLDEST)
+    for varName in args.variables:
+        pipeline.subscribe(varName, 1.0 / args.rate, decode = decode)
+    pipeline.addConsumer("writer", writer, capacity = args.queue, policy = POLICY_DROP_OLDEST, batchSize = args.batch)
+
+    _start = time.monotonic()
+    pipeline.start()
+    try:
+        while args.duration is None or time.monotonic() - _start < args.duration:
+            _wait = args.stats_interval if args.duration is None else min(args.stats_interval, args.duration - (time.monotonic() - _start))
+            time.sleep(max(0.0, _wait))
+            if not args.quiet:
+                _printStatistics(pipeline, writer, time.monotonic() - _start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+        writer.close()
+        kvp.disconnect()
+    if not args.quiet:
+        _printStatistics(pipeline, writer, time.monotonic() - _start)
+    return 0
+
+def commandBench(args):
+    import py_kukavarproxy4_bench as bench
+    results = bench.runBenchmarks(args)
+    bench.printSummary(results)
+    if not args.output is None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    return 0
+
+def _addConnectionArguments(parser):
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 7000)
+    parser.add_argument("--robot-ip", default = None, help = "robot ip set with setRobotIP after the connection")
+    parser.add_argument("--timeout", type = float, default = 3.0, help = "reply timeout in seconds")
+
+def parseArguments(argv = None):
+    parser = argparse.ArgumentParser(prog = "kvp", description = "KUKAVARPROXY command line tool")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    get = commands.add_parser("get", help = "read variables")
+    _addConnectionArguments(get)
+    get.add_argument("--json", action = "store_true", help = "print the decoded values as JSON")
+    get.add_argument("variables", nargs = "+")
+    get.set_defaults(function = commandGet)
+
+    set_ = commands.add_parser("set", help = "write variables")
+    _addConnectionArguments(set_)
+    set_.add_argument("pairs", nargs = "+", metavar = "VARIABLE VALUE", help = "the KRL values, i.e. $OV_PRO 50")
+    set_.set_defaults(function = commandSet)
+
+    poll = commands.add_parser("poll", help = "poll variables at a fixed rate and export them")
+    _addConnectionArguments(poll)
+    poll.add_argument("--rate", type = float, default = 10.0, help = "target rate in Hz")
+    poll.add_argument("--duration", type = float, default = None, help = "seconds, runs until Ctrl+C if not given")
+    poll.add_argument("--format", choices = ["text", "csv", "parquet"], default = "text")
+    poll.add_argument("-o", "--output", default = None, help = "output file, stdout if not given")
+    poll.add_argument("--raw", action = "store_true", help = "write the values as received, without decoding the structs")
+    poll.add_argument("--batch", type = int, default = 1000, help = "rows per write")
+    poll.add_argument("--flush-interval", type = float, default = 1.0, help = "maximum seconds between two writes")
+    poll.add_argument("--queue", type = int, default = 100000, help = "samples buffered before dropping the oldest")
+    poll.add_argument("--stats-interval", type = float, default = 1.0, help = "seconds between two statistics lines")
+    poll.add_argument("-q", "--quiet", action = "store_true", help = "no statistics")
+    poll.add_argument("variables", nargs = "+")
+    poll.set_defaults(function = commandPoll)
+
+    import py_kukavarproxy4_bench as bench
+    benchParser = commands.add_parser("bench", help = "run the client benchmarks")
+    bench.addArguments(benchParser)
+    benchParser.set_defaults(function = commandBench)
+
+    args = parser.parse_args(argv)
+    if args.command == "poll" and args.rate <= 0:
+        parser.error("the rate must be positive")
+    return args
+
+def main(argv = None):
+    args = parseArguments(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
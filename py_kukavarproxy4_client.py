@@ -8,7 +8,164 @@ import socket
 import time
 import traceback
 import os
-import select
+import random
+import sys
+from array import array
+
+import py_kukavarproxy4_codec as codec
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_instrumentation import Instrumentation
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class TransportProfile():
+    """ Socket options and reconnection policy of a KukaVarProxyClient connection
+
+        tcp_nodelay (bool): disables the Nagle's algorithm, small request frames are sent immediately
+        tcp_quickack (bool): disables the delayed ACKs where the platform supports it (Linux)
+        send_buffer_size, recv_buffer_size (int): SO_SNDBUF and SO_RCVBUF, None keeps the system default
+        keepalive (bool): enables the TCP keepalive, the keepalive_* times are in seconds
+        reconnect_backoff_min, reconnect_backoff_max (float): bounds of the delay between two failed
+            connection attempts in seconds, the delay is doubled after every failure
+        reconnect_jitter (float): random fraction added or removed to the delay
+    """
+    tcp_nodelay = False
+    tcp_quickack = False
+    send_buffer_size = None
+    recv_buffer_size = None
+
+    keepalive = False
+    keepalive_idle = 10
+    keepalive_interval = 3
+    keepalive_count = 3
+
+    reconnect_backoff_min = 0.1
+    reconnect_backoff_max = 10.0
+    reconnect_jitter = 0.2
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not hasattr(TransportProfile, name):
+                raise TypeError("unknown transport option %s"%name)
+            setattr(self, name, value)
+
+    @staticmethod
+    def lowLatency(**options):
+        """ Returns a profile tuned for fast cyclic polling """
+        _options = dict(tcp_nodelay = True, tcp_quickack = True, keepalive = True, reconnect_backoff_min = 0.05, reconnect_backoff_max = 2.0)
+        _options.update(options)
+        return TransportProfile(**_options)
+
+    def apply(self, sock):
+        """ Applies the socket options, the ones not supported by the platform are skipped """
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self.send_buffer_size is None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if not self.recv_buffer_size is None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive_interval)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepalive_count)
+            elif hasattr(socket, "SIO_KEEPALIVE_VALS"): #windows
+                sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(self.keepalive_idle*1000), int(self.keepalive_interval*1000)))
+        self.applyQuickAck(sock)
+
+    def applyQuickAck(self, sock):
+        """ TCP_QUICKACK is not permanent, the kernel resets it so it has to be set again before every receive """
+        if self.tcp_quickack and hasattr(socket, "TCP_QUICKACK"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    def backoffDelay(self, failures):
+        """ Returns the delay before the next connection attempt after the given number of consecutive failures """
+        delay = min(self.reconnect_backoff_max, self.reconnect_backoff_min * (2 ** min(failures - 1, 30)))
+        return delay * (1.0 + self.reconnect_jitter * random.uniform(-1.0, 1.0))
+
+
+class PreparedRead():
+    """ A read (or readArray) request encoded once, see KukaVarProxyClient.prepareRead.
+        The prepared reads always go to the controller, they don't use the client cache
+    """
+
+    def __init__(self, client, template, funcName, varName):
+        self.client = client
+        self.template = template
+        self.funcName = funcName
+        self.varName = varName
+
+    def read(self):
+        """ Returns the variable value if success otherwise None """
+        _success, _varValue = self.client.transact(self.template.kvp_func, self.template, self.funcName, self.varName)
+        return _varValue
+
+
+class PreparedWrite():
+    """ A write request encoded once, see KukaVarProxyClient.prepareWrite.
+        When the value has the same size of the previous one only the value bytes are patched,
+        otherwise the template is encoded again
+    """
+
+    def __init__(self, client, varName, varValue = ""):
+        self.client = client
+        self.varName = varName
+        self.template = codec.prepareWriteRequest(varName, varValue)
+
+    def write(self, varValue):
+        """ Returns True if success """
+        _value = varValue.encode("utf-8")
+        if not self.template.setValue(_value):
+            self.template = codec.prepareWriteRequest(self.varName, varValue)
+        _success, _varValue = self.client.transact(self.client.KVP_FUNCTION_WRITE, self.template, "writeVar", self.varName)
+        if not self.client.cache is None:
+            self.client.cache.invalidate(self.varName)
+        return _success
+
+
+class PreparedWriteArray():
+    """ A writeArray request encoded once, see KukaVarProxyClient.prepareWriteArray.
+        The values are packed in place with a precompiled struct while their count doesn't change
+    """
+
+    def __init__(self, client, varName, count):
+        self.client = client
+        self.varName = varName
+        self.count = count
+        self._packer = struct.Struct(">%dH"%count)
+        self.template = codec.prepareWriteArrayRequest(varName, [0] * count)
+
+    def write(self, varValues):
+        """ varValues (list of shorts (2bytes)): the array values
+            Returns True if success
+        """
+        if len(varValues) != self.count or not self.template.setShorts(varValues, self._packer):
+            self.count = len(varValues)
+            self._packer = struct.Struct(">%dH"%self.count)
+            self.template = codec.prepareWriteArrayRequest(self.varName, varValues)
+        _success, _varValue = self.client.transact(self.client.KVP_FUNCTION_WRITEARRAY, self.template, "writeArray", self.varName)
+        if not self.client.cache is None:
+            self.client.cache.invalidate(self.varName)
+        return _success
+
+
+class PreparedReadMany():
+    """ Pipelined reads of many variables encoded once, see KukaVarProxyClient.prepareReadMany """
+
+    def __init__(self, client, varNames):
+        self.client = client
+        self.varNames = list(varNames)
+        self.requests = [(client.KVP_FUNCTION_READ, codec.prepareReadRequest(varName)) for varName in self.varNames]
+
+    def read(self):
+        """ Returns the list of values (bytes or None if failed) in the same order of varNames """
+        _replies = self.client.transactMany(self.requests, "readMany", self.varNames)
+        return self.client.unpackManyReplies(self.client.KVP_FUNCTION_READ, _replies, "readMany")
+
 
 class KukaVarProxyClient():
     sock = None
@@ -16,6 +173,12 @@ class KukaVarProxyClient():
     port = None
 
     sock_timeout = 3.0
+
+    #max number of requests in flight for readMany/writeMany
+    max_pipeline_depth = 16
+
+    #optional ReadCache of readVar/readArray
+    cache = None
     
     #message id
     KVP_IDCOUNTER = 0 #short
@@ -44,20 +207,98 @@ class KukaVarProxyClient():
     KVP_RESULTOK			= 1;
     KVP_RESULTFAIL			= 0;
 
-    def __init__(self, _host, _port, _sockTimeout = 3.0):
+    def __init__(self, _host, _port, _sockTimeout = 3.0, _maxPipelineDepth = 16, _transportProfile = None, _instrumentation = None, _cache = None):
         self.host = _host
         self.port = _port
         self.sock_timeout = _sockTimeout
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.transport = _transportProfile if not _transportProfile is None else TransportProfile()
+        self.instrumentation = _instrumentation if not _instrumentation is None else Instrumentation()
+        self.max_pipeline_depth = max(1, min(_maxPipelineDepth, 0x7fff))
+        self.cache = _cache
+
+        #receive buffer reused for every reply, big enough for the header and the largest body
+        self._rxBuffer = bytearray(codec.KVP_HEADERSIZE + codec.KVP_MAXBODYSIZE)
+        self._rxView = memoryview(self._rxBuffer)
+
+        #connection metrics
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.reconnects = 0
+        self._consecutiveFailures = 0
+        self._nextConnectTime = 0.0
+        self._disconnectedTime = 0.0
+        self._disconnectedSince = None
+        self._everConnected = False
+
         self.connect()
 
     def connect(self):
+        """ Opens the connection applying the transport profile.
+            After a failure the next attempts are delayed with an exponential backoff,
+            during the backoff the call returns immediately
+
+            Returns True if connected
+        """
+        now = time.monotonic()
+        if now < self._nextConnectTime:
+            return False
+
+        self.connect_attempts += 1
+        sock = None
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect( (self.host, self.port) )
-            self.sock.settimeout( self.sock_timeout )
-        except:
-            traceback.print_exc()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.transport.apply(sock)
+            sock.settimeout( self.sock_timeout )
+            sock.connect( (self.host, self.port) )
+        except Exception as e:
+            print("connect - %s:%s %s"%(self.host, self.port, e))
+            if not sock is None:
+                sock.close()
+            self.sock = None
+            self.connect_failures += 1
+            self._consecutiveFailures += 1
+            self._nextConnectTime = time.monotonic() + self.transport.backoffDelay(self._consecutiveFailures)
+            if self._disconnectedSince is None:
+                self._disconnectedSince = now
+            if self.instrumentation.enabled:
+                self.instrumentation.onConnect(False, self._everConnected)
+            return False
+
+        self.sock = sock
+        if self._everConnected:
+            self.reconnects += 1
+        if self.instrumentation.enabled:
+            self.instrumentation.onConnect(True, self._everConnected)
+        self._everConnected = True
+        self._consecutiveFailures = 0
+        self._nextConnectTime = 0.0
+        if not self._disconnectedSince is None:
+            self._disconnectedTime += time.monotonic() - self._disconnectedSince
+            self._disconnectedSince = None
+        return True
+
+    def disconnect(self):
+        """ Closes the connection, the next request reconnects """
+        if not self.sock is None:
+            try:
+                self.sock.close()
+            except:
+                pass
+            self.sock = None
+            self._disconnectedSince = time.monotonic()
+
+    def transportMetrics(self):
+        """ Returns a dictionary with the connection counters and the total time spent disconnected in seconds """
+        disconnectedTime = self._disconnectedTime
+        if not self._disconnectedSince is None:
+            disconnectedTime += time.monotonic() - self._disconnectedSince
+        return {
+            "connect_attempts": self.connect_attempts,
+            "connect_failures": self.connect_failures,
+            "reconnects": self.reconnects,
+            "disconnected_time": disconnectedTime,
+            "connected": not self.sock is None,
+        }
 
     def packMessage(self, kvp_func, dataToSend):
         """ Returns the buffer ready to be sent by socket
@@ -66,339 +307,411 @@ class KukaVarProxyClient():
         if self.KVP_IDCOUNTER==0xffff:
             self.KVP_IDCOUNTER = 0
 
-        _buffer = bytearray()
-        _buffer.extend( struct.pack(">H", self.KVP_IDCOUNTER) ) #little endian, unsigned short (2 bytes)
+        if isinstance(dataToSend, codec.RequestTemplate):
+            #prepared request, only the message id is patched
+            return dataToSend.stamp(self.KVP_IDCOUNTER)
+        return codec.packMessage(self.KVP_IDCOUNTER, kvp_func, dataToSend)
 
-        _dataLen = self.KVP_FUNCTIONSIZE + len(dataToSend)
+    def read_message(self, data_length, offset = 0):
+        """ Receives exactly data_length bytes into the connection receive buffer at the given offset.
+            The call blocks up to the socket timeout waiting for the data.
 
-        if _dataLen > 0xffff or _dataLen < (self.KVP_FUNCTIONSIZE):
-            raise Exception()
-        
-        _buffer.extend( struct.pack(">H", _dataLen) ) #little endian, unsigned short (2 bytes)
+            Returns a memoryview on the receive buffer, valid until the next read_message call,
+            or None if the connection is lost
+        """
+        if self.sock is None or offset + data_length > len(self._rxBuffer):
+            return None
 
-        _buffer.extend( struct.pack("B", kvp_func) ) #unsigned char (1 byte)
+        _view = self._rxView[offset:offset + data_length]
+        received = 0
+        try:
+            while received < data_length:
+                self.transport.applyQuickAck(self.sock)
+                _n = self.sock.recv_into(_view[received:])
+                if _n < 1:
+                    #the peer closed the connection
+                    break
+                received += _n
+        except socket.timeout:
+            print("read_message - timeout")
+        except:
+            traceback.print_exc()
 
-        _buffer.extend(dataToSend)
-        return _buffer
+        if received < data_length:
+            #on timeout or socket error the reply stream is no more aligned
+            self.disconnect()
+            return None
+        return _view
 
-    def read_message(self, data_length):
-        data = bytearray()
-        while (not self.sock is None) and (len(data) < data_length):
-            try:
-                readable, writable, errors = select.select([self.sock,], [], [], 0) #last parameter is timeout, when 0 is non blocking
-                if self.sock in readable:
-                    _data = self.sock.recv(data_length-len(data))
-                    if len(_data) < 1:
-                        return data 
-                    data += _data
-            except:
-                #se il socket era risultato leggibile ma la lettura fallisce, allora si e' disconnesso
-                self.sock = None
-                return None
-        return data
+    def transact(self, kvp_func, dataToSend, funcName, varName = None):
+        """ Sends a request and waits for its reply
 
-    def readVar(self, varName):
-        """ Returns the variable value if success otherwise None """
+            kvp_func (int): the protocol function
+            dataToSend (bytes): the request body, without the function byte
+            funcName (str): the caller name, used in log messages and instrumentation
+            varName (str): the variable name, used in log messages and instrumentation
 
-        if self.sock == None:
-            self.connect()
+            Returns (True, value) if success otherwise (False, None),
+            the value depends on the function (see codec.unpackReply)
+        """
+        if self.sock == None and not self.connect():
+            return False, None
 
-        _dataToSend = bytearray()
-        _dataToSend.extend( struct.pack(">H", len(varName)))
-        _dataToSend.extend(varName.encode("utf-8"))
-        _msg = self.packMessage(self.KVP_FUNCTION_READ, _dataToSend)
+        _instr = self.instrumentation if self.instrumentation.enabled else None
+        if not _instr is None:
+            _instr.onRequest(funcName, varName)
+            _t0 = time.perf_counter()
 
         try:
+            _msg = self.packMessage(kvp_func, dataToSend)
             if self.sock.send(_msg) == len(_msg):
-            
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
-
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE*2)):
-                    print("readVar - recv bad response length")
+                if not _instr is None:
+                    _t1 = time.perf_counter()
+
+                _reply = self.read_message(codec.KVP_HEADERSIZE) #msg_id + msg_size
+                _msgID, _msgSize = codec.unpackHeader(_reply)
+                if not _instr is None:
+                    _t2 = time.perf_counter()
+
+                if not _msgID == self.KVP_IDCOUNTER:
+                    print("%s - recv bad message id"%_callName(funcName, varName))
+                    if not _instr is None:
+                        _instr.onError(funcName, varName, "bad message id")
                 else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_READ:
-                        print("readVar - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
+                    _reply = self.read_message(_msgSize, codec.KVP_HEADERSIZE)
+                    _value, result = codec.unpackReply(kvp_func, _reply)
+                    _success = result == self.KVP_RESULTOK
 
-                        _varValueSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the variable value size
+                    if not _instr is None:
+                        _instr.onReply(funcName, varName, _success, len(_msg), codec.KVP_HEADERSIZE + _msgSize, _t1 - _t0, _t2 - _t1, time.perf_counter() - _t2)
 
-                        _varValue = struct.unpack("%ss"%_varValueSize, _reply[0:_varValueSize])[0]
-                        _reply = _reply[_varValueSize:] #removing variable value
-
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
-
-                        result = _reply[0]
+                    if _success:
+                        return True, _value
+                    else:
+                        #the reply was consumed, the connection is still usable
+                        print("%s - result not OK"%_callName(funcName, varName))
+                        return False, None
+        except codec.KvpProtocolError as e:
+            print("%s - %s"%(_callName(funcName, varName), e))
+            if not _instr is None:
+                _instr.onError(funcName, varName, e)
+        except Exception as e:
+            print("%s - exception"%_callName(funcName, varName))
+            traceback.print_exc()
+            if not _instr is None:
+                _instr.onError(funcName, varName, e)
 
-                        if result == self.KVP_RESULTOK:
-                            return _varValue
-                        else:
-                            print("readVar - result not OK")
+        self.disconnect()
+        return False, None
 
-            self.sock.close()
-        except:
-            print("readVar - exception, varname: %s"%varName)
-            traceback.print_exc()
-        
-        self.sock = None
-        return None
+    def readVar(self, varName):
+        """ Returns the variable value if success otherwise None """
+        if not self.cache is None:
+            _hit, _varValue, _token = self.cache.lookup(self.KVP_FUNCTION_READ, varName)
+            if _hit:
+                return _varValue
+        _request = _encodeRequest(_callName("readVar", varName), codec.packReadRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValue = self.transact(self.KVP_FUNCTION_READ, _request, "readVar", varName)
+        if _success and not self.cache is None:
+            self.cache.store(self.KVP_FUNCTION_READ, varName, _varValue, _token)
+        return _varValue
 
     def readArray(self, varName):
         """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
-            Returns the array of shorts (2 bytes) if success otherwise None """
-
-        if self.sock == None:
-            self.connect()
-
-        _dataToSend = bytearray()
-        _dataToSend.extend( struct.pack(">H", len(varName)))
-        _dataToSend.extend(varName.encode("utf-8"))
-        _msg = self.packMessage(self.KVP_FUNCTION_READARRAY, _dataToSend)
-
-        if self.sock.send(_msg) == len(_msg):
-            try:
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
-
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE*2)):
-                    print("readArray - recv bad response length")
-                else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_READARRAY:
-                        print("readArray - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
-
-                        _varValueSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the array size in bytes
-
-                        _varValues = struct.unpack(">" + "H"*int(_varValueSize/2),_reply[0:_varValueSize])
-                        _reply = _reply[_varValueSize:] #removing variable value
-
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
-
-                        result = _reply[0]
-
-                        if result == self.KVP_RESULTOK:
-                            return _varValues
-                        else:
-                            print("readArray - result not OK")
-                
-                self.sock.close()
-            except:
-                print("readArray - exception")
-                traceback.print_exc()
-                
-        self.sock = None
-        return None
+            Returns the array('H') of shorts (2 bytes) if success otherwise None """
+        if not self.cache is None:
+            _hit, _varValues, _token = self.cache.lookup(self.KVP_FUNCTION_READARRAY, varName)
+            if _hit:
+                return _varValues
+        _request = _encodeRequest(_callName("readArray", varName), codec.packReadArrayRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValues = self.transact(self.KVP_FUNCTION_READARRAY, _request, "readArray", varName)
+        if _success and not self.cache is None:
+            self.cache.store(self.KVP_FUNCTION_READARRAY, varName, _varValues, _token)
+        return _varValues
 
     def writeVar(self, varName, varValue):
         """ Returns True if success """
-
-        if self.sock == None:
-            self.connect()
-
         if len(varName) > 0xffff or len(varValue) > 0xffff:
             print("writeVar - var name or value too long")
+            return False
 
-        _dataToSend = bytearray()
-        _dataToSend.extend( struct.pack(">H", len(varName)))
-        _dataToSend.extend(varName.encode("utf-8"))
-        _dataToSend.extend( struct.pack(">H", len(varValue)))
-        _dataToSend.extend(varValue.encode("utf-8"))
-        _msg = self.packMessage(self.KVP_FUNCTION_WRITE, _dataToSend)
-        
-        try:
-            if self.sock.send(_msg) == len(_msg):
-            
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
-
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE*2)):
-                    print("writeVar - recv bad response length")
-                else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_WRITE:
-                        print("writeVar - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
-
-                        _varValueSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the variable value size
-
-                        _varValue = struct.unpack("%ss"%_varValueSize, _reply[0:_varValueSize])[0]
-                        _reply = _reply[_varValueSize:] #removing variable value
-
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
-
-                        result = _reply[0]
-
-                        if result == self.KVP_RESULTOK:
-                            return True
-                        else:
-                            print("writeVar - result not OK")
-            self.sock.close()
-        except:
-            print("writeVar - exception, varname: %s"%varName)
-            traceback.print_exc()
-                
-        self.sock = None
-        return False
+        _success, _varValue = self.transact(self.KVP_FUNCTION_WRITE, codec.packWriteRequest(varName, varValue), "writeVar", varName)
+        if not self.cache is None:
+            self.cache.invalidate(varName)
+        return _success
 
     def writeArray(self, varName, varValues):
         """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
-            varValues (list of shorts (2bytes)): the array values
+            varValues: list of shorts, array('H'), NumPy array of uint16 or any buffer of 2 bytes items
+                in native byte order. bytes/bytearray are taken as shorts already in big-endian order
             Returns True if success 
         
         """
+        if len(varName) > 0xffff:
+            print("writeArray - var name too long")
+            return False
+        _data = _bigEndianShorts(varValues)
+        if codec.KVP_FUNCTIONSIZE + 2*codec.KVP_BLOCKSIZE + len(varName.encode("utf-8")) + len(_data) > codec.KVP_MAXBODYSIZE:
+            #too large for a single message
+            return self.writeArrayChunked(varName, _data)
 
-        if self.sock == None:
-            self.connect()
+        _success, _varValue = self.transact(self.KVP_FUNCTION_WRITEARRAY, codec.packWriteArrayRawRequest(varName, _data), "writeArray", varName)
+        if not self.cache is None:
+            self.cache.invalidate(varName)
+        return _success
 
-        if len(varName) > 0xffff or len(varValues) > 0xffff:
-            print("writeVar - var name or value too long")
+    def readArrayChunked(self, varName, count, chunkSize = 16384, asNumpy = False):
+        """ Reads an array larger than a single message with pipelined requests of chunkSize elements,
+            each one addressing an index range of the array (see codec.arrayRangeName)
 
-        _dataToSend = bytearray()
-        _dataToSend.extend( struct.pack(">H", len(varName)))
-        _dataToSend.extend(varName.encode("utf-8"))
-        _dataToSend.extend( struct.pack(">H", len(varValues)*2))
-        _dataToSend.extend(struct.pack(">%sH"%len(varValues),*varValues))
-        _msg = self.packMessage(self.KVP_FUNCTION_WRITEARRAY, _dataToSend)
-        
-        if self.sock.send(_msg) == len(_msg):
+            varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            count (int): the number of elements to read
+            asNumpy (bool): returns a NumPy array of big-endian uint16 viewing the received data, without copies
+
+            Returns an array('H') (or a NumPy array) if success otherwise None
+        """
+        chunkSize = max(1, min(chunkSize, codec.KVP_MAXARRAYSHORTS))
+        _ranges = [(first, min(chunkSize, count - first)) for first in range(0, count, chunkSize)]
+        _requests = [(self.KVP_FUNCTION_READARRAY, codec.packReadArrayRequest(codec.arrayRangeName(varName, first + 1, size))) for first, size in _ranges]
+        _replies = self.transactMany(_requests, "readArray", [varName] * len(_requests))
+
+        #the chunks are copied once, in place, into the big-endian bytes of the result
+        _values = array("H", [0]) * count
+        _data = memoryview(_values).cast("B")
+        for (first, size), _reply in zip(_ranges, _replies):
+            if _reply is None:
+                return None
             try:
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
+                _chunk, result = codec.unpackReadArrayRaw(_reply)
+            except codec.KvpProtocolError as e:
+                print("%s - %s"%(_callName("readArray", varName), e))
+                return None
+            if not result == self.KVP_RESULTOK or len(_chunk) != size * 2:
+                print("%s - chunk %d failed"%(_callName("readArray", varName), first + 1))
+                return None
+            _data[first * 2:(first + size) * 2] = _chunk
+        _data.release()
+
+        if asNumpy:
+            if np is None:
+                raise ImportError("numpy is required for asNumpy")
+            return np.frombuffer(_values, dtype = ">u2")
+        if sys.byteorder == "little":
+            _values.byteswap()
+        return _values
+
+    def writeArrayChunked(self, varName, varValues, chunkSize = 16384):
+        """ Writes an array larger than a single message with pipelined requests of chunkSize elements,
+            each one addressing an index range of the array (see codec.arrayRangeName)
+
+            varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            varValues: list of shorts, array('H'), NumPy array of uint16 or any buffer of 2 bytes items
+                in native byte order. bytes/bytearray are taken as shorts already in big-endian order
+
+            Returns True if success
+        """
+        _data = _bigEndianShorts(varValues)
+        count = len(_data) // 2
+        _nameSize = len(codec.arrayRangeName(varName, count or 1, count or 1).encode("utf-8"))
+        chunkSize = max(1, min(chunkSize, (codec.KVP_MAXBODYSIZE - codec.KVP_FUNCTIONSIZE - 2*codec.KVP_BLOCKSIZE - _nameSize)//2))
+        _requests = [(self.KVP_FUNCTION_WRITEARRAY,
+                      codec.packWriteArrayRawRequest(codec.arrayRangeName(varName, first + 1, min(chunkSize, count - first)), _data[first * 2:(first + chunkSize) * 2]))
+                     for first in range(0, count, chunkSize)]
+        _replies = self.transactMany(_requests, "writeArray", [varName] * len(_requests))
+        if not self.cache is None:
+            self.cache.invalidate(varName)
+        return all(not _value is None for _value in self.unpackManyReplies(self.KVP_FUNCTION_WRITEARRAY, _replies, "writeArray"))
+
+    def prepareRead(self, varName):
+        """ Returns a PreparedRead of the variable, encoded once: prepared.read() sends it """
+        return PreparedRead(self, codec.prepareReadRequest(varName), "readVar", varName)
+
+    def prepareReadArray(self, varName):
+        """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            Returns a PreparedRead of the array: prepared.read() sends it
+        """
+        return PreparedRead(self, codec.prepareReadArrayRequest(varName), "readArray", varName)
 
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE*2)):
-                    print("writeArray - recv bad response length")
-                else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_WRITEARRAY:
-                        print("writeArray - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
+    def prepareWrite(self, varName, varValue = ""):
+        """ Returns a PreparedWrite of the variable: prepared.write(varValue) sends it,
+            varValue gives the initial value size
+        """
+        return PreparedWrite(self, varName, varValue)
 
-                        _varNameSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the variable name size
+    def prepareWriteArray(self, varName, count):
+        """ Returns a PreparedWriteArray of count values: prepared.write(varValues) sends it """
+        return PreparedWriteArray(self, varName, count)
 
-                        _varValue = struct.unpack("%ds"%_varNameSize, _reply[0:_varNameSize])[0]
-                        _reply = _reply[_varNameSize:] #removing variable value
+    def prepareReadMany(self, varNames):
+        """ Returns a PreparedReadMany of the variables: prepared.read() sends the pipelined requests """
+        return PreparedReadMany(self, varNames)
 
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
+    def transactMany(self, requests, funcName = "transactMany", varNames = None):
+        """ Sends the requests pipelined on the connection, keeping up to max_pipeline_depth
+            messages in flight. The replies are matched to the requests by message ID.
 
-                        result = _reply[0]
+            requests (list): list of (kvp_func, dataToSend) tuples
+            funcName (str): the caller name, used in log messages and instrumentation
+            varNames (list): the variable names of the requests, used in instrumentation
 
-                        if result == self.KVP_RESULTOK:
-                            return True
-                        else:
-                            print("writeArray - result not OK")
-                self.sock.close()
-            except:
-                print("writeArray - exception")
-                traceback.print_exc()
-                
-        self.sock = None
-        return False
+            Returns the list of reply bodies (function byte included) in the same order
+            of the requests, None for the requests that did not get a reply
+        """
+        results = [None] * len(requests)
+        if len(requests) < 1:
+            return results
 
-    def parseStructure(self, value):
-        """ Given a variable value of type struct, 
-            this function returns a dictionary three of the parsed value
+        if self.sock == None and not self.connect():
+            return results
 
-            value (str): the kuka string representation of a struct 
+        _instr = self.instrumentation if self.instrumentation.enabled else None
+        pending = {} #message id -> request index
+        nextToSend = 0
+        try:
+            while nextToSend < len(requests) or len(pending) > 0:
+                #filling the pipeline, all the new frames are sent with a single call
+                _out = bytearray()
+                while nextToSend < len(requests) and len(pending) < self.max_pipeline_depth:
+                    kvp_func, dataToSend = requests[nextToSend]
+                    if not _instr is None:
+                        _instr.onRequest(funcName, None if varNames is None else varNames[nextToSend])
+                    _out.extend(self.packMessage(kvp_func, dataToSend))
+                    pending[self.KVP_IDCOUNTER] = nextToSend
+                    nextToSend += 1
+                if not _instr is None:
+                    _t0 = time.perf_counter()
+                if len(_out) > 0:
+                    self.sock.sendall(_out)
+                if not _instr is None:
+                    _t1 = time.perf_counter()
+
+                _reply = self.read_message(codec.KVP_HEADERSIZE) #msg_id + msg_size
+                if _reply is None:
+                    print("%s - connection lost"%funcName)
+                    break
+                _msgID, _msgSize = codec.unpackHeader(_reply)
+                if not _instr is None:
+                    _t2 = time.perf_counter()
+
+                _reply = self.read_message(_msgSize, codec.KVP_HEADERSIZE)
+                if _reply is None:
+                    print("%s - connection lost"%funcName)
+                    break
+
+                index = pending.pop(_msgID, None)
+                if index is None:
+                    print("%s - unexpected message id %d"%(funcName, _msgID))
+                    if not _instr is None:
+                        _instr.onError(funcName, None, "unexpected message id")
+                    continue
+                #the receive buffer is reused by the next read
+                results[index] = bytes(_reply)
+
+                if not _instr is None:
+                    try:
+                        _success = codec.unpackReply(requests[index][0], _reply)[1] == self.KVP_RESULTOK
+                    except codec.KvpProtocolError:
+                        _success = False
+                    #the requests are sent in batches, the send time is accounted to the first reply after the send
+                    _instr.onReply(funcName, None if varNames is None else varNames[index], _success,
+                                   codec.KVP_HEADERSIZE + codec.KVP_FUNCTIONSIZE + len(requests[index][1]), codec.KVP_HEADERSIZE + _msgSize,
+                                   _t1 - _t0, _t2 - _t1, time.perf_counter() - _t2)
+
+            if len(pending) == 0 and nextToSend == len(requests):
+                return results
+        except Exception as e:
+            print("%s - exception"%funcName)
+            traceback.print_exc()
+            if not _instr is None:
+                _instr.onError(funcName, None, e)
 
-            Returns a dictionary
-        """
-        resultDict = {}
-        value = value[value.index(':'):]
-        value = value.replace('{','').replace(' ','').replace('}','')
-        fields = value.split(',')
-        for v in fields:
-            v = v.strip()
-            fieldName = v[:v.index(' ')]
-            fieldValue = v[v.index(' ')+1:]
-            resultDict[fieldName] = fieldValue
-
-            if fieldValue.startswith('{'):
-                resultDict[fieldName] = self.parseStructure(fieldValue)
-        return resultDict
-
-    def packStructure(self, structTypeName, valuesDict):
-        ret = '{%s:'%structTypeName
-        for fieldName, fieldValue in valuesDict.items():
-            if type(fieldValue) == dict:
-                fieldValue = self.parseStructure(fieldName, fieldValue)
-            ret = ret + " " + fieldName + " " + str(fieldValue) + ","
-
-        return ret
+        self.disconnect()
+        return results
 
-    def discoverRobots(self):
-        """ Returns the IPs of the available robots  """
-        ipList = []
+    def _transactEncoded(self, kvp_func, bodies, funcName, varNames):
+        """ transactMany of the request bodies, the ones that couldn't be encoded (None) get a None reply
+            and the others are still pipelined
+        """
+        _indexes = [i for i, body in enumerate(bodies) if not body is None]
+        _replies = self.transactMany([(kvp_func, bodies[i]) for i in _indexes], funcName, [varNames[i] for i in _indexes])
+        results = [None] * len(bodies)
+        for i, _reply in zip(_indexes, _replies):
+            results[i] = _reply
+        return results
+
+    def unpackManyReplies(self, kvp_func, _replies, funcName):
+        """ Returns the list of values of the replies, None for the failed ones """
+        _values = []
+        for _reply in _replies:
+            _value = None
+            if not _reply is None:
+                try:
+                    _value, result = codec.unpackReply(kvp_func, _reply)
+                    if not result == self.KVP_RESULTOK:
+                        _value = None
+                except codec.KvpProtocolError as e:
+                    print("%s - %s"%(funcName, e))
+            _values.append(_value)
+        return _values
+
+    def readMany(self, varNames):
+        """ Reads many variables with pipelined requests
+
+            varNames (list of str): the variable names
+
+            Returns the list of values (bytes or None if failed) in the same order of varNames
+        """
+        _bodies = [_encodeRequest(_callName("readMany", varName), codec.packReadRequest, varName) for varName in varNames]
+        _replies = self._transactEncoded(self.KVP_FUNCTION_READ, _bodies, "readMany", varNames)
+        return self.unpackManyReplies(self.KVP_FUNCTION_READ, _replies, "readMany")
 
-        if self.sock == None:
-            self.connect()
+    def writeMany(self, pairs):
+        """ Writes many variables with pipelined requests
 
-        #MESSAGE BODY: [1 byte FUNCTION]
-        _dataToSend = bytearray()
-        _msg = self.packMessage(self.KVP_FUNCTION_DISCOVER, _dataToSend)
+            pairs (list of (str, str)): the (varName, varValue) couples
 
-        try:
-            if self.sock.send(_msg) == len(_msg):
-                #REPLY MESSAGE BODY: [1 byte FUNCTION][2 bytes IP ADDRESSES COUNT][4 bytes IP ADDRESS * IP ADDRESSES COUNT][RESULT LENGTH][RESULT]
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
+            Returns the list of results (True if success) in the same order of pairs
+        """
+        _bodies = [_encodeRequest(_callName("writeMany", varName), codec.packWriteRequest, varName, varValue) for varName, varValue in pairs]
+        _replies = self._transactEncoded(self.KVP_FUNCTION_WRITE, _bodies, "writeMany", [varName for varName, varValue in pairs])
+        if not self.cache is None:
+            for varName, varValue in pairs:
+                self.cache.invalidate(varName)
+        return [not _value is None for _value in self.unpackManyReplies(self.KVP_FUNCTION_WRITE, _replies, "writeMany")]
 
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE*2 + 1)):
-                    print("readVar - recv bad response length")
-                else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_DISCOVER:
-                        print("readVar - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
+    def parseStructure(self, value):
+        """ Given a variable value of type struct, 
+            this function returns a dictionary three of the parsed value
 
-                        _ipAddressCount = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the variable value size
+            value (str or bytes): the kuka string representation of a struct 
 
-                        for ip_index in range(0, _ipAddressCount):
-                            ip = _reply[0:4]
-                            ipList.append(ip)
-                            _reply = _reply[4:] #removing variable value
+            Returns a dictionary
+        """
+        return krl.parseKrl(value)
 
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
+    def packStructure(self, structTypeName, valuesDict, precision = krl.DEFAULT_PRECISION):
+        """ Given a dictionary of field values (nested dictionaries are nested structs),
+            this function returns the kuka string representation of a struct
 
-                        result = _reply[0]
+            structTypeName (str): the struct type, i.e. E6POS
+            precision (int): decimals of the real values
 
-                        if result == self.KVP_RESULTOK:
-                            return ipList
-                        else:
-                            print("readVar - result not OK")
+            Returns a str, i.e. "{E6POS: X 10.0000, Y 0.0000, ..., S 2, T 35}"
+        """
+        return krl.formatKrl(valuesDict, structTypeName, precision)
 
-            self.sock.close()
-        except:
-            traceback.print_exc()
-        
-        self.sock = None
-        return []
+    def discoverRobots(self):
+        """ Returns the IPs of the available robots  """
+        #MESSAGE BODY: [1 byte FUNCTION]
+        #REPLY MESSAGE BODY: [1 byte FUNCTION][2 bytes IP ADDRESSES COUNT][4 bytes IP ADDRESS * IP ADDRESSES COUNT][RESULT LENGTH][RESULT]
+        _success, ipList = self.transact(self.KVP_FUNCTION_DISCOVER, codec.packDiscoverRequest(), "discoverRobots")
+        if not _success:
+            return []
+        return ipList
 
     def setRobotIP(self, ip):
         """ Sets the ip of the server robot 
@@ -406,47 +719,9 @@ class KukaVarProxyClient():
                 ip (list) = list of 4 ip bytes
         """
         #MESSAGE BODY: [1 byte FUNCTION][4 bytes IP]
-
-        if self.sock == None:
-            self.connect()
-
-        _dataToSend = bytearray(ip)
-        _msg = self.packMessage(self.KVP_FUNCTION_SETROBOTIP, _dataToSend)
-
-        try:
-            if self.sock.send(_msg) == len(_msg):
-                #REPLY MESSAGE BODY: [1 byte FUNCTION][RESULT LENGTH][RESULT]
-                _reply = self.read_message(4) #msg_id + msg_size
-                _msgID, _msgSize = struct.unpack(">HH", _reply)
-
-                if (not _msgID == self.KVP_IDCOUNTER) or (_msgSize < (self.KVP_FUNCTIONSIZE + self.KVP_BLOCKSIZE + 1)):
-                    print("readVar - recv bad response length")
-                else:
-                    _reply = self.read_message(_msgSize)
-                    
-                    if not _reply[0] == self.KVP_FUNCTION_SETROBOTIP:
-                        print("readVar - invalid packet, the returned function doesn't match") 
-                    else:
-                        _reply = _reply[1:] #removing the first byte that is the function
-
-                        #this is not useful, the result size is 1, but I leave this as is
-                        _resultSize = struct.unpack(">H", _reply[0:2])[0]
-                        _reply = _reply[2:] #removing the result size
-
-                        result = _reply[0]
-
-                        if result == self.KVP_RESULTOK:
-                            return True
-                        else:
-                            print("readVar - result not OK")
-
-            self.sock.close()
-        except:
-            traceback.print_exc()
-        
-        self.sock = None
-        return False
-
+        #REPLY MESSAGE BODY: [1 byte FUNCTION][RESULT LENGTH][RESULT]
+        _success, _value = self.transact(self.KVP_FUNCTION_SETROBOTIP, codec.packSetRobotIPRequest(ip), "setRobotIP")
+        return _success
 
 
 libPath = '/R1/sickodvaluelib/'
@@ -455,6 +730,50 @@ robotPort = 7000
 
 sockPartner = None
 
+def _callName(funcName, varName):
+    """ Returns the call description used in log messages """
+    if varName is None:
+        return funcName
+    return "%s(%s)"%(funcName, varName)
+
+def _encode(funcName, pack, *args):
+    """ Returns the request body built by pack(*args), None if it can't be encoded (i.e. too long) """
+    try:
+        return pack(*args)
+    except (codec.KvpProtocolError, struct.error, UnicodeError) as e:
+        print("%s - %s"%(funcName, e))
+        return None
+
+def _encodeRequest(funcName, pack, *args):
+    """ Returns the request body built by pack(*args), None if it can't be encoded or doesn't fit in a message """
+    _body = _encode(funcName, pack, *args)
+    if not _body is None and codec.KVP_FUNCTIONSIZE + len(_body) > codec.KVP_MAXBODYSIZE:
+        print("%s - message body too long: %d bytes"%(funcName, codec.KVP_FUNCTIONSIZE + len(_body)))
+        return None
+    return _body
+
+def _bigEndianShorts(varValues):
+    """ Returns a buffer of the values as big-endian shorts, buffers of 1 byte items are taken as already packed """
+    if isinstance(varValues, (bytes, bytearray)):
+        return memoryview(varValues)
+    if not np is None and isinstance(varValues, np.ndarray):
+        return memoryview(np.ascontiguousarray(varValues, dtype = ">u2")).cast("B")
+    try:
+        _view = memoryview(varValues)
+    except TypeError:
+        #list or tuple of ints
+        return memoryview(struct.pack(">%dH"%len(varValues), *varValues))
+    if _view.itemsize == 1:
+        #already packed, i.e. the result of a previous call
+        return _view.cast("B")
+    if _view.itemsize != 2:
+        raise codec.KvpProtocolError("the array items must be 2 bytes, got %d"%_view.itemsize)
+    _values = array("H")
+    _values.frombytes(_view.cast("B"))
+    if sys.byteorder == "little":
+        _values.byteswap()
+    return memoryview(_values).cast("B")
+
 def parseValue(stringa):
     try:
         return float(stringa)
@@ -466,77 +785,22 @@ def parseValue(stringa):
         return stringa
 
 def toPythonDict(stringa):
-    i = 0
-    resultDict = {}
-    field = ""
-    jumpSubStruct = 0
-    for c in stringa:
-        i += 1
-        if jumpSubStruct > 0: #per scartare le sottostrutture
-            if c=='{':
-                jumpSubStruct += 1
-                continue
-            if c=='}':
-                jumpSubStruct -= 1
-                continue
-
-        if c=='{':
-            jumpSubStruct += 1
-            field = field.strip()
-            fieldName = field
-            fieldValue = toPythonDict(stringa[i:])
-
-            resultDict[fieldName] = fieldValue
-            field = ""
-            continue
-
-        if c==':': #per scartare il nome struttura
-            field = ""
-            continue
-
-        elif c==',': #per separare i campi
-            field = field.strip()
-
-            if len(field)<1: #dopo il parse di una struttura
-                continue
-
-            if len(field.split(' '))<2: #campo senza valore
-                field = ""
-                continue
-            fieldName, fieldValue = field[:field.index(' ')], field[field.index(' ')+1:]
-            
-            resultDict[fieldName] = parseValue(fieldValue)
-            field = ""
-            continue
-
-        elif c=='}': #per separare i campi
-            field = field.strip()
-
-            if len(field)<1: #dopo il parse di una struttura
-                break
-
-            if len(field.split(' '))<2: #campo senza valore
-                field = ""
-                break
-            fieldName, fieldValue = field[:field.index(' ')], field[field.index(' ')+1:]
-            
-            resultDict[fieldName] = parseValue(fieldValue)
-            field = ""
-            break
-        
-        else:
-            field += c
-
-    return resultDict    
+    """ Parses a KRL struct, with or without the external braces, into a dictionary
+        i.e. E6AXIS: A1 0.0, A2 -90.0, A3 90.0, A4 0.0, A5 0.0, A6 0.0
+    """
+    if stringa.lstrip().startswith('{'):
+        return krl.parseKrl(stringa)
+    return krl.parseStructBody(stringa)
 
 
 if __name__ == '__main__':
-    kvp = KukaVarProxyClient(kukavarproxyIP, robotPort)
+    kvp = KukaVarProxyClient(kukavarproxyIP, robotPort, _transportProfile = TransportProfile.lowLatency())
     IPs = [[172,17,255,1],]
     
-    while len(IPs) < 1:
+    if len(IPs) < 1:
+        from py_kukavarproxy4_discovery import DiscoveryService
         print("discovering robots...")
-        IPs = kvp.discoverRobots()
+        IPs = [list(ip.packed) for ip in DiscoveryService([(kukavarproxyIP, robotPort)]).discover()]
     
     print("Found IPs:")
     for ip in IPs:
@@ -569,10 +833,17 @@ if __name__ == '__main__':
 
     rdk_robot.setSpeedJoints(100)
     rdk_robot.setAccelerationJoints(100)
-    while True:
-        stringa = kvp.readVar("$AXIS_ACT").decode()
-        stringa = stringa[stringa.index('{')+1: stringa.rindex('}') ]
-        pos = toPythonDict(stringa)
-        
+    from py_kukavarproxy4_pipeline import AcquisitionPipeline, POLICY_LATEST
+
+    #MoveJ blocks while the simulated robot moves: it only gets the latest position, the reads go on at 250 Hz
+    def moveRobot(sample):
+        pos = sample.value
         rdk_robot.MoveJ([pos['A1'], pos['A2'], pos['A3'], pos['A4'], pos['A5'], pos['A6']])
+
+    pipeline = AcquisitionPipeline(kvp)
+    pipeline.subscribe("$AXIS_ACT", 0.004, decode = krl.parseKrl) #250 Hz
+    pipeline.addConsumer("robodk", moveRobot, policy = POLICY_LATEST)
+    with pipeline:
+        input("press enter to stop")
+    print(pipeline.statistics())
     """ 
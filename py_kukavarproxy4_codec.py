@@ -0,0 +1,335 @@
+"""
+    Author: Davide Rosa
+    Description: Protocol codec for KUKAVARPROXY for KRC4, shared by the sync and async clients.
+                 The functions here are pure: they do not touch sockets and keep no state,
+                 a RequestTemplate only holds its own encoded frame.
+
+    Protocol is BIG-ENDIAN
+    Messages Header format: [2 bytes MESSAGE ID][2 bytes MESSAGE BODY LEN]
+"""
+
+import re
+import struct
+import sys
+from array import array
+
+""" Byte size of the various protocol messages fields """
+KVP_IDSIZE              = 2
+KVP_LENSIZE             = 2
+KVP_HEADERSIZE          = KVP_IDSIZE + KVP_LENSIZE
+KVP_IPSIZE              = 4 #i.e. 0x255 0x255 0x255 0x0
+KVP_FUNCTIONSIZE        = 1
+KVP_BLOCKSIZE           = 2
+KVP_RESULTLENGTHSIZE    = 2
+KVP_RESULTSIZE          = 1
+
+KVP_FUNCTION_READ       = 0
+KVP_FUNCTION_WRITE      = 1
+KVP_FUNCTION_READARRAY  = 2
+KVP_FUNCTION_WRITEARRAY = 3
+KVP_FUNCTION_DISCOVER   = 4
+KVP_FUNCTION_SETROBOTIP = 5
+
+KVP_RESULTOK            = 1
+KVP_RESULTFAIL          = 0
+
+KVP_MAXBODYSIZE         = 0xffff
+
+#max number of shorts of a READARRAY reply: [1 byte FUNCTION][ARRAY LENGTH][shorts][RESULT LENGTH][RESULT]
+KVP_MAXARRAYSHORTS      = (KVP_MAXBODYSIZE - KVP_FUNCTIONSIZE - KVP_BLOCKSIZE - KVP_RESULTLENGTHSIZE - KVP_RESULTSIZE)//2
+
+_header = struct.Struct(">HH")
+_block = struct.Struct(">H")
+_arrayRange = re.compile(r"^(.*)\[(\d+)\.\.(\d+)\]$")
+
+
+class KvpProtocolError(Exception):
+    """ Raised when a message can't be encoded or a reply is malformed """
+    pass
+
+
+def packMessage(msgID, kvp_func, dataToSend):
+    """ Returns the buffer ready to be sent by socket
+        [2 bytes MESSAGE ID][2 bytes MESSAGE BODY LEN][1 byte FUNCTION][dataToSend]
+    """
+    _dataLen = KVP_FUNCTIONSIZE + len(dataToSend)
+    if _dataLen > KVP_MAXBODYSIZE:
+        raise KvpProtocolError("message body too long: %d bytes"%_dataLen)
+
+    _buffer = bytearray(KVP_HEADERSIZE + _dataLen)
+    _header.pack_into(_buffer, 0, msgID & 0xffff, _dataLen)
+    _buffer[KVP_HEADERSIZE] = kvp_func
+    _buffer[KVP_HEADERSIZE + KVP_FUNCTIONSIZE:] = dataToSend
+    return _buffer
+
+def stampMessageID(buffer, msgID):
+    """ Patches the message ID of a frame built by packMessage in place """
+    _block.pack_into(buffer, 0, msgID & 0xffff)
+    return buffer
+
+def packBlock(data):
+    """ Returns [2 bytes LENGTH][data] """
+    if len(data) > KVP_MAXBODYSIZE:
+        raise KvpProtocolError("block too long: %d bytes"%len(data))
+    return _block.pack(len(data)) + data
+
+def packReadRequest(varName):
+    """ REQUEST MESSAGE BODY (without function): [VARIABLE NAME LENGTH][VARIABLE NAME] """
+    return packBlock(varName.encode("utf-8"))
+
+def packWriteRequest(varName, varValue):
+    """ REQUEST MESSAGE BODY (without function): [VARIABLE NAME LENGTH][VARIABLE NAME][VARIABLE VALUE LENGTH][VARIABLE VALUE] """
+    return packBlock(varName.encode("utf-8")) + packBlock(varValue.encode("utf-8"))
+
+def packReadArrayRequest(varName):
+    """ varName (str): the variable name with [] at the end. i.e. MYARRAY[] """
+    return packReadRequest(varName)
+
+def packWriteArrayRequest(varName, varValues):
+    """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+        varValues (list of shorts (2bytes)): the array values
+    """
+    return packBlock(varName.encode("utf-8")) + packBlock(struct.pack(">%sH"%len(varValues), *varValues))
+
+def packWriteArrayRawRequest(varName, data):
+    """ varName (str): the variable name with [] at the end, or an array range (see arrayRangeName)
+        data (bytes-like): the array values already packed as big-endian shorts
+    """
+    return packBlock(varName.encode("utf-8")) + packBlock(data)
+
+def arrayRangeName(varName, first, count):
+    """ Returns the name addressing count elements of an array starting at index first (1 based, like KRL)
+        i.e. MYARRAY[], 1, 100 -> MYARRAY[1..100]
+    """
+    if first < 1 or count < 1:
+        raise KvpProtocolError("invalid array range: first %d count %d"%(first, count))
+    _name = varName[:-2] if varName.endswith("[]") else varName
+    return "%s[%d..%d]"%(_name, first, first + count - 1)
+
+def parseArrayRangeName(varName):
+    """ Returns (array name with [] at the end, first, count) of an array range name, None if varName is not a range """
+    _match = _arrayRange.match(varName)
+    if _match is None:
+        return None
+    first, last = int(_match.group(2)), int(_match.group(3))
+    if first < 1 or last < first:
+        return None
+    return _match.group(1) + "[]", first, last - first + 1
+
+def packDiscoverRequest():
+    """ REQUEST MESSAGE BODY (without function): empty """
+    return b""
+
+def packSetRobotIPRequest(ip):
+    """ ip (list) = list of 4 ip bytes """
+    if len(ip) != KVP_IPSIZE:
+        raise KvpProtocolError("invalid ip: %s"%(ip,))
+    return bytes(ip)
+
+
+class RequestTemplate():
+    """ A request frame encoded once and sent many times.
+        Only the message ID is patched before every send, and the value of the write requests
+        when it has the same size of the previous one (fixed shape values)
+
+        kvp_func (int): the protocol function
+        dataToSend (bytes): the request body, without the function byte
+        valueOffset (int): offset of the value bytes in dataToSend, None if the value can't be patched
+    """
+    __slots__ = ("kvp_func", "frame", "valueOffset", "valueSize")
+
+    def __init__(self, kvp_func, dataToSend, valueOffset = None):
+        self.kvp_func = kvp_func
+        self.frame = packMessage(0, kvp_func, dataToSend)
+        self.valueOffset = None
+        self.valueSize = 0
+        if not valueOffset is None:
+            self.valueOffset = KVP_HEADERSIZE + KVP_FUNCTIONSIZE + valueOffset
+            self.valueSize = len(self.frame) - self.valueOffset
+
+    def __len__(self):
+        """ Size of the request body without the function byte, like the dataToSend it replaces """
+        return len(self.frame) - KVP_HEADERSIZE - KVP_FUNCTIONSIZE
+
+    def stamp(self, msgID):
+        """ Patches the message ID in place and returns the frame """
+        return stampMessageID(self.frame, msgID)
+
+    def setValue(self, value):
+        """ Patches the value bytes in place, returns False if the size differs from the template one """
+        if self.valueOffset is None or len(value) != self.valueSize:
+            return False
+        self.frame[self.valueOffset:] = value
+        return True
+
+    def setShorts(self, shorts, packer):
+        """ Patches the value of a write array request in place with a precompiled struct packer (">%dH") """
+        if self.valueOffset is None or packer.size != self.valueSize:
+            return False
+        packer.pack_into(self.frame, self.valueOffset, *shorts)
+        return True
+
+def prepareReadRequest(varName):
+    return RequestTemplate(KVP_FUNCTION_READ, packReadRequest(varName))
+
+def prepareReadArrayRequest(varName):
+    return RequestTemplate(KVP_FUNCTION_READARRAY, packReadArrayRequest(varName))
+
+def prepareWriteRequest(varName, varValue):
+    _name = packBlock(varName.encode("utf-8"))
+    return RequestTemplate(KVP_FUNCTION_WRITE, _name + packBlock(varValue.encode("utf-8")), len(_name) + KVP_BLOCKSIZE)
+
+def prepareWriteArrayRequest(varName, varValues):
+    _name = packBlock(varName.encode("utf-8"))
+    return RequestTemplate(KVP_FUNCTION_WRITEARRAY, _name + packBlock(struct.pack(">%sH"%len(varValues), *varValues)), len(_name) + KVP_BLOCKSIZE)
+
+def unpackHeader(buffer, offset = 0):
+    """ Returns (msgID, msgSize) """
+    if buffer is None or len(buffer) - offset < KVP_HEADERSIZE:
+        raise KvpProtocolError("truncated header")
+    return _header.unpack_from(buffer, offset)
+
+def _unpackBlock(body, offset, what):
+    """ Returns (block, next offset) where block is a view on body """
+    if len(body) < offset + KVP_BLOCKSIZE:
+        raise KvpProtocolError("truncated %s length"%what)
+    _size = _block.unpack_from(body, offset)[0]
+    offset += KVP_BLOCKSIZE
+    if len(body) < offset + _size:
+        raise KvpProtocolError("truncated %s"%what)
+    return memoryview(body)[offset:offset + _size], offset + _size
+
+def _unpackResult(body, offset):
+    #the result size is always 1, the result is the first byte of the block
+    _result, offset = _unpackBlock(body, offset, "result")
+    if len(_result) < KVP_RESULTSIZE:
+        raise KvpProtocolError("empty result")
+    return _result[0]
+
+def unpackReply(kvp_func, body):
+    """ Parses the reply body of the given function
+
+        body (bytes-like): the message body, starting with the function byte
+
+        Returns (value, result) where value depends on the function:
+            READ, WRITE: the variable value (bytes)
+            READARRAY: the array('H') of shorts (2 bytes)
+            WRITEARRAY: the variable value (bytes)
+            DISCOVER: the list of IPs (4 bytes each)
+            SETROBOTIP: None
+    """
+    if body is None or len(body) < KVP_FUNCTIONSIZE:
+        raise KvpProtocolError("empty reply")
+    if not body[0] == kvp_func:
+        raise KvpProtocolError("invalid packet, the returned function doesn't match")
+
+    offset = KVP_FUNCTIONSIZE
+    if kvp_func in (KVP_FUNCTION_READ, KVP_FUNCTION_WRITE, KVP_FUNCTION_WRITEARRAY):
+        _varValue, offset = _unpackBlock(body, offset, "value")
+        return bytes(_varValue), _unpackResult(body, offset)
+
+    if kvp_func == KVP_FUNCTION_READARRAY:
+        _varValues, offset = _unpackBlock(body, offset, "array")
+        return unpackShorts(_varValues[:len(_varValues)//2*2]), _unpackResult(body, offset)
+
+    if kvp_func == KVP_FUNCTION_DISCOVER:
+        #[1 byte FUNCTION][2 bytes IP ADDRESSES COUNT][4 bytes IP ADDRESS * IP ADDRESSES COUNT][RESULT LENGTH][RESULT]
+        if len(body) < offset + KVP_BLOCKSIZE:
+            raise KvpProtocolError("truncated ip count")
+        _ipAddressCount = _block.unpack_from(body, offset)[0]
+        offset += KVP_BLOCKSIZE
+        if len(body) < offset + _ipAddressCount*KVP_IPSIZE:
+            raise KvpProtocolError("truncated ip list")
+        ipList = [bytes(body[offset + i*KVP_IPSIZE: offset + (i+1)*KVP_IPSIZE]) for i in range(_ipAddressCount)]
+        offset += _ipAddressCount*KVP_IPSIZE
+        return ipList, _unpackResult(body, offset)
+
+    if kvp_func == KVP_FUNCTION_SETROBOTIP:
+        #[1 byte FUNCTION][RESULT LENGTH][RESULT]
+        return None, _unpackResult(body, offset)
+
+    raise KvpProtocolError("unknown function %d"%kvp_func)
+
+
+def unpackShorts(data):
+    """ Returns the array('H') of the big-endian shorts of data (bytes-like of even size) """
+    _values = array("H")
+    _values.frombytes(data)
+    if sys.byteorder == "little":
+        _values.byteswap()
+    return _values
+
+def unpackReadArrayRaw(body):
+    """ Parses a READARRAY reply body without decoding the shorts
+
+        Returns (data, result) where data is a view of the big-endian shorts on body
+    """
+    if body is None or len(body) < KVP_FUNCTIONSIZE:
+        raise KvpProtocolError("empty reply")
+    if not body[0] == KVP_FUNCTION_READARRAY:
+        raise KvpProtocolError("invalid packet, the returned function doesn't match")
+    _data, offset = _unpackBlock(body, KVP_FUNCTIONSIZE, "array")
+    if len(_data) % 2 != 0:
+        raise KvpProtocolError("odd array length: %d bytes"%len(_data))
+    return _data, _unpackResult(body, offset)
+
+
+""" Server side: requests parsing and replies encoding """
+
+def unpackRequest(body):
+    """ Parses the request body of any function
+
+        body (bytes-like): the message body, starting with the function byte
+
+        Returns (kvp_func, args) where args depends on the function:
+            READ, READARRAY: (varName,)
+            WRITE: (varName, varValue) with varValue as bytes
+            WRITEARRAY: (varName, tuple of shorts)
+            DISCOVER: ()
+            SETROBOTIP: (ip,) with ip as 4 bytes
+    """
+    if body is None or len(body) < KVP_FUNCTIONSIZE:
+        raise KvpProtocolError("empty request")
+    kvp_func = body[0]
+    offset = KVP_FUNCTIONSIZE
+
+    if kvp_func in (KVP_FUNCTION_READ, KVP_FUNCTION_READARRAY):
+        _varName, offset = _unpackBlock(body, offset, "name")
+        return kvp_func, (bytes(_varName).decode("utf-8"),)
+
+    if kvp_func in (KVP_FUNCTION_WRITE, KVP_FUNCTION_WRITEARRAY):
+        _varName, offset = _unpackBlock(body, offset, "name")
+        _varValue, offset = _unpackBlock(body, offset, "value")
+        if kvp_func == KVP_FUNCTION_WRITE:
+            return kvp_func, (bytes(_varName).decode("utf-8"), bytes(_varValue))
+        return kvp_func, (bytes(_varName).decode("utf-8"), struct.unpack_from(">%dH"%(len(_varValue)//2), _varValue))
+
+    if kvp_func == KVP_FUNCTION_DISCOVER:
+        return kvp_func, ()
+
+    if kvp_func == KVP_FUNCTION_SETROBOTIP:
+        if len(body) < offset + KVP_IPSIZE:
+            raise KvpProtocolError("truncated ip")
+        return kvp_func, (bytes(body[offset:offset + KVP_IPSIZE]),)
+
+    raise KvpProtocolError("unknown function %d"%kvp_func)
+
+def packResult(result):
+    """ Returns [RESULT LENGTH][RESULT] """
+    return _block.pack(KVP_RESULTSIZE) + bytes((result,))
+
+def packValueReply(varValue, result):
+    """ READ, WRITE and WRITEARRAY reply body (without function): [VARIABLE VALUE LENGTH][VARIABLE VALUE][RESULT LENGTH][RESULT] """
+    return packBlock(varValue) + packResult(result)
+
+def packReadArrayReply(varValues, result):
+    """ READARRAY reply body (without function): [ARRAY LENGTH IN BYTES][shorts (2 bytes)][RESULT LENGTH][RESULT] """
+    return packBlock(struct.pack(">%dH"%len(varValues), *varValues)) + packResult(result)
+
+def packDiscoverReply(ipList, result):
+    """ DISCOVER reply body (without function): [IP ADDRESSES COUNT][4 bytes IP ADDRESS * IP ADDRESSES COUNT][RESULT LENGTH][RESULT] """
+    return _block.pack(len(ipList)) + b"".join(bytes(ip) for ip in ipList) + packResult(result)
+
+def packSetRobotIPReply(result):
+    """ SETROBOTIP reply body (without function): [RESULT LENGTH][RESULT] """
+    return packResult(result)
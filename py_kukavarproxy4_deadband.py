@@ -0,0 +1,139 @@
+"""
+    Author: Davide Rosa
+    Description: Change-only delivery of polled variables.
+
+    The raw reply of a variable is compared with the previous one first: when the bytes are identical
+    the value is not decoded at all. Otherwise the value is decoded and compared field by field with the
+    last delivered value, the numeric fields are considered changed only when they move more than their deadband.
+
+    i.e.
+        changes = ChangeFilter()
+        changes.setDeadband("$AXIS_ACT", {"A1": 0.01, "A2": 0.01, "A3": 0.01, "A4": 0.01, "A5": 0.01, "A6": 0.01})
+        while True:
+            changed, value = changes.update("$AXIS_ACT", kvp.readVar("$AXIS_ACT"))
+            if changed:
+                publish(value)
+"""
+
+from array import array
+
+import py_kukavarproxy4_krl as krl
+
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _fields(value):
+    """ Returns the (name, value) couples of a decoded value, None if it is a scalar """
+    if isinstance(value, dict):
+        return value.items()
+    if hasattr(value, "asDict"): #KrlRecord
+        return value.asDict().items()
+    if isinstance(value, (tuple, list, array)): #readArray values
+        return enumerate(value)
+    return None
+
+
+class ChangeDetector():
+    """ Change detection of a single variable
+
+        deadband (float or dict): a number applies to all the numeric fields, a dictionary gives the deadband
+            of single fields (nested struct fields with dotted names i.e. CM.X), the fields not listed must change exactly.
+            None (or 0) delivers every value that differs
+        decode (callable): applied to the raw value before the comparison, None to compare the raw values only
+    """
+
+    def __init__(self, deadband = None, decode = krl.parseKrl):
+        self.deadband = deadband
+        self.decode = decode
+        self._lastRaw = None
+        self._lastValue = None
+        self._hasValue = False
+
+        #statistics
+        self.raw_unchanged = 0
+        self.suppressed = 0
+        self.delivered = 0
+
+    def reset(self):
+        self._lastRaw = None
+        self._lastValue = None
+        self._hasValue = False
+
+    def _fieldDeadband(self, path):
+        if isinstance(self.deadband, dict):
+            return self.deadband.get(path, 0.0)
+        return self.deadband or 0.0
+
+    def _differs(self, old, new, path):
+        _oldFields = _fields(old)
+        _newFields = _fields(new)
+        if _oldFields is None or _newFields is None:
+            if _isNumber(old) and _isNumber(new):
+                return abs(new - old) > self._fieldDeadband(path)
+            return old != new
+
+        _old = dict(_oldFields)
+        _count = 0
+        for name, value in _newFields:
+            _count += 1
+            if not name in _old:
+                return True
+            _path = str(name) if path is None else "%s.%s"%(path, name)
+            if self._differs(_old[name], value, _path):
+                return True
+        return _count != len(_old)
+
+    def update(self, raw):
+        """ raw (bytes or array): the value as returned by readVar/readArray, None is ignored
+
+            Returns (changed, value) where value is the decoded value if changed, otherwise the last delivered value
+        """
+        if raw is None: #failed read
+            return False, self._lastValue
+        if self._hasValue and raw == self._lastRaw:
+            self.raw_unchanged += 1
+            return False, self._lastValue
+        self._lastRaw = raw
+
+        #readArray values (arrays) are compared as they are
+        value = raw if self.decode is None or not isinstance(raw, (bytes, bytearray, str)) else self.decode(raw)
+        if self._hasValue and not self._differs(self._lastValue, value, None):
+            self.suppressed += 1
+            return False, self._lastValue
+
+        self._lastValue = value
+        self._hasValue = True
+        self.delivered += 1
+        return True, value
+
+    def statistics(self):
+        return {"raw_unchanged": self.raw_unchanged, "suppressed": self.suppressed, "delivered": self.delivered}
+
+
+class ChangeFilter():
+    """ Change detection of many variables, keyed by variable name
+
+        decode (callable): the default decode of the variables (see ChangeDetector)
+    """
+
+    def __init__(self, decode = krl.parseKrl):
+        self.decode = decode
+        self.detectors = {}
+
+    def setDeadband(self, varName, deadband, decode = None):
+        """ Sets the deadband of a variable (see ChangeDetector), decode defaults to the filter one """
+        self.detectors[varName] = ChangeDetector(deadband, self.decode if decode is None else decode)
+
+    def detector(self, varName):
+        _detector = self.detectors.get(varName)
+        if _detector is None:
+            _detector = self.detectors[varName] = ChangeDetector(None, self.decode)
+        return _detector
+
+    def update(self, varName, raw):
+        """ Returns (changed, value), see ChangeDetector.update """
+        return self.detector(varName).update(raw)
+
+    def statistics(self):
+        return {varName: _detector.statistics() for varName, _detector in self.detectors.items()}
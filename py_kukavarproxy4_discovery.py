@@ -0,0 +1,171 @@
+"""
+    Author: Davide Rosa
+    Description: Concurrent discovery of the robots behind many KUKAVARPROXY servers and parallel robot IP assignment.
+
+    Every server (endpoint) is queried in its own thread, with a timeout and a few attempts spaced by the
+    transport profile backoff. The robot IPs are decoded into ipaddress.IPv4Address objects and merged:
+    a robot seen by many endpoints is reported once, with the list of the endpoints that see it.
+    The replies are cached for ttl seconds, a new discovery only queries the endpoints whose result expired.
+    The robot IP is a property of the connection: assign() opens a client per endpoint and sets the IPs
+    in parallel, the clients returned are ready to be used.
+    The duration of every step is kept in timings.
+
+    i.e.
+        service = DiscoveryService([("192.168.1.10", 7000), ("192.168.1.11", 7000)], timeout = 0.5)
+        robots = service.discover() #{IPv4Address("172.17.255.1"): [("192.168.1.10", 7000)], ...}
+        clients = service.assign({("192.168.1.10", 7000): "172.17.255.1", ("192.168.1.11", 7000): "172.17.255.2"})
+        print(service.timings)
+"""
+
+import ipaddress
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import py_kukavarproxy4_codec as codec
+from py_kukavarproxy4_client import KukaVarProxyClient, TransportProfile
+
+
+def robotAddress(ip):
+    """ Returns the IPv4Address of a robot ip: list of 4 bytes (as returned by discoverRobots), dotted string or IPv4Address """
+    if isinstance(ip, ipaddress.IPv4Address):
+        return ip
+    if isinstance(ip, str):
+        return ipaddress.IPv4Address(ip)
+    return ipaddress.IPv4Address(bytes(ip))
+
+def _endpointKey(endpoint):
+    return (endpoint[0], int(endpoint[1]))
+
+
+class DiscoveryService():
+    """ Discovers the robots of many endpoints concurrently and assigns them
+
+        endpoints (list): (host, port) of the KUKAVARPROXY servers
+        timeout (float): seconds to wait for the connection and for every reply
+        attempts (int): discovery attempts per endpoint before giving up
+        ttl (float): seconds a discovery result is reused, 0 disables the cache
+        maxWorkers (int): threads querying the endpoints, None uses one per endpoint
+        transportProfile (TransportProfile): socket options of the connections and delay between the attempts
+    """
+
+    def __init__(self, endpoints, timeout = 1.0, attempts = 3, ttl = 30.0, maxWorkers = None, transportProfile = None):
+        self.endpoints = [_endpointKey(endpoint) for endpoint in endpoints]
+        self.timeout = timeout
+        self.attempts = max(1, attempts)
+        self.ttl = ttl
+        self.maxWorkers = maxWorkers
+        self.transport = transportProfile if not transportProfile is None else TransportProfile.lowLatency()
+        self._cache = {} #endpoint -> (monotonic time, tuple of IPv4Address)
+        self.failed = [] #endpoints that didn't reply to the last discovery
+        self.timings = {}
+
+    def _executor(self, count):
+        return ThreadPoolExecutor(max(1, min(count, self.maxWorkers or count)), thread_name_prefix = "kvp-discovery")
+
+    def _query(self, endpoint):
+        """ Returns (tuple of IPv4Address or None if failed, seconds) """
+        _start = time.monotonic()
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                time.sleep(self.transport.backoffDelay(attempt))
+            #a new client per attempt: its connection is not skipped by the backoff of the previous failure
+            kvp = KukaVarProxyClient(endpoint[0], endpoint[1], _sockTimeout = self.timeout, _transportProfile = self.transport)
+            try:
+                _success, ipList = kvp.transact(codec.KVP_FUNCTION_DISCOVER, codec.packDiscoverRequest(), "discoverRobots")
+            finally:
+                kvp.disconnect()
+            if _success:
+                return tuple(robotAddress(ip) for ip in ipList), time.monotonic() - _start
+        return None, time.monotonic() - _start
+
+    def discover(self, refresh = False):
+        """ Queries the endpoints whose cached result is expired (all of them if refresh)
+
+            Returns a dictionary IPv4Address -> list of the (host, port) endpoints that see the robot, sorted by address
+        """
+        _start = time.monotonic()
+        _expired = [endpoint for endpoint in self.endpoints
+                    if refresh or self.ttl <= 0 or not endpoint in self._cache or _start - self._cache[endpoint][0] > self.ttl]
+        _endpointTimes = {}
+        self.failed = []
+        if len(_expired) > 0:
+            with self._executor(len(_expired)) as executor:
+                for endpoint, (ips, seconds) in zip(_expired, executor.map(self._query, _expired)):
+                    _endpointTimes["%s:%d"%endpoint] = seconds
+                    if ips is None:
+                        self.failed.append(endpoint)
+                        self._cache.pop(endpoint, None)
+                    else:
+                        self._cache[endpoint] = (time.monotonic(), ips)
+
+        robots = {}
+        for endpoint in self.endpoints:
+            _cached = self._cache.get(endpoint)
+            if _cached is None:
+                continue
+            for ip in _cached[1]:
+                _seenBy = robots.setdefault(ip, [])
+                if not endpoint in _seenBy:
+                    _seenBy.append(endpoint)
+
+        self.timings["discover"] = time.monotonic() - _start
+        self.timings["discover_endpoints"] = _endpointTimes
+        self.timings["discover_cached"] = len(self.endpoints) - len(_expired)
+        return dict(sorted(robots.items()))
+
+    def plan(self, robots):
+        """ Pairs every discovered robot with a distinct endpoint that sees it (the robots seen by fewer endpoints first)
+
+            robots (dict): as returned by discover()
+            Returns a dictionary (host, port) -> IPv4Address, the robots left without an endpoint are not included
+        """
+        assignments = {}
+        for ip, endpoints in sorted(robots.items(), key = lambda item: (len(item[1]), item[0])):
+            for endpoint in endpoints:
+                if not endpoint in assignments:
+                    assignments[endpoint] = ip
+                    break
+        return assignments
+
+    def _assign(self, item):
+        endpoint, ip = item
+        _start = time.monotonic()
+        kvp = KukaVarProxyClient(endpoint[0], endpoint[1], _sockTimeout = self.timeout, _transportProfile = self.transport)
+        if not kvp.setRobotIP(list(robotAddress(ip).packed)):
+            kvp.disconnect()
+            kvp = None
+        return kvp, time.monotonic() - _start
+
+    def assign(self, assignments):
+        """ Opens a client per endpoint and sets its robot IP, in parallel
+
+            assignments (dict): (host, port) -> robot ip (IPv4Address, dotted string or list of 4 bytes)
+            Returns a dictionary (host, port) -> connected KukaVarProxyClient, None where the assignment failed
+        """
+        _start = time.monotonic()
+        _items = [(_endpointKey(endpoint), ip) for endpoint, ip in assignments.items()]
+        clients = {}
+        _endpointTimes = {}
+        if len(_items) > 0:
+            with self._executor(len(_items)) as executor:
+                for (endpoint, ip), (kvp, seconds) in zip(_items, executor.map(self._assign, _items)):
+                    clients[endpoint] = kvp
+                    _endpointTimes["%s:%d"%endpoint] = seconds
+        self.timings["assign"] = time.monotonic() - _start
+        self.timings["assign_endpoints"] = _endpointTimes
+        return clients
+
+    def assignDiscovered(self, refresh = False):
+        """ Discovers, plans and assigns the robots, returns a dictionary (host, port) -> (IPv4Address, client or None) """
+        _start = time.monotonic()
+        assignments = self.plan(self.discover(refresh))
+        clients = self.assign(assignments)
+        self.timings["total"] = time.monotonic() - _start
+        return {endpoint: (ip, clients[endpoint]) for endpoint, ip in assignments.items()}
+
+    def invalidate(self, endpoint = None):
+        """ Drops the cached result of an endpoint (all of them if None) """
+        if endpoint is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(_endpointKey(endpoint), None)
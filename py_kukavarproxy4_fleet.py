@@ -0,0 +1,383 @@
+"""
+    Author: Davide Rosa
+    Description: Polling of a fleet of robots from a single thread.
+
+    Every target is a (host, port, robot_ip) couple: a KUKAVARPROXY server and the robot it has to talk to,
+    set with setRobotIP after the connection. All the connections are non blocking sockets driven by a single
+    selectors event loop, each one with its own state machine (connecting, setting the robot ip, ready, polling).
+    At every poll the variables are requested from all the ready robots with a pipelined burst, the replies are
+    collected as they arrive and the results are returned keyed by robot. A poll waits only for the bursts it
+    started: the connections still connecting or setting the robot ip progress across the polls, within their own
+    timeout, so a robot that doesn't answer doesn't slow down the others.
+
+    i.e.
+        fleet = FleetPoller([FleetTarget("192.168.1.10", 7000, "172.17.255.1", "R1"),
+                             FleetTarget("192.168.1.11", 7000, "172.17.255.1", "R2")],
+                            ["$AXIS_ACT", "$OV_PRO"])
+        for timestamp, results in fleet.samples(period = 0.01, duration = 10.0):
+            print(results["R1"]["$AXIS_ACT"])
+"""
+
+import collections
+import errno
+import selectors
+import socket
+import time
+
+import py_kukavarproxy4_codec as codec
+from py_kukavarproxy4_client import TransportProfile
+
+#robot_ip: list of 4 ip bytes or dotted string, None doesn't call setRobotIP
+#name: the key of the results, None uses "host:port" (followed by "/robot_ip" if given)
+FleetTarget = collections.namedtuple("FleetTarget", ["host", "port", "robot_ip", "name"], defaults = [None, None])
+
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_SETTING_IP = "setting_ip"
+STATE_READY = "ready"
+STATE_POLLING = "polling"
+
+
+def _ipBytes(ip):
+    if isinstance(ip, str):
+        return [int(part) for part in ip.split(".")]
+    return list(ip)
+
+def targetKey(target):
+    """ Returns the key of the results of a target """
+    if not target.name is None:
+        return target.name
+    _key = "%s:%s"%(target.host, target.port)
+    if not target.robot_ip is None:
+        _key += "/" + ".".join(str(part) for part in _ipBytes(target.robot_ip))
+    return _key
+
+
+class _Connection():
+    """ Non blocking connection to a target and its state machine """
+
+    def __init__(self, target, transport, timeout):
+        self.target = target
+        self.key = targetKey(target)
+        self.transport = transport
+        self.timeout = timeout
+        self.sock = None
+        self.state = STATE_DISCONNECTED
+        self.msgID = 0
+        self._tx = bytearray()
+        self._rx = bytearray()
+        self._pending = {} #message id -> index of the variable in the burst, -1 for setRobotIP
+        self.values = None
+        self.remaining = 0
+
+        #statistics
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.timeouts = 0
+        self.polls = 0
+        self._consecutiveFailures = 0
+        self._nextConnectTime = 0.0
+        self._connectDeadline = 0.0 #time.monotonic() limit to get ready after open()
+
+    def _nextMessageID(self):
+        self.msgID = self.msgID + 1
+        if self.msgID==0xffff:
+            self.msgID = 0
+        return self.msgID
+
+    def _queue(self, template, index):
+        _msgID = self._nextMessageID()
+        self._pending[_msgID] = index
+        self._tx += template.stamp(_msgID)
+
+    def events(self):
+        if self.state == STATE_CONNECTING or len(self._tx) > 0:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def open(self, now):
+        """ Starts a non blocking connection, returns False during the reconnection backoff """
+        if now < self._nextConnectTime:
+            return False
+        self.connect_attempts += 1
+        self._connectDeadline = now + self.timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        try:
+            self.transport.apply(self.sock)
+            _error = self.sock.connect_ex((self.target.host, self.target.port))
+        except OSError as e:
+            _error = e.errno
+        if not _error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+            self.close("connect error %s"%_error)
+            return False
+        self.state = STATE_CONNECTING
+        return True
+
+    def connectExpired(self, now):
+        """ Returns True if the connection is connecting or setting the robot ip beyond its timeout """
+        return self.state in (STATE_CONNECTING, STATE_SETTING_IP) and now >= self._connectDeadline
+
+    def close(self, reason = None):
+        """ Closes the socket, the next connection attempt is delayed with the transport profile backoff """
+        if not reason is None:
+            print("FleetPoller - %s %s"%(self.key, reason))
+        if not self.sock is None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        if self.state in (STATE_CONNECTING, STATE_SETTING_IP):
+            self.connect_failures += 1
+            self._consecutiveFailures += 1
+            self._nextConnectTime = time.monotonic() + self.transport.backoffDelay(self._consecutiveFailures)
+        self.state = STATE_DISCONNECTED
+        self._tx.clear()
+        self._rx.clear()
+        self._pending.clear()
+        self.remaining = 0
+
+    def _connected(self):
+        if self.target.robot_ip is None:
+            self._ready()
+            return
+        self.state = STATE_SETTING_IP
+        self._queue(codec.RequestTemplate(codec.KVP_FUNCTION_SETROBOTIP, codec.packSetRobotIPRequest(_ipBytes(self.target.robot_ip))), -1)
+
+    def _ready(self):
+        self.state = STATE_READY
+        self._consecutiveFailures = 0
+        self._nextConnectTime = 0.0
+
+    def startPoll(self, requests):
+        """ Queues the pipelined burst of the prepared read requests, the connection must be ready """
+        self.values = [None] * len(requests)
+        self.remaining = len(requests)
+        for index, template in enumerate(requests):
+            self._queue(template, index)
+        self.state = STATE_POLLING
+
+    def onWritable(self):
+        if self.state == STATE_CONNECTING:
+            _error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if _error != 0:
+                self.close("connect error %s"%_error)
+                return
+            self._connected()
+        if len(self._tx) > 0:
+            try:
+                _n = self.sock.send(self._tx)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.close("send error %s"%e)
+                return
+            del self._tx[:_n]
+
+    def onReadable(self):
+        try:
+            self.transport.applyQuickAck(self.sock)
+            _data = self.sock.recv(codec.KVP_HEADERSIZE + codec.KVP_MAXBODYSIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close("recv error %s"%e)
+            return
+        if len(_data) == 0:
+            self.close("connection closed by the server")
+            return
+        self._rx += _data
+
+        _offset = 0
+        while len(self._rx) - _offset >= codec.KVP_HEADERSIZE:
+            _msgID, _msgSize = codec.unpackHeader(self._rx, _offset)
+            _end = _offset + codec.KVP_HEADERSIZE + _msgSize
+            if _end > len(self._rx):
+                break
+            _body = bytes(self._rx[_offset + codec.KVP_HEADERSIZE:_end])
+            _offset = _end
+            if not self._onReply(_msgID, _body):
+                return
+        del self._rx[:_offset]
+
+    def _onReply(self, msgID, body):
+        """ Returns False if the connection has been closed """
+        index = self._pending.pop(msgID, None)
+        if index is None:
+            self.close("unexpected message id %d"%msgID)
+            return False
+        try:
+            _value, result = codec.unpackReply(codec.KVP_FUNCTION_SETROBOTIP if index < 0 else codec.KVP_FUNCTION_READ, body)
+        except codec.KvpProtocolError as e:
+            self.close(e)
+            return False
+
+        if index < 0:
+            if not result == codec.KVP_RESULTOK:
+                self.close("setRobotIP failed")
+                return False
+            self._ready()
+            return True
+
+        if result == codec.KVP_RESULTOK:
+            self.values[index] = _value
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.polls += 1
+            self.state = STATE_READY
+        return True
+
+    def statistics(self):
+        return {
+            "state": self.state,
+            "connect_attempts": self.connect_attempts,
+            "connect_failures": self.connect_failures,
+            "timeouts": self.timeouts,
+            "polls": self.polls,
+        }
+
+
+class FleetPoller():
+    """ Polls the same variables from many robots with a single thread
+
+        targets (list of FleetTarget or (host, port, robot_ip) tuples)
+        varNames (list of str): the variables polled from every robot
+        timeout (float): seconds to wait for the replies of a poll, the robots that don't reply in time are reconnected
+        transportProfile (TransportProfile): socket options and reconnection backoff of all the connections
+    """
+
+    def __init__(self, targets, varNames, timeout = 3.0, transportProfile = None):
+        self.varNames = list(varNames)
+        self.timeout = timeout
+        self.transport = transportProfile if not transportProfile is None else TransportProfile.lowLatency()
+        self.selector = selectors.DefaultSelector()
+        self.connections = []
+        for target in targets:
+            target = target if isinstance(target, FleetTarget) else FleetTarget(*target)
+            self.connections.append(_Connection(target, self.transport, timeout))
+        if len(set(connection.key for connection in self.connections)) != len(self.connections):
+            raise ValueError("duplicated fleet targets, give them a name")
+        self._requests = [codec.prepareReadRequest(varName) for varName in self.varNames]
+        self._registered = {} #connection -> (socket, events)
+        self.ticks = 0
+        self._running = False
+
+    def _register(self, connection):
+        _current = self._registered.get(connection)
+        if connection.sock is None:
+            if not _current is None:
+                try:
+                    self.selector.unregister(_current[0])
+                except (KeyError, ValueError):
+                    pass
+                del self._registered[connection]
+            return
+        _events = connection.events()
+        if _current is None or not _current[0] is connection.sock:
+            if not _current is None:
+                try:
+                    self.selector.unregister(_current[0])
+                except (KeyError, ValueError):
+                    pass
+            self.selector.register(connection.sock, _events, connection)
+        elif _current[1] != _events:
+            self.selector.modify(connection.sock, _events, connection)
+        self._registered[connection] = (connection.sock, _events)
+
+    def _advance(self, connection, now, polling):
+        """ Moves a connection forward: opens it if disconnected and starts its burst when it gets ready """
+        if connection.connectExpired(now):
+            #a connection or setRobotIP without reply is retried after the backoff
+            connection.timeouts += 1
+            connection.close("connect timeout")
+        if connection.state == STATE_DISCONNECTED:
+            connection.open(now)
+        if polling and connection.state == STATE_READY and not connection in self._polled:
+            self._polled.add(connection)
+            connection.startPoll(self._requests)
+        self._register(connection)
+
+    def poll(self):
+        """ Reads the variables from all the robots
+
+            Returns a dictionary robot key -> {varName: value}, value is bytes or None if the read failed.
+            The robots that are not ready at this poll have all the values None
+        """
+        now = time.monotonic()
+        _deadline = now + self.timeout
+        self.ticks += 1
+        self._polled = set()
+        for connection in self.connections:
+            connection.values = None
+            self._advance(connection, now, True)
+
+        while True:
+            #only the bursts started by this poll are waited for, the other connections progress without blocking
+            _waiting = any(connection.state == STATE_POLLING for connection in self._polled)
+            _remaining = _deadline - time.monotonic()
+            if _remaining <= 0:
+                break
+            _events = self.selector.select(_remaining if _waiting else 0)
+            if not _waiting and len(_events) == 0:
+                break
+            for key, mask in _events:
+                connection = key.data
+                if mask & selectors.EVENT_WRITE:
+                    connection.onWritable()
+                if mask & selectors.EVENT_READ and not connection.sock is None:
+                    connection.onReadable()
+                self._advance(connection, time.monotonic(), True)
+
+        results = {}
+        now = time.monotonic()
+        for connection in self.connections:
+            if connection.state == STATE_POLLING:
+                #the replies still missing would desynchronize the next poll
+                connection.timeouts += 1
+                connection.close("timeout")
+                self._register(connection)
+            elif connection.connectExpired(now):
+                connection.timeouts += 1
+                connection.close("connect timeout")
+                self._register(connection)
+            _values = connection.values if connection in self._polled and not connection.values is None else [None] * len(self.varNames)
+            results[connection.key] = dict(zip(self.varNames, _values))
+        return results
+
+    def samples(self, period, duration = None):
+        """ Generator of (timestamp, results) polled every period seconds with a drift free schedule,
+            stops after duration seconds (None runs until stop())
+        """
+        self._running = True
+        _next = time.monotonic()
+        _end = None if duration is None else _next + duration
+        while self._running and (_end is None or time.monotonic() < _end):
+            _wait = _next - time.monotonic()
+            if _wait > 0:
+                time.sleep(_wait)
+            _timestamp = time.time()
+            yield _timestamp, self.poll()
+            _next += period
+            if _next <= time.monotonic():
+                _next = time.monotonic()
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+            self._register(connection)
+        self.selector.close()
+
+    def statistics(self):
+        """ Returns the connection statistics of every robot """
+        return {connection.key: connection.statistics() for connection in self.connections}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,238 @@
+"""
+    Author: Davide Rosa
+    Description: Instrumentation of KukaVarProxyClient calls.
+
+    The client notifies every call to its instrumentation object. The default Instrumentation does nothing
+    and has enabled = False, so that the client doesn't even take the timings.
+    StatsInstrumentation keeps per function and per variable counters and latency histograms,
+    split in send, wait for header and wait for body times, and calls the optional pre/post hooks.
+
+    i.e.
+        stats = StatsInstrumentation()
+        kvp = KukaVarProxyClient('127.0.0.1', 7000, _instrumentation = stats)
+        ...
+        print(stats.snapshot()["functions"]["readVar"]["total"]["p99_us"])
+"""
+
+import threading
+
+
+class LatencyHistogram():
+    """ HDR style histogram of durations: the values in microseconds are grouped in power of two ranges,
+        each one split in 2**(SUB_BUCKET_BITS-1) linear sub buckets, so the relative error is below 1/2**(SUB_BUCKET_BITS-1).
+        Recording is O(1) and the memory doesn't depend on the number of samples
+    """
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucketIndex(cls, microseconds):
+        _exponent = microseconds.bit_length() - cls.SUB_BUCKET_BITS
+        if _exponent <= 0:
+            return microseconds
+        #the first SUB_BUCKETS values are exact, then SUB_BUCKETS/2 buckets per power of two
+        return (_exponent << (cls.SUB_BUCKET_BITS - 1)) + (microseconds >> _exponent)
+
+    @classmethod
+    def bucketValue(cls, index):
+        """ Returns the highest value in microseconds of the bucket """
+        if index < cls.SUB_BUCKETS:
+            return index
+        _half = cls.SUB_BUCKETS >> 1
+        _exponent = (index >> (cls.SUB_BUCKET_BITS - 1)) - 1
+        _mantissa = (index & (_half - 1)) + _half
+        return ((_mantissa + 1) << _exponent) - 1
+
+    def record(self, seconds):
+        _microseconds = int(seconds * 1e6)
+        if _microseconds < 0:
+            _microseconds = 0
+        _index = self.bucketIndex(_microseconds)
+        self.counts[_index] = self.counts.get(_index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for _index, _count in other.counts.items():
+            self.counts[_index] = self.counts.get(_index, 0) + _count
+        self.count += other.count
+        self.total += other.total
+        if not other.min is None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if not other.max is None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, fraction):
+        """ Returns the duration in microseconds below which the given fraction (0.0 - 1.0) of the samples falls """
+        if self.count == 0:
+            return None
+        _threshold = fraction * self.count
+        _cumulative = 0
+        for _index in sorted(self.counts):
+            _cumulative += self.counts[_index]
+            if _cumulative >= _threshold:
+                return min(self.bucketValue(_index), self.max * 1e6)
+        return self.max * 1e6
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6,
+            "min_us": self.min * 1e6,
+            "p50_us": self.percentile(0.5),
+            "p90_us": self.percentile(0.9),
+            "p99_us": self.percentile(0.99),
+            "p999_us": self.percentile(0.999),
+            "max_us": self.max * 1e6,
+        }
+
+
+class Instrumentation():
+    """ No-op instrumentation, base class of the instrumentations.
+        When enabled is False the client skips the timings and doesn't call the methods
+    """
+    enabled = False
+
+    def onRequest(self, funcName, varName):
+        """ Called before sending a request """
+        pass
+
+    def onReply(self, funcName, varName, success, bytesSent, bytesReceived, sendTime, headerTime, bodyTime):
+        """ Called after a request is completed, with the sizes in bytes and the durations in seconds of:
+            sendTime: sending the request
+            headerTime: waiting for the reply header
+            bodyTime: receiving the reply body
+        """
+        pass
+
+    def onError(self, funcName, varName, error):
+        """ Called on exceptions and malformed replies """
+        pass
+
+    def onConnect(self, success, reconnect):
+        """ Called after every connection attempt """
+        pass
+
+
+class CallStats():
+    """ Counters and latency histograms of a function or of a variable """
+    __slots__ = ("calls", "failures", "errors", "bytes_sent", "bytes_received", "send", "header", "body", "total")
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send = LatencyHistogram()
+        self.header = LatencyHistogram()
+        self.body = LatencyHistogram()
+        self.total = LatencyHistogram()
+
+    def record(self, success, bytesSent, bytesReceived, sendTime, headerTime, bodyTime):
+        self.calls += 1
+        if not success:
+            self.failures += 1
+        self.bytes_sent += bytesSent
+        self.bytes_received += bytesReceived
+        self.send.record(sendTime)
+        self.header.record(headerTime)
+        self.body.record(bodyTime)
+        self.total.record(sendTime + headerTime + bodyTime)
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "send": self.send.summary(),
+            "header": self.header.summary(),
+            "body": self.body.summary(),
+            "total": self.total.summary(),
+        }
+
+
+class StatsInstrumentation(Instrumentation):
+    """ Collects per function and per variable statistics, thread safe.
+
+        perVariable (bool): also collects the statistics per variable name
+        preHooks (list): callables f(funcName, varName) called before every request
+        postHooks (list): callables f(funcName, varName, success, totalTime) called after every request
+    """
+    enabled = True
+
+    def __init__(self, perVariable = True, preHooks = None, postHooks = None):
+        self.perVariable = perVariable
+        self.preHooks = list(preHooks or [])
+        self.postHooks = list(postHooks or [])
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.functions = {}
+            self.variables = {}
+            self.connects = 0
+            self.connect_failures = 0
+            self.reconnects = 0
+
+    def _stats(self, table, key):
+        _stats = table.get(key)
+        if _stats is None:
+            _stats = table[key] = CallStats()
+        return _stats
+
+    def onRequest(self, funcName, varName):
+        for hook in self.preHooks:
+            hook(funcName, varName)
+
+    def onReply(self, funcName, varName, success, bytesSent, bytesReceived, sendTime, headerTime, bodyTime):
+        with self._lock:
+            self._stats(self.functions, funcName).record(success, bytesSent, bytesReceived, sendTime, headerTime, bodyTime)
+            if self.perVariable and not varName is None:
+                self._stats(self.variables, varName).record(success, bytesSent, bytesReceived, sendTime, headerTime, bodyTime)
+        for hook in self.postHooks:
+            hook(funcName, varName, success, sendTime + headerTime + bodyTime)
+
+    def onError(self, funcName, varName, error):
+        with self._lock:
+            self._stats(self.functions, funcName).errors += 1
+            if self.perVariable and not varName is None:
+                self._stats(self.variables, varName).errors += 1
+
+    def onConnect(self, success, reconnect):
+        with self._lock:
+            if not success:
+                self.connect_failures += 1
+            else:
+                self.connects += 1
+                if reconnect:
+                    self.reconnects += 1
+
+    def snapshot(self):
+        """ Returns a dictionary with all the statistics """
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "connect_failures": self.connect_failures,
+                "reconnects": self.reconnects,
+                "functions": {name: stats.summary() for name, stats in self.functions.items()},
+                "variables": {name: stats.summary() for name, stats in self.variables.items()},
+            }
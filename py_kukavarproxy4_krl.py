@@ -0,0 +1,395 @@
+"""
+    Author: Davide Rosa
+    Description: Parser for the KRL literals returned by KUKAVARPROXY
+                 i.e. {E6AXIS: A1 0.0, A2 -90.0, A3 90.0, A4 0.0, A5 0.0, A6 0.0, E1 0.0, E2 0.0, E3 0.0, E4 0.0, E5 0.0, E6 0.0}
+
+    The generic parser scans the text once with a regular expression tokenizer, nested structures
+    are parsed in place without copying the rest of the string.
+    For every struct type (E6AXIS, E6POS, FRAME, ...) met the first time, a schema with the fields order
+    and kinds is compiled and cached, the next values of the same type are parsed with a single regex match.
+
+    The serializer (formatKrl) works the other way: for every struct type and fields order a format string with
+    fixed precision numbers is compiled and cached (StructTemplate), a value is formatted with a single % operation.
+    formatMany formats a whole trajectory (i.e. a NumPy array of setpoints) in one pass.
+"""
+
+import re
+
+#token kinds
+_TOKEN_OPEN = 1
+_TOKEN_CLOSE = 2
+_TOKEN_COMMA = 3
+_TOKEN_COLON = 4
+_TOKEN_STRING = 5
+_TOKEN_WORD = 6
+
+_tokenizer = re.compile(r'\s*(?:(\{)|(\})|(,)|(:)|("[^"]*")|([^\s{},:"]+))')
+
+#field kinds of a schema
+KIND_NUMBER = "number"
+KIND_BOOL = "bool"
+KIND_ENUM = "enum"
+KIND_STRING = "string"
+#serializer only kinds
+KIND_INT = "int"
+KIND_STRUCT = "struct"
+
+#decimals of the numbers written by the serializer
+DEFAULT_PRECISION = 4
+
+#INT fields of the standard types, parsed as numbers (float) but written as integers
+_INT_FIELDS = {
+    "POS": ("S", "T"),
+    "E6POS": ("S", "T"),
+}
+
+_KIND_PATTERNS = {
+    KIND_NUMBER: r'([^\s,{}"]+)',
+    KIND_BOOL: r'([^\s,{}"]+)',
+    KIND_ENUM: r'([^\s,{}"]+)',
+    KIND_STRING: r'"([^"]*)"',
+}
+
+_typeName = re.compile(r'\s*\{\s*([^\s{},:"]+)\s*:')
+
+#struct type name -> _Schema
+_schemas = {}
+
+#(struct type name, field names, field kinds, precision) -> StructTemplate
+_templates = {}
+
+
+class KrlParseError(ValueError):
+    pass
+
+
+def _parseBool(token):
+    _upper = token.upper()
+    if _upper == "TRUE":
+        return True
+    if _upper == "FALSE":
+        return False
+    raise ValueError(token)
+
+def _parseEnum(token):
+    #the kind of a field is the one of the first value seen, an enum field can hold other values
+    #(i.e. a number) and they are parsed like without a schema
+    if token.startswith("#"):
+        return token
+    return parseScalar(token)[0]
+
+_KIND_CONVERTERS = {
+    KIND_NUMBER: float,
+    KIND_BOOL: _parseBool,
+    KIND_ENUM: _parseEnum,
+    KIND_STRING: str,
+}
+
+
+def parseScalar(token):
+    """ Returns (value, kind) of a KRL scalar token.
+        Numbers are returned as float, booleans as bool, strings without quotes,
+        enums (#T1) and the other identifiers as str
+    """
+    if token.startswith('"'):
+        return token[1:-1], KIND_STRING
+    try:
+        return float(token), KIND_NUMBER
+    except ValueError:
+        pass
+    _upper = token.upper()
+    if _upper == "TRUE":
+        return True, KIND_BOOL
+    if _upper == "FALSE":
+        return False, KIND_BOOL
+    return token, KIND_ENUM
+
+
+class _Schema():
+    """ Compiled layout of a flat struct type """
+    __slots__ = ("typeName", "fieldNames", "kinds", "regex", "allNumbers", "converters")
+
+    def __init__(self, typeName, fields):
+        self.typeName = typeName
+        self.fieldNames = tuple(name for name, kind in fields)
+        self.kinds = tuple(kind for name, kind in fields)
+        self.allNumbers = all(kind == KIND_NUMBER for kind in self.kinds)
+        self.converters = tuple(_KIND_CONVERTERS[kind] for kind in self.kinds)
+        _fieldPatterns = [r'\s*%s\s+%s\s*'%(re.escape(name), _KIND_PATTERNS[kind]) for name, kind in fields]
+        self.regex = re.compile(r'\s*\{\s*%s\s*:%s\}\s*'%(re.escape(typeName), ','.join(_fieldPatterns)))
+
+    def parse(self, text):
+        """ Returns the dictionary of the values or None if text doesn't fit the schema """
+        _match = self.regex.fullmatch(text)
+        if _match is None:
+            return None
+        try:
+            if self.allNumbers:
+                return dict(zip(self.fieldNames, map(float, _match.groups())))
+            return {name: convert(value) for name, convert, value in zip(self.fieldNames, self.converters, _match.groups())}
+        except ValueError:
+            return None
+
+
+class _Parser():
+    """ Recursive descent parser on the token stream, the position is an index in the text """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.length = len(text)
+
+    def next(self):
+        """ Returns (kind, token) or (None, None) at the end of the text """
+        _match = _tokenizer.match(self.text, self.pos)
+        if _match is None:
+            if self.text[self.pos:].strip():
+                raise KrlParseError("unexpected character at %d"%self.pos)
+            self.pos = self.length
+            return None, None
+        self.pos = _match.end()
+        kind = _match.lastindex
+        return kind, _match.group(kind)
+
+    def peek(self):
+        _pos = self.pos
+        kind, token = self.next()
+        self.pos = _pos
+        return kind, token
+
+    def parseStruct(self, opened):
+        """ Parses the struct fields up to the closing brace (or the end of the text if not opened).
+            Returns (typeName, dictionary, flatFields) where flatFields is the list of (name, kind)
+            or None if the struct contains nested structs
+        """
+        typeName = None
+        resultDict = {}
+        flatFields = []
+
+        kind, token = self.next()
+        _kind2, _token2 = self.peek()
+        if kind == _TOKEN_WORD and _kind2 == _TOKEN_COLON:
+            typeName = token
+            self.next()
+            kind, token = self.next()
+
+        while True:
+            if kind is None:
+                if opened:
+                    raise KrlParseError("missing closing brace")
+                break
+            if kind == _TOKEN_CLOSE:
+                if not opened:
+                    raise KrlParseError("unexpected closing brace at %d"%self.pos)
+                break
+            if kind == _TOKEN_COMMA:
+                #empty field
+                kind, token = self.next()
+                continue
+            if not kind == _TOKEN_WORD:
+                raise KrlParseError("field name expected at %d"%self.pos)
+
+            fieldName = token
+            kind, token = self.next()
+            if kind == _TOKEN_OPEN:
+                _subType, resultDict[fieldName], _subFields = self.parseStruct(True)
+                flatFields = None
+                kind, token = self.next()
+            elif kind in (_TOKEN_WORD, _TOKEN_STRING):
+                resultDict[fieldName], _fieldKind = parseScalar(token)
+                if not flatFields is None:
+                    flatFields.append((fieldName, _fieldKind))
+                kind, token = self.next()
+            else:
+                #field without value
+                flatFields = None
+
+            if kind == _TOKEN_COMMA:
+                kind, token = self.next()
+            elif not kind in (_TOKEN_CLOSE, None):
+                raise KrlParseError("comma expected at %d"%self.pos)
+
+        return typeName, resultDict, flatFields
+
+
+def _decode(text):
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        return bytes(text).decode("utf-8", "replace")
+    return text
+
+def krlTypeName(text):
+    """ Returns the struct type name of a KRL struct literal or None """
+    _match = _typeName.match(_decode(text))
+    if _match is None:
+        return None
+    return _match.group(1)
+
+def parseKrl(text):
+    """ Parses a KRL literal, value can be str or bytes (as returned by readVar)
+
+        Returns a dictionary for structs (nested structs are nested dictionaries)
+        or the scalar value (see parseScalar)
+    """
+    text = _decode(text)
+
+    #fast path for the already known struct types
+    _match = _typeName.match(text)
+    if not _match is None:
+        _schema = _schemas.get(_match.group(1))
+        if not _schema is None:
+            resultDict = _schema.parse(text)
+            if not resultDict is None:
+                return resultDict
+
+    parser = _Parser(text)
+    kind, token = parser.next()
+    if kind == _TOKEN_OPEN:
+        typeName, resultDict, flatFields = parser.parseStruct(True)
+        if not parser.next()[0] is None:
+            raise KrlParseError("unexpected text after the struct")
+        if not typeName is None and flatFields and len(flatFields) == len(resultDict):
+            _schemas[typeName] = _Schema(typeName, flatFields)
+        return resultDict
+    if kind in (_TOKEN_WORD, _TOKEN_STRING) and parser.next()[0] is None:
+        return parseScalar(token)[0]
+    raise KrlParseError("invalid KRL literal")
+
+def parseStructBody(text):
+    """ Parses the content of a struct without the external braces
+        i.e. E6AXIS: A1 0.0, A2 -90.0, ...
+
+        Returns a dictionary
+    """
+    #wrapped so that the cached schemas are used
+    return parseKrl('{' + _decode(text) + '}')
+
+def clearSchemaCache():
+    _schemas.clear()
+    _templates.clear()
+
+
+""" Serializer """
+
+def _formatBool(value):
+    return "TRUE" if value else "FALSE"
+
+def valueKind(value):
+    """ Returns the serializer kind of a Python value """
+    if isinstance(value, bool):
+        return KIND_BOOL
+    if isinstance(value, int):
+        return KIND_INT
+    if isinstance(value, float):
+        return KIND_NUMBER
+    if isinstance(value, str):
+        return KIND_ENUM if value.startswith("#") else KIND_STRING
+    if isinstance(value, dict) or hasattr(value, "asTuple"):
+        return KIND_STRUCT
+    try:
+        float(value) #i.e. NumPy scalars
+        return KIND_NUMBER
+    except (TypeError, ValueError):
+        raise KrlParseError("can't format %r as KRL"%(value,))
+
+
+class StructTemplate():
+    """ Compiled format of a struct type: the field names, the separators and the fixed precision
+        number formats are joined once in a format string
+
+        typeName (str): the struct type name, None writes the struct without it (valid for nested structs)
+        fieldNames (tuple): the fields in the order to be written
+        kinds (tuple): the KIND_* of every field
+        precision (int): decimals of the KIND_NUMBER fields
+    """
+    __slots__ = ("typeName", "fieldNames", "kinds", "precision", "formatString", "converters", "simple")
+
+    def __init__(self, typeName, fieldNames, kinds, precision = DEFAULT_PRECISION):
+        self.typeName = typeName
+        self.fieldNames = tuple(fieldNames)
+        self.kinds = tuple(kinds)
+        self.precision = precision
+        _formats = {
+            KIND_NUMBER: "%%.%df"%precision,
+            KIND_INT: "%d",
+            KIND_BOOL: "%s",
+            KIND_ENUM: "%s",
+            KIND_STRING: '"%s"',
+            KIND_STRUCT: "%s",
+        }
+        _fields = ", ".join("%s %s"%(name, _formats[kind]) for name, kind in zip(self.fieldNames, self.kinds))
+        self.formatString = ("{%s: "%typeName if typeName else "{") + _fields + "}"
+        self.converters = tuple(_formatBool if kind == KIND_BOOL else
+                                (lambda value, precision = precision: formatKrl(value, None, precision)) if kind == KIND_STRUCT else None
+                                for kind in self.kinds)
+        self.simple = all(converter is None for converter in self.converters)
+
+    def format(self, values):
+        """ values (dict, KrlRecord or sequence in the fields order)
+            Returns the KRL literal
+        """
+        if isinstance(values, dict):
+            values = [values[name] for name in self.fieldNames]
+        elif hasattr(values, "asTuple"):
+            values = values.asTuple()
+        if not self.simple:
+            values = [value if converter is None else converter(value) for converter, value in zip(self.converters, values)]
+        return self.formatString % tuple(values)
+
+    def formatMany(self, rows):
+        """ Formats many values in one pass
+
+            rows: NumPy 2D array (one row per value, the columns in the fields order), NumPy structured array
+                (the fields are selected by name, i.e. a SampleBatch array) or sequence of values
+            Returns the list of KRL literals
+        """
+        if not getattr(rows, "dtype", None) is None:
+            if not rows.dtype.names is None:
+                rows = rows[list(self.fieldNames)]
+            #tolist converts all the numbers to Python objects at C speed
+            rows = rows.tolist()
+        if self.simple:
+            _format = self.formatString
+            return [_format % tuple(row) for row in rows]
+        return [self.format(row) for row in rows]
+
+
+def structTemplate(typeName, fieldNames, kinds = None, precision = DEFAULT_PRECISION):
+    """ Returns the cached StructTemplate of a struct type and fields order.
+        kinds defaults to KIND_NUMBER for all the fields (KIND_INT for the standard INT fields, i.e. E6POS S and T)
+    """
+    fieldNames = tuple(fieldNames)
+    if kinds is None:
+        _intFields = _INT_FIELDS.get(typeName, ())
+        kinds = [KIND_INT if name in _intFields else KIND_NUMBER for name in fieldNames]
+    key = (typeName, fieldNames, tuple(kinds), precision)
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = StructTemplate(typeName, fieldNames, kinds, precision)
+    return template
+
+def formatKrl(value, typeName = None, precision = DEFAULT_PRECISION):
+    """ Returns the KRL literal of a value
+
+        value: dict (struct, nested dicts are nested structs), KrlRecord, bool, int, float,
+            enum (str starting with #) or str (written as a quoted string)
+        typeName (str): the struct type name of a dict, i.e. E6POS
+        precision (int): decimals of the numbers
+    """
+    if isinstance(value, dict):
+        #the kinds are part of the template key: a field given once as int and once as float gets two templates
+        _intFields = _INT_FIELDS.get(typeName, ())
+        kinds = tuple(KIND_INT if name in _intFields else valueKind(fieldValue) for name, fieldValue in value.items())
+        return structTemplate(typeName, value, kinds, precision).format(value)
+    if hasattr(value, "asTuple"): #KrlRecord
+        return value.encode(precision)
+
+    kind = valueKind(value)
+    if kind == KIND_NUMBER:
+        return "%.*f"%(precision, value)
+    if kind == KIND_INT:
+        return "%d"%value
+    if kind == KIND_BOOL:
+        return _formatBool(value)
+    if kind == KIND_STRING:
+        return '"%s"'%value
+    return value
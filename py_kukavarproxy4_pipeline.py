@@ -0,0 +1,379 @@
+"""
+    Author: Davide Rosa
+    Description: Acquisition pipeline decoupling the robot reads from slow consumers.
+
+    The samples flow through three kinds of stages, each one in its own thread:
+    - the reader polls the subscribed variables (SubscriptionEngine) and only queues the raw values
+    - the decoder decodes the values, in its thread or in a pool of worker processes, and hands them to every consumer
+    - the consumers (visualization, database, ...) receive the decoded samples, one by one or in batches
+    The stages are connected by bounded ring buffers, every buffer has its own overflow policy:
+    - POLICY_DROP_OLDEST: the oldest item is discarded to make room, the producer never waits
+    - POLICY_BLOCK: the producer waits for room (backpressure up to the reader, use it only where losing samples is worse)
+    - POLICY_LATEST: only the last item is kept, i.e. a robot simulator that only needs the current position
+    Every consumer has its own buffer: a stalled consumer loses its own samples, the others and the reader go on.
+
+    i.e.
+        pipeline = AcquisitionPipeline(kvp)
+        pipeline.subscribe("$AXIS_ACT", 0.004, decode = E6AXIS.decode)
+        pipeline.addConsumer("robodk", lambda sample: rdk_robot.MoveJ(list(sample.value)[:6]), policy = POLICY_LATEST)
+        pipeline.addConsumer("database", db.insertMany, capacity = 100000, batchSize = 500)
+        pipeline.start()
+        ...
+        pipeline.stop()
+        print(pipeline.statistics())
+"""
+
+import collections
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from py_kukavarproxy4_subscription import SubscriptionEngine
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_BLOCK = "block"
+POLICY_LATEST = "latest"
+
+_POLICIES = (POLICY_DROP_OLDEST, POLICY_BLOCK, POLICY_LATEST)
+
+
+def _decodeBatch(decode, values):
+    """ Decodes a list of raw values, runs in the worker processes """
+    results = []
+    for value in values:
+        try:
+            results.append((True, decode(value)))
+        except Exception as e:
+            results.append((False, repr(e)))
+    return results
+
+
+class RingBuffer():
+    """ Bounded thread safe queue with an overflow policy
+
+        capacity (int): maximum number of items, POLICY_LATEST always keeps 1
+        policy (str): POLICY_DROP_OLDEST, POLICY_BLOCK or POLICY_LATEST
+    """
+
+    def __init__(self, capacity = 1024, policy = POLICY_DROP_OLDEST):
+        if not policy in _POLICIES:
+            raise ValueError("unknown overflow policy %s"%policy)
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.policy = policy
+        self.capacity = 1 if policy == POLICY_LATEST else capacity
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        #statistics
+        self.put_count = 0
+        self.dropped = 0
+        self.blocked_time = 0.0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """ Queues an item, returns False if the buffer is closed """
+        with self._condition:
+            if self.policy == POLICY_BLOCK and len(self._items) >= self.capacity:
+                _start = time.monotonic()
+                while len(self._items) >= self.capacity and not self._closed:
+                    self._condition.wait()
+                self.blocked_time += time.monotonic() - _start
+            if self._closed:
+                return False
+            if len(self._items) >= self.capacity:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self.put_count += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._condition.notify_all()
+            return True
+
+    def get(self, maxItems = 1, timeout = None):
+        """ Returns the list of up to maxItems items, waits for at least one.
+            Returns an empty list on timeout, None when the buffer is closed and empty
+        """
+        with self._condition:
+            if len(self._items) == 0:
+                if self._closed:
+                    return None
+                self._condition.wait_for(lambda: len(self._items) > 0 or self._closed, timeout)
+                if len(self._items) == 0:
+                    return None if self._closed else []
+            items = [self._items.popleft() for i in range(min(maxItems, len(self._items)))]
+            self._condition.notify_all()
+            return items
+
+    def close(self):
+        """ Wakes up the waiting threads, the items already queued can still be read """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def statistics(self):
+        return {
+            "policy": self.policy,
+            "capacity": self.capacity,
+            "backlog": len(self._items),
+            "high_water": self.high_water,
+            "put": self.put_count,
+            "dropped": self.dropped,
+            "blocked_time": self.blocked_time,
+        }
+
+
+class _Stage():
+    """ A thread consuming the items of an input buffer, with the throughput statistics """
+
+    def __init__(self, name, inputBuffer = None, batchSize = 1):
+        self.name = name
+        self.input = inputBuffer
+        self.batchSize = batchSize
+        self._thread = None
+
+        #statistics
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self._startTime = None
+        self._stopTime = None
+
+    def start(self):
+        self._startTime = time.monotonic()
+        self._stopTime = None
+        self._thread = threading.Thread(target = self._run, name = "pipeline-%s"%self.name, daemon = True)
+        self._thread.start()
+
+    def join(self, timeout = None):
+        if not self._thread is None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        try:
+            while True:
+                items = self.input.get(self.batchSize)
+                if items is None:
+                    return
+                _start = time.monotonic()
+                try:
+                    self.process(items)
+                except Exception:
+                    self.errors += len(items)
+                    traceback.print_exc()
+                self.busy_time += time.monotonic() - _start
+                self.processed += len(items)
+        finally:
+            self._stopTime = time.monotonic()
+            self.finished()
+
+    def process(self, items):
+        raise NotImplementedError()
+
+    def finished(self):
+        pass
+
+    def statistics(self):
+        """ Returns the counters, the throughput (items/s) and the busy fraction of the stage """
+        _elapsed = None
+        if not self._startTime is None:
+            _elapsed = (time.monotonic() if self._stopTime is None else self._stopTime) - self._startTime
+        _statistics = {
+            "processed": self.processed,
+            "errors": self.errors,
+            "throughput": self.processed / _elapsed if _elapsed else None,
+            "busy": self.busy_time / _elapsed if _elapsed else None,
+        }
+        if not self.input is None:
+            _statistics["input"] = self.input.statistics()
+        return _statistics
+
+
+class _Consumer(_Stage):
+
+    def __init__(self, name, callback, inputBuffer, batchSize):
+        _Stage.__init__(self, name, inputBuffer, batchSize)
+        self.callback = callback
+
+    def process(self, samples):
+        if self.batchSize > 1:
+            self.callback(samples)
+        else:
+            self.callback(samples[0])
+
+
+class _Decoder(_Stage):
+
+    def __init__(self, pipeline, inputBuffer, batchSize, workers):
+        _Stage.__init__(self, "decoder", inputBuffer, batchSize)
+        self.pipeline = pipeline
+        self.workers = workers
+        self._executor = None
+        self._reported = set() #names of the variables whose decode failure has been printed
+
+    def start(self):
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(self.workers)
+        _Stage.start(self)
+
+    def finished(self):
+        if not self._executor is None:
+            self._executor.shutdown()
+            self._executor = None
+        for consumer in self.pipeline.consumers.values():
+            consumer.input.close()
+
+    def process(self, samples):
+        _decoders = self.pipeline.decoders
+        if self._executor is None:
+            _decoded = []
+            for sample in samples:
+                decode = _decoders.get(sample.name)
+                if decode is None:
+                    _decoded.append(sample)
+                    continue
+                try:
+                    _decoded.append(sample._replace(value = decode(sample.value)))
+                except Exception as e:
+                    self._decodeFailed(sample.name, e)
+        else:
+            #one task per decode function, the samples keep their order
+            _groups = collections.OrderedDict()
+            for index, sample in enumerate(samples):
+                _groups.setdefault(_decoders.get(sample.name), []).append(index)
+            _decoded = list(samples)
+            _futures = [(indexes, self._executor.submit(_decodeBatch, decode, [samples[index].value for index in indexes]))
+                        for decode, indexes in _groups.items() if not decode is None]
+            for indexes, future in _futures:
+                for index, (success, value) in zip(indexes, future.result()):
+                    if success:
+                        _decoded[index] = samples[index]._replace(value = value)
+                    else:
+                        self._decodeFailed(samples[index].name, value)
+                        _decoded[index] = None
+            _decoded = [sample for sample in _decoded if not sample is None]
+
+        for consumer in self.pipeline.consumers.values():
+            for sample in _decoded:
+                consumer.input.put(sample)
+
+    def _decodeFailed(self, name, error):
+        self.errors += 1
+        if not name in self._reported:
+            #only the first failure of a variable, the next ones are counted in errors
+            self._reported.add(name)
+            print("AcquisitionPipeline - decoding %s: %s"%(name, error))
+
+
+class AcquisitionPipeline():
+    """ Reader, decoder and consumers stages connected by ring buffers
+
+        client (KukaVarProxyClient): the client used by the reader
+        capacity (int): size of the buffer between the reader and the decoder
+        policy (str): overflow policy of the buffer between the reader and the decoder
+        decodeBatch (int): maximum number of samples decoded at once
+        decodeWorkers (int): 0 decodes in the decoder thread, > 0 in a pool of processes
+            (the decode functions must be picklable, i.e. krl.parseKrl or E6AXIS.decode)
+    """
+
+    def __init__(self, client, capacity = 4096, policy = POLICY_DROP_OLDEST, decodeBatch = 64, decodeWorkers = 0, groupWindow = 0.0005):
+        self.engine = SubscriptionEngine(client, groupWindow)
+        self.decoders = {}
+        self.consumers = collections.OrderedDict()
+        self._decodeBuffer = RingBuffer(capacity, policy)
+        self._decoder = _Decoder(self, self._decodeBuffer, decodeBatch, decodeWorkers)
+        self._stopped = False
+        self._reader = None
+        self._stopping = threading.Event()
+        self.running = False
+
+    def subscribe(self, varName, period, decode = None, onlyChanges = False, deadband = None):
+        """ Subscribes a variable (see SubscriptionEngine.subscribe), the value is decoded by the decoder stage.
+            With onlyChanges or deadband the value is compared (and decoded) by the reader
+        """
+        if onlyChanges or not deadband is None:
+            self.decoders.pop(varName, None)
+            return self.engine.subscribe(varName, period, decode, onlyChanges, deadband)
+        if decode is None:
+            self.decoders.pop(varName, None)
+        else:
+            self.decoders[varName] = decode
+        return self.engine.subscribe(varName, period)
+
+    def addConsumer(self, name, callback, capacity = 1024, policy = POLICY_DROP_OLDEST, batchSize = 1):
+        """ Adds a consumer stage, before start()
+
+            callback (callable): f(sample), or f(list of samples) if batchSize > 1
+            capacity, policy: the buffer of the consumer
+            batchSize (int): maximum number of samples given at once
+        """
+        if self.running:
+            raise RuntimeError("the consumers must be added before start()")
+        self.consumers[name] = _Consumer(name, callback, RingBuffer(capacity, policy), batchSize)
+
+    def _read(self):
+        try:
+            while not self._stopping.is_set():
+                if self.engine.nextDueTime() is None:
+                    self._stopping.wait(0.01)
+                    continue
+                for sample in self.engine.poll():
+                    self._decodeBuffer.put(sample)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._decodeBuffer.close()
+
+    def start(self):
+        """ Starts all the stages in background threads, a stopped pipeline can be started again """
+        if self.running:
+            return self
+        if self._stopped:
+            #the buffers of the previous run are closed
+            self._decodeBuffer = RingBuffer(self._decodeBuffer.capacity, self._decodeBuffer.policy)
+            self._decoder = _Decoder(self, self._decodeBuffer, self._decoder.batchSize, self._decoder.workers)
+            for consumer in self.consumers.values():
+                consumer.input = RingBuffer(consumer.input.capacity, consumer.input.policy)
+            self._stopped = False
+        self.running = True
+        self._stopping.clear()
+        for consumer in self.consumers.values():
+            consumer.start()
+        self._decoder.start()
+        self._reader = threading.Thread(target = self._read, name = "pipeline-reader", daemon = True)
+        self._reader.start()
+        return self
+
+    def stop(self):
+        """ Stops reading, the samples already queued are delivered to the consumers before returning """
+        if not self.running:
+            return
+        self._stopping.set()
+        self._reader.join()
+        self._reader = None
+        self._decoder.join()
+        for consumer in self.consumers.values():
+            consumer.join()
+        self._stopped = True
+        self.running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def statistics(self):
+        """ Returns the statistics of every stage: the reader (per subscription), the decoder and the consumers """
+        return {
+            "reader": self.engine.statistics(),
+            "decoder": self._decoder.statistics(),
+            "consumers": {name: consumer.statistics() for name, consumer in self.consumers.items()},
+        }
@@ -0,0 +1,392 @@
+"""
+    Author: Davide Rosa
+    Description: Coalescing multiplexing proxy in front of KUKAVARPROXY.
+
+    The proxy speaks the KUKAVARPROXY protocol on its listening side, so the existing clients connect to it
+    unchanged, and forwards the requests to the real server over a small pool of upstream connections.
+    - identical READ (and READARRAY, DISCOVER) requests in flight at the same time are sent upstream once,
+      all the clients waiting for them get the same reply
+    - with a freshness window, a value read less than freshness seconds ago is served without going upstream
+    - the replies are sent back with the message ID of the client request (the upstream IDs are not the client ones)
+    - WRITE and WRITEARRAY are always forwarded, and drop the cached values of the variable
+    - the order of every client is kept: its writes go pipelined over one upstream connection, its reads wait for
+      its previous writes (and don't join reads started before them), SETROBOTIP waits for all its previous requests
+    - the robot IP belongs to the client connection, like on the real server: every robot IP set by the clients
+      gets its own pool of upstream connections, the IP is sent on every (re)connection of the pool before any
+      other request, and the requests are merged and cached only between the clients of the same robot
+
+    i.e.
+        python py_kukavarproxy4_proxy.py --upstream-host 192.168.1.10 --upstream-port 7000 --port 7000 --freshness 0.004
+
+    or embedded:
+        proxy = CoalescingProxy("192.168.1.10", 7000, port = 7001, freshness = 0.004)
+        proxy.start()
+        kvp = KukaVarProxyClient(*proxy.address)
+"""
+
+import argparse
+import asyncio
+import itertools
+import threading
+import time
+import traceback
+
+import py_kukavarproxy4_codec as codec
+from py_kukavarproxy4_async_client import AsyncKukaVarProxyClient
+from py_kukavarproxy4_cache import baseName
+from py_kukavarproxy4_client import TransportProfile
+
+#functions whose identical requests can share the same reply
+_COALESCED = (codec.KVP_FUNCTION_READ, codec.KVP_FUNCTION_READARRAY, codec.KVP_FUNCTION_DISCOVER)
+
+
+def failureBody(kvp_func):
+    """ Returns the reply body (function byte included) of a failed request """
+    if kvp_func == codec.KVP_FUNCTION_READARRAY:
+        _data = codec.packReadArrayReply((), codec.KVP_RESULTFAIL)
+    elif kvp_func == codec.KVP_FUNCTION_DISCOVER:
+        _data = codec.packDiscoverReply([], codec.KVP_RESULTFAIL)
+    elif kvp_func == codec.KVP_FUNCTION_SETROBOTIP:
+        _data = codec.packSetRobotIPReply(codec.KVP_RESULTFAIL)
+    else:
+        _data = codec.packValueReply(b"", codec.KVP_RESULTFAIL)
+    return bytes((kvp_func,)) + _data
+
+
+class CoalescingProxy():
+    """ KUKAVARPROXY proxy merging the identical concurrent reads of its clients
+
+        upstreamHost, upstreamPort: the real KUKAVARPROXY server
+        host, port: the listening address, port 0 picks a free port (see address)
+        poolSize (int): number of upstream connections per robot IP, the requests are spread round robin
+        freshness (float): seconds a reply can be served again to other requests, 0 only merges the requests in flight
+        sockTimeout (float): seconds to wait for an upstream reply
+        transportProfile (TransportProfile): socket options of the upstream connections
+    """
+
+    def __init__(self, upstreamHost, upstreamPort, host = "127.0.0.1", port = 7000, poolSize = 2, freshness = 0.0, sockTimeout = 3.0, transportProfile = None):
+        self.upstreamHost = upstreamHost
+        self.upstreamPort = upstreamPort
+        self.host = host
+        self.port = port
+        self.poolSize = max(1, poolSize)
+        self.freshness = freshness
+        self.sockTimeout = sockTimeout
+        self.transport = transportProfile if not transportProfile is None else TransportProfile.lowLatency()
+
+        self._pools = {} #SETROBOTIP request data (None for the clients that never set it) -> _UpstreamPool
+        self._inFlight = {} #(robot IP, function, request data) -> future of the reply body
+        self._fresh = {} #(robot IP, function, request data) -> (monotonic time, reply body)
+        self._freshByName = {} #(robot IP, BASE NAME) -> set of keys
+        self._generation = 0 #incremented by every write
+        self._server = None
+        self._writers = set() #the client connections, closed by stop()
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+        self._startError = None #the exception that stopped serve() from listening
+
+        #statistics
+        self.clients = 0
+        self.requests = 0
+        self.upstream_requests = 0
+        self.coalesced = 0
+        self.fresh_hits = 0
+        self.failures = 0
+
+    @property
+    def address(self):
+        """ Returns (host, port) to connect to, once started """
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve(self):
+        """ Opens the listening socket, returns when closed """
+        self._pools = {}
+        self._loop = asyncio.get_running_loop()
+        self._startError = None
+        try:
+            self._server = await asyncio.start_server(self._handleClient, self.host, self.port)
+        except Exception as e:
+            #i.e. port already in use, start() raises it
+            self._startError = e
+            raise
+        finally:
+            self._started.set()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for pool in self._pools.values():
+                await pool.close()
+
+    def start(self):
+        """ Serves in a background thread with its own event loop, raises the error if it can't listen """
+        self._started.clear()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        self._started.wait()
+        if not self._startError is None:
+            self._thread.join()
+            self._thread = None
+            raise self._startError
+        return self
+
+    def _run(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception:
+            if self._startError is None:
+                traceback.print_exc()
+
+    def _close(self):
+        self._server.close()
+        #since Python 3.12.1 the server waits for its client connections to be closed
+        for writer in list(self._writers):
+            writer.close()
+
+    def stop(self):
+        if not self._loop is None and not self._server is None:
+            self._loop.call_soon_threadsafe(self._close)
+        if not self._thread is None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def statistics(self):
+        return {
+            "clients": self.clients,
+            "requests": self.requests,
+            "upstream_requests": self.upstream_requests,
+            "coalesced": self.coalesced,
+            "fresh_hits": self.fresh_hits,
+            "failures": self.failures,
+        }
+
+    async def _handleClient(self, reader, writer):
+        self.clients += 1
+        self._writers.add(writer)
+        self.transport.apply(writer.get_extra_info("socket"))
+        tasks = set()
+        _drainLock = asyncio.Lock()
+        client = _ClientState()
+        try:
+            while True:
+                _header = await reader.readexactly(codec.KVP_HEADERSIZE)
+                _msgID, _msgSize = codec.unpackHeader(_header)
+                _body = await reader.readexactly(_msgSize)
+                #the requests of a client are served concurrently, the replies are matched by message ID
+                task = asyncio.get_running_loop().create_task(self._serveRequest(client, writer, _drainLock, _msgID, _body))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            #client disconnected or proxy closed
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            #the requests in flight are completed, other clients may be waiting for the same replies
+            self.clients -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _serveRequest(self, client, writer, drainLock, msgID, body):
+        self.requests += 1
+        if len(body) < codec.KVP_FUNCTIONSIZE:
+            writer.close()
+            return
+        kvp_func = body[0]
+        dataToSend = bytes(body[codec.KVP_FUNCTIONSIZE:])
+
+        #the previous requests this one must not overtake, taken before any await (the tasks start in arrival order)
+        _robotIPSet, _lastWrite = client.robotIPSet, client.lastWrite
+        done = None
+        if kvp_func == codec.KVP_FUNCTION_SETROBOTIP:
+            done = client.robotIPSet = asyncio.get_running_loop().create_future()
+        elif not kvp_func in _COALESCED:
+            done = client.lastWrite = asyncio.get_running_loop().create_future()
+        try:
+            await _waitFor(_robotIPSet)
+            if kvp_func in _COALESCED:
+                await _waitFor(_lastWrite)
+                _reply = await self._read(client.robotIP, kvp_func, dataToSend)
+            elif kvp_func == codec.KVP_FUNCTION_SETROBOTIP:
+                await _waitFor(_lastWrite)
+                _reply = await self._setRobotIP(client, dataToSend)
+            else:
+                #not waited for: the writes are pipelined in order over the upstream connection of the client
+                _reply = await self._write(client, kvp_func, dataToSend)
+        except asyncio.CancelledError:
+            raise
+        except:
+            traceback.print_exc()
+            _reply = None
+        finally:
+            if not done is None:
+                #a write is done when the previous ones are done too
+                _complete(done, None if kvp_func == codec.KVP_FUNCTION_SETROBOTIP else _lastWrite)
+        if _reply is None:
+            self.failures += 1
+            _reply = failureBody(kvp_func)
+        if writer.is_closing():
+            return
+        #message ID rewriting: the reply gets the ID of the client request
+        writer.write(codec.packMessage(msgID, _reply[0], _reply[codec.KVP_FUNCTIONSIZE:]))
+        #a client not reading its replies slows down only its own requests
+        try:
+            async with drainLock:
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    def _pool(self, robotIP):
+        """ Returns the upstream pool of the robot IP, created on first use """
+        pool = self._pools.get(robotIP)
+        if pool is None:
+            pool = self._pools[robotIP] = _UpstreamPool(self, robotIP)
+        return pool
+
+    async def _upstream(self, robotIP, kvp_func, dataToSend, upstream = None):
+        self.upstream_requests += 1
+        if upstream is None:
+            upstream = self._pool(robotIP).next()
+        return await upstream.transact_raw(kvp_func, dataToSend, "CoalescingProxy")
+
+    async def _read(self, robotIP, kvp_func, dataToSend):
+        key = (robotIP, kvp_func, dataToSend)
+        if self.freshness > 0:
+            _fresh = self._fresh.get(key)
+            if not _fresh is None and time.monotonic() - _fresh[0] <= self.freshness:
+                self.fresh_hits += 1
+                return _fresh[1]
+
+        _generation = self._generation
+        _inFlight = self._inFlight.get(key)
+        #a read started before a write may return the previous value
+        if not _inFlight is None and _inFlight[0] == _generation:
+            self.coalesced += 1
+            return await asyncio.shield(_inFlight[1])
+
+        future = asyncio.get_running_loop().create_future()
+        _inFlight = self._inFlight[key] = (_generation, future)
+        try:
+            _reply = await self._upstream(robotIP, kvp_func, dataToSend)
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            if self._inFlight.get(key) is _inFlight:
+                del self._inFlight[key]
+        future.set_result(_reply)
+
+        #the reply is kept only if no write happened while reading
+        if self.freshness > 0 and not _reply is None and _generation == self._generation and _reply[-1] == codec.KVP_RESULTOK:
+            if not key in self._fresh and kvp_func != codec.KVP_FUNCTION_DISCOVER:
+                self._freshByName.setdefault((robotIP, self._name(dataToSend)), set()).add(key)
+            self._fresh[key] = (time.monotonic(), _reply)
+        return _reply
+
+    def _name(self, dataToSend):
+        _varName, offset = codec._unpackBlock(dataToSend, 0, "name")
+        return baseName(bytes(_varName).decode("utf-8", "replace"))
+
+    def _invalidate(self, robotIP, dataToSend):
+        self._generation += 1
+        try:
+            _keys = self._freshByName.pop((robotIP, self._name(dataToSend)), ())
+        except codec.KvpProtocolError:
+            return
+        for key in _keys:
+            self._fresh.pop(key, None)
+
+    async def _write(self, client, kvp_func, dataToSend):
+        robotIP = client.robotIP
+        if client.upstream is None:
+            client.upstream = self._pool(robotIP).next()
+        self._invalidate(robotIP, dataToSend)
+        _reply = await self._upstream(robotIP, kvp_func, dataToSend, client.upstream)
+        #the reads completed while writing may have cached the previous value
+        self._invalidate(robotIP, dataToSend)
+        return _reply
+
+    async def _setRobotIP(self, client, dataToSend):
+        """ Moves the client to the pool of the robot IP, the other clients keep their own robot """
+        #the pool connections send the robot IP on connect, this request checks that the robot accepts it
+        _reply = await self._upstream(dataToSend, codec.KVP_FUNCTION_SETROBOTIP, dataToSend)
+        if not _reply is None and _reply[-1] == codec.KVP_RESULTOK:
+            client.robotIP = dataToSend
+            client.upstream = None
+        return _reply
+
+
+async def _waitFor(future):
+    """ Waits for a future without cancelling it if the waiting task is cancelled """
+    if not future is None and not future.done():
+        await asyncio.wait((future,))
+
+def _complete(future, previous):
+    """ Completes the future, once previous is completed if not None """
+    if previous is None or previous.done():
+        future.set_result(None)
+    else:
+        previous.add_done_callback(lambda _previous: future.set_result(None))
+
+
+class _ClientState():
+    __slots__ = ("robotIP", "upstream", "lastWrite", "robotIPSet")
+
+    def __init__(self):
+        self.robotIP = None #the SETROBOTIP request data accepted for this client
+        self.upstream = None #the upstream connection of the writes of the client, in the pool of its robot IP
+        self.lastWrite = None #future completed when the last write of the client and the previous ones are done
+        self.robotIPSet = None #future completed when the last SETROBOTIP of the client is done
+
+
+class _UpstreamPool():
+    """ The upstream connections serving the clients of one robot IP """
+
+    def __init__(self, proxy, robotIP):
+        self.proxy = proxy
+        self.robotIP = robotIP
+        self.upstreams = [AsyncKukaVarProxyClient(proxy.upstreamHost, proxy.upstreamPort, proxy.sockTimeout, proxy.transport) for i in range(proxy.poolSize)]
+        if not robotIP is None:
+            for upstream in self.upstreams:
+                upstream.on_connect = self._onConnect
+        self._next = itertools.cycle(self.upstreams)
+
+    def next(self):
+        return next(self._next)
+
+    async def _onConnect(self, upstream):
+        """ The robot IP belongs to the connection: every new upstream connection gets the one of the pool """
+        self.proxy.upstream_requests += 1
+        _reply = await upstream.transact_raw(codec.KVP_FUNCTION_SETROBOTIP, self.robotIP, "CoalescingProxy")
+        return not _reply is None and _reply[-1] == codec.KVP_RESULTOK
+
+    async def close(self):
+        for upstream in self.upstreams:
+            await upstream.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "KUKAVARPROXY coalescing proxy")
+    parser.add_argument("--upstream-host", required = True)
+    parser.add_argument("--upstream-port", type = int, default = 7000)
+    parser.add_argument("--host", default = "0.0.0.0")
+    parser.add_argument("--port", type = int, default = 7000)
+    parser.add_argument("--pool", type = int, default = 2, help = "number of upstream connections")
+    parser.add_argument("--freshness", type = float, default = 0.0, help = "seconds a read value is served again")
+    parser.add_argument("--timeout", type = float, default = 3.0, help = "upstream reply timeout in seconds")
+    args = parser.parse_args()
+
+    proxy = CoalescingProxy(args.upstream_host, args.upstream_port, args.host, args.port, args.pool, args.freshness, args.timeout)
+    try:
+        asyncio.run(proxy.serve())
+    except KeyboardInterrupt:
+        print(proxy.statistics())
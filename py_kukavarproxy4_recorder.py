@@ -0,0 +1,329 @@
+"""
+    Author: Davide Rosa
+    Description: Binary telemetry recording and replay.
+
+    TelemetryRecorder appends the raw values of the replies (the bytes received, not decoded) to a binary log,
+    together with a monotonic timestamp, the variable ID and the robot ID. Nothing is parsed while recording,
+    so the capture keeps up with high rate polling.
+    TelemetryLog reads a log through a memory-mapped file: the values are decoded later, in bulk.
+    ReplayServer serves a log with the stand-in server, at real time or accelerated speed,
+    so that any KukaVarProxyClient can connect to it as it would to the robot.
+
+    Log format (little-endian):
+        file header: [8 bytes MAGIC][8 bytes wall clock time of the start (double)][8 bytes monotonic ns of the start]
+        records: [1 byte KIND][2 bytes VARIABLE ID][2 bytes ROBOT ID][8 bytes monotonic ns][4 bytes SIZE][SIZE bytes]
+        KIND_VARIABLE and KIND_ROBOT records define the names of the IDs, KIND_SAMPLE records hold the values,
+        a KIND_SESSION record starts every capture appended to an existing log (the monotonic clock of the new
+        capture is unrelated to the previous one, i.e. after a reboot):
+            [8 bytes wall clock time of the start (double)][8 bytes monotonic ns of the start]
+        The monotonic ns of the records are relative to the start of their session. In the log time the sessions
+        follow one another without gaps, the wall clock time of every record is kept
+
+    i.e.
+        with TelemetryRecorder("trace.kvplog") as recorder:
+            recorder.capture(kvp, ["$AXIS_ACT", "$POS_ACT"], period = 0.004, duration = 60.0, robot = "R1")
+
+        log = TelemetryLog("trace.kvplog")
+        batch = log.toSampleBatch("$AXIS_ACT", E6AXIS)
+
+        with ReplayServer(log, port = 7000, speed = 4.0):
+            ...
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_server import KukaVarProxyServer
+from py_kukavarproxy4_subscription import SubscriptionEngine
+
+MAGIC = b"KVPLOG01"
+
+KIND_SAMPLE = 0
+KIND_VARIABLE = 1
+KIND_ROBOT = 2
+KIND_SESSION = 3
+
+_fileHeader = struct.Struct("<8sdq")
+_recordHeader = struct.Struct("<BHHqI")
+_session = struct.Struct("<dq")
+
+
+class TelemetryRecorder():
+    """ Append-only binary log of raw values, thread safe
+
+        path (str): the log file, an existing log is continued with a new session
+        bufferSize (int): size in bytes of the write buffer
+    """
+
+    def __init__(self, path, bufferSize = 1 << 20):
+        self.path = path
+        self._lock = threading.Lock()
+        self.variables = {}
+        self.robots = {}
+        self.records = 0
+
+        _exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if _exists:
+            #the IDs already defined are reused
+            _log = TelemetryLog(path)
+            self.variables = {name: varID for varID, name in _log.variables.items()}
+            self.robots = {name: robotID for robotID, name in _log.robots.items()}
+            _end = _log.end
+            _log.close()
+            #the partial record left by an interrupted capture is removed, the new records would be misread after it
+            if _end < os.path.getsize(path):
+                os.truncate(path, _end)
+        self._file = open(path, "ab", buffering = bufferSize)
+        _startTime, _startNs = time.time(), time.monotonic_ns()
+        if not _exists:
+            self._file.write(_fileHeader.pack(MAGIC, _startTime, _startNs))
+        else:
+            self._file.write(_recordHeader.pack(KIND_SESSION, 0, 0, _startNs, _session.size))
+            self._file.write(_session.pack(_startTime, _startNs))
+
+    def _define(self, table, kind, name):
+        _id = table.get(name)
+        if _id is None:
+            if len(table) >= 0xffff:
+                raise ValueError("too many names in the log")
+            _id = table[name] = len(table)
+            _name = name.encode("utf-8")
+            _varID, _robotID = (_id, 0) if kind == KIND_VARIABLE else (0, _id)
+            self._file.write(_recordHeader.pack(kind, _varID, _robotID, time.monotonic_ns(), len(_name)))
+            self._file.write(_name)
+        return _id
+
+    def record(self, varName, value, robot = "", timestamp = None):
+        """ Appends a value
+
+            value (bytes-like): the raw value as received, None is skipped
+            robot (str): the robot name
+            timestamp (int): time.monotonic_ns() of the sample, None for now
+        """
+        if value is None:
+            return
+        with self._lock:
+            _varID = self._define(self.variables, KIND_VARIABLE, varName)
+            _robotID = self._define(self.robots, KIND_ROBOT, robot)
+            self._file.write(_recordHeader.pack(KIND_SAMPLE, _varID, _robotID, time.monotonic_ns() if timestamp is None else timestamp, len(value)))
+            self._file.write(value)
+            self.records += 1
+
+    def recordMany(self, varNames, values, robot = "", timestamp = None):
+        """ Appends the values of readMany, with the same timestamp """
+        _timestamp = time.monotonic_ns() if timestamp is None else timestamp
+        for varName, value in zip(varNames, values):
+            self.record(varName, value, robot, _timestamp)
+
+    def capture(self, client, varNames, period, duration = None, robot = ""):
+        """ Polls the variables with a SubscriptionEngine and records the raw values,
+            runs for duration seconds (None until the engine is stopped). Returns the engine statistics
+        """
+        engine = SubscriptionEngine(client)
+        for varName in varNames:
+            engine.subscribe(varName, period)
+        #the samples have the wall clock time of their read, the records the monotonic one
+        _offset = time.monotonic_ns() - time.time_ns()
+        for sample in engine.samples(duration):
+            self.record(sample.name, sample.value, robot, int(sample.timestamp * 1e9) + _offset)
+        return engine.statistics()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TelemetryLog():
+    """ Memory-mapped reader of a TelemetryRecorder log
+
+        The records are indexed when the log is opened, the values are views on the mapped file
+        and are decoded only when requested
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._mmap) < _fileHeader.size:
+            self.close()
+            raise ValueError("%s is not a telemetry log"%path)
+        magic, self.start_time, self.start_ns = _fileHeader.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a telemetry log"%path)
+
+        self.variables = {} #id -> name
+        self.robots = {} #id -> name
+        self.sessions = 1
+        self._index = [] #(log time, wall clock time, variable id, robot id, value offset, value size)
+        offset = _fileHeader.size
+        self.end = offset #end of the last complete record
+        _sessionTime, _sessionWall, _sessionNs = 0.0, self.start_time, self.start_ns
+        _last = 0.0 #log time of the last record
+        while offset + _recordHeader.size <= len(self._mmap):
+            kind, varID, robotID, timestamp, size = _recordHeader.unpack_from(self._mmap, offset)
+            offset += _recordHeader.size
+            if offset + size > len(self._mmap):
+                #record truncated by an interrupted capture
+                break
+            if kind == KIND_SESSION:
+                #the new session starts where the previous one ended
+                _sessionWall, _sessionNs = _session.unpack_from(self._mmap, offset)
+                _sessionTime = _last
+                self.sessions += 1
+            else:
+                _elapsed = (timestamp - _sessionNs) * 1e-9
+                _last = max(_last, _sessionTime + _elapsed)
+            if kind == KIND_SAMPLE:
+                self._index.append((_sessionTime + _elapsed, _sessionWall + _elapsed, varID, robotID, offset, size))
+            elif kind == KIND_VARIABLE:
+                self.variables[varID] = bytes(self._mmap[offset:offset + size]).decode("utf-8")
+            elif kind == KIND_ROBOT:
+                self.robots[robotID] = bytes(self._mmap[offset:offset + size]).decode("utf-8")
+            offset += size
+            self.end = offset
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        """ Closes the log. The values returned by records() still referenced keep the file mapped:
+            it is unmapped when the last of them is released
+        """
+        self._index = []
+        if not self._view is None:
+            self._view.release()
+            self._view = None
+        if not self._mmap is None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                #values still exported, the mapping is released with them
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _ids(self, table, name):
+        if name is None:
+            return None
+        return set(_id for _id, _name in table.items() if _name == name)
+
+    def records(self, varName = None, robot = None):
+        """ Generator of (time, varName, robot, value) in recording order
+
+            time (float): seconds from the start of the log, the sessions follow one another without gaps
+            value (memoryview): the raw value, a view on the mapped file, valid until released (also after close())
+        """
+        for t, wallTime, varName, robot, value in self._records(varName, robot):
+            yield t, varName, robot, value
+
+    def _records(self, varName, robot):
+        """ Generator of (time, wall clock time, varName, robot, value) in recording order """
+        _varIDs = self._ids(self.variables, varName)
+        _robotIDs = self._ids(self.robots, robot)
+        for t, wallTime, varID, robotID, offset, size in self._index:
+            if (_varIDs is None or varID in _varIDs) and (_robotIDs is None or robotID in _robotIDs):
+                yield t, wallTime, self.variables[varID], self.robots[robotID], self._view[offset:offset + size]
+
+    def duration(self):
+        """ Returns the time in seconds from the start of the log to the last record """
+        if len(self._index) == 0:
+            return 0.0
+        return self._index[-1][0]
+
+    def decode(self, varName, decode = krl.parseKrl, robot = None):
+        """ Returns the list of (time, decoded value) of a variable """
+        return [(t, decode(bytes(value))) for t, _varName, _robot, value in self.records(varName, robot)]
+
+    def toSampleBatch(self, varName, recordType, robot = None):
+        """ Decodes all the values of a variable into a SampleBatch of the record type (i.e. E6AXIS),
+            the timestamps are the wall clock times of the samples
+        """
+        from py_kukavarproxy4_types import SampleBatch
+        _records = list(self._records(varName, robot))
+        batch = SampleBatch(recordType, len(_records))
+        for t, wallTime, _varName, _robot, value in _records:
+            batch.appendValue(bytes(value), wallTime)
+        return batch
+
+
+class ReplayServer(KukaVarProxyServer):
+    """ Stand-in server whose variables follow a recorded log
+
+        log (TelemetryLog or str): the log to replay, a log opened from its path is closed by stop()
+        speed (float): 1.0 replays in real time, 4.0 four times faster
+        robot (str): the robot of the log to replay, None replays all the records
+        loop (bool): restarts from the beginning at the end of the log
+        The other arguments are the KukaVarProxyServer ones
+    """
+
+    def __init__(self, log, host = "127.0.0.1", port = 7000, speed = 1.0, robot = None, loop = False, **options):
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        options.setdefault("variables", {})
+        KukaVarProxyServer.__init__(self, host, port, **options)
+        self._ownsLog = not isinstance(log, TelemetryLog)
+        self.log = TelemetryLog(log) if self._ownsLog else log
+        self.speed = speed
+        self.robot = robot
+        self.loop = loop
+        self.replayed = 0
+        self._stopReplay = threading.Event()
+        self._replayThread = None
+
+    def _replay(self):
+        while not self._stopReplay.is_set():
+            _start = time.monotonic()
+            _replayed = self.replayed
+            for t, varName, robot, value in self.log.records(robot = self.robot):
+                _wait = _start + t / self.speed - time.monotonic()
+                if _wait > 0 and self._stopReplay.wait(_wait):
+                    return
+                self.setVar(varName, bytes(value))
+                self.replayed += 1
+            if not self.loop or self.replayed == _replayed:
+                #nothing to replay (empty log or no records of the robot), looping would spin
+                return
+
+    def start(self):
+        """ Starts serving and replaying in background threads """
+        KukaVarProxyServer.start(self)
+        self._stopReplay.clear()
+        self._replayThread = threading.Thread(target = self._replay, daemon = True)
+        self._replayThread.start()
+        return self
+
+    def finished(self):
+        """ Returns True when the whole log has been replayed """
+        return not self._replayThread is None and not self._replayThread.is_alive()
+
+    def stop(self):
+        self._stopReplay.set()
+        if not self._replayThread is None:
+            self._replayThread.join()
+            self._replayThread = None
+        KukaVarProxyServer.stop(self)
+        if self._ownsLog:
+            self.log.close()
@@ -0,0 +1,360 @@
+"""
+    Author: Davide Rosa
+    Description: Pure Python stand-in for KUKAVARPROXY_KRC4_server.exe, for testing and benchmarking
+                 the clients without a controller.
+
+    It speaks the same protocol and implements READ, WRITE, READARRAY, WRITEARRAY, DISCOVER and SETROBOTIP
+    on an in-memory variable store. READARRAY and WRITEARRAY also accept index ranges (MYARRAY[1..100],
+    see codec.arrayRangeName), used by the chunked array transfers.
+    The replies can be delayed (latency + jitter) and faults can be injected: dropped connections,
+    mismatched message IDs and truncated replies.
+
+    i.e.
+        server = KukaVarProxyServer(port = 0, latency = 0.002)
+        server.start()
+        kvp = KukaVarProxyClient(*server.address)
+        ...
+        server.stop()
+
+    or from the command line:
+        python py_kukavarproxy4_server.py --port 7000 --latency 0.002 --jitter 0.001
+"""
+
+import argparse
+import collections
+import random
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+import py_kukavarproxy4_codec as codec
+
+#realistic values of a robot standing in its home position
+DEFAULT_VARIABLES = {
+    "$OV_PRO": "100",
+    "$MODE_OP": "#T1",
+    "$ROBNAME[]": "\"KR 10 R1100 sixx\"",
+    "$AXIS_ACT": "{E6AXIS: A1 0.0, A2 -90.0, A3 90.0, A4 0.0, A5 0.0, A6 0.0, E1 0.0, E2 0.0, E3 0.0, E4 0.0, E5 0.0, E6 0.0}",
+    "$POS_ACT": "{E6POS: X 525.000, Y 0.0, Z 890.000, A 0.0, B 90.0, C 0.0, S 2, T 35, E1 0.0, E2 0.0, E3 0.0, E4 0.0, E5 0.0, E6 0.0}",
+    "$TOOL": "{FRAME: X 0.0, Y 0.0, Z 120.0, A 0.0, B 0.0, C 0.0}",
+    "$BASE": "{FRAME: X 0.0, Y 0.0, Z 0.0, A 0.0, B 0.0, C 0.0}",
+    "$LOAD": "{LOAD: M 2.5, CM {FRAME: X 0.0, Y 0.0, Z 60.0, A 0.0, B 0.0, C 0.0}, J {INERTIA: X 0.01, Y 0.01, Z 0.01}}",
+}
+
+DEFAULT_ROBOT_IPS = [(172, 17, 255, 1)]
+
+
+class FaultInjection():
+    """ Probabilities (0.0 - 1.0) of the faults applied to every request.
+        The random generator is seeded so that the sequence of faults is reproducible
+
+        drop_connection: the connection is closed instead of replying
+        mismatched_id: the reply has a different message id
+        truncated_reply: only part of the reply is sent, then the connection is closed
+    """
+    drop_connection = 0.0
+    mismatched_id = 0.0
+    truncated_reply = 0.0
+
+    def __init__(self, drop_connection = 0.0, mismatched_id = 0.0, truncated_reply = 0.0, seed = 0):
+        self.drop_connection = drop_connection
+        self.mismatched_id = mismatched_id
+        self.truncated_reply = truncated_reply
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def pick(self):
+        """ Returns the fault to apply to the next request or None """
+        with self._lock:
+            _value = self._random.random()
+        for fault in ("drop_connection", "mismatched_id", "truncated_reply"):
+            _probability = getattr(self, fault)
+            if _value < _probability:
+                return fault
+            _value -= _probability
+        return None
+
+
+class _ReplyScheduler():
+    """ Sends the replies of a connection in order, each one not before its due time.
+        Pipelined requests are delayed concurrently as they would be by the network
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._queue = collections.deque()
+        self._lastDueTime = 0.0
+        self._condition = threading.Condition()
+        self._finishing = False
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def schedule(self, dueTime, frame, closeAfter = False):
+        with self._condition:
+            #the replies are never reordered, as on a TCP stream
+            self._lastDueTime = max(self._lastDueTime, dueTime)
+            self._queue.append((self._lastDueTime, frame, closeAfter))
+            self._condition.notify()
+
+    def finish(self):
+        """ Waits until the scheduled replies are sent """
+        with self._condition:
+            self._finishing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if len(self._queue) > 0:
+                        _wait = self._queue[0][0] - time.monotonic()
+                        if _wait <= 0.0:
+                            break
+                        self._condition.wait(_wait)
+                    elif self._finishing:
+                        return
+                    else:
+                        self._condition.wait()
+                dueTime, frame, closeAfter = self._queue.popleft()
+            try:
+                if len(frame) > 0:
+                    self.sock.sendall(frame)
+                if closeAfter:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                    return
+            except OSError:
+                return
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def recvExactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            _data = self.request.recv(size - len(data))
+            if len(_data) < 1:
+                return None
+            data += _data
+        return data
+
+    def handle(self):
+        server = self.server.owner
+        scheduler = _ReplyScheduler(self.request)
+        try:
+            while True:
+                _header = self.recvExactly(codec.KVP_HEADERSIZE)
+                if _header is None:
+                    return
+                _msgID, _msgSize = codec.unpackHeader(_header)
+                _body = self.recvExactly(_msgSize)
+                if _body is None:
+                    return
+
+                kvp_func, args = codec.unpackRequest(_body)
+                _replyData = server.execute(kvp_func, args)
+
+                dueTime = time.monotonic() + server.replyDelay()
+                fault = None if server.faults is None else server.faults.pick()
+                if fault == "drop_connection":
+                    scheduler.schedule(dueTime, b"", closeAfter = True)
+                    return
+                if fault == "mismatched_id":
+                    _msgID = (_msgID + 1) & 0xffff
+                _frame = codec.packMessage(_msgID, kvp_func, _replyData)
+                if fault == "truncated_reply":
+                    scheduler.schedule(dueTime, _frame[:len(_frame)//2], closeAfter = True)
+                    return
+                scheduler.schedule(dueTime, _frame)
+        except (OSError, codec.KvpProtocolError):
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            #the scheduled replies are sent before closing
+            scheduler.finish()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class KukaVarProxyServer():
+    """ In-process KUKAVARPROXY stand-in
+
+        host, port: the listening address, port 0 picks a free port (see address)
+        variables (dict): initial variables (name -> KRL value string), defaults to DEFAULT_VARIABLES
+        arrays (dict): initial arrays (name with [] -> list of shorts)
+        robotIPs (list): the IPs returned by DISCOVER
+        latency (float): delay in seconds of every reply
+        jitter (float): maximum random delay in seconds added to latency
+        faults (FaultInjection): faults to inject, None for no faults
+        seed (int): seed of the jitter random generator
+    """
+
+    def __init__(self, host = "127.0.0.1", port = 7000, variables = None, arrays = None, robotIPs = None, latency = 0.0, jitter = 0.0, faults = None, seed = 0):
+        self._lock = threading.Lock()
+        self.variables = {}
+        for name, value in (DEFAULT_VARIABLES if variables is None else variables).items():
+            self.setVar(name, value)
+        self.arrays = {}
+        for name, values in ({} if arrays is None else arrays).items():
+            self.setArray(name, values)
+        self.robotIPs = [bytes(ip) for ip in (DEFAULT_ROBOT_IPS if robotIPs is None else robotIPs)]
+        self.robotIP = None
+
+        self.latency = latency
+        self.jitter = jitter
+        self.faults = faults
+        self._random = random.Random(seed)
+
+        self.requests_count = 0
+
+        self._server = _ThreadingTCPServer((host, port), _RequestHandler, bind_and_activate = True)
+        self._server.owner = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """ Returns (host, port) to connect to """
+        return self._server.server_address[:2]
+
+    def start(self):
+        """ Starts serving in a background thread """
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def serveForever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if not self._thread is None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def setVar(self, varName, varValue):
+        """ varValue (str or bytes): the KRL representation of the value """
+        if isinstance(varValue, str):
+            varValue = varValue.encode("utf-8")
+        with self._lock:
+            self.variables[varName.upper()] = bytes(varValue)
+
+    def getVar(self, varName):
+        with self._lock:
+            return self.variables.get(varName.upper())
+
+    def setArray(self, varName, varValues):
+        with self._lock:
+            self.arrays[varName.upper()] = list(varValues)
+
+    def getArray(self, varName):
+        """ varName (str): the array name with [] at the end, or a range (see codec.arrayRangeName) """
+        _range = codec.parseArrayRangeName(varName)
+        with self._lock:
+            if _range is None:
+                return self.arrays.get(varName.upper())
+            _varValues = self.arrays.get(_range[0].upper())
+            if _varValues is None or _range[1] + _range[2] - 1 > len(_varValues):
+                return None
+            return _varValues[_range[1] - 1:_range[1] - 1 + _range[2]]
+
+    def setArrayRange(self, varName, varValues):
+        """ Writes the values of a range (see codec.arrayRangeName), the array is extended with zeros if needed
+            Returns False if the range size doesn't match the values
+        """
+        arrayName, first, count = codec.parseArrayRangeName(varName)
+        if count != len(varValues):
+            return False
+        with self._lock:
+            _array = self.arrays.setdefault(arrayName.upper(), [])
+            if len(_array) < first - 1 + count:
+                _array.extend([0] * (first - 1 + count - len(_array)))
+            _array[first - 1:first - 1 + count] = varValues
+        return True
+
+    def replyDelay(self):
+        if self.jitter <= 0.0:
+            return self.latency
+        with self._lock:
+            return self.latency + self._random.uniform(0.0, self.jitter)
+
+    def execute(self, kvp_func, args):
+        """ Executes a request, returns the reply data (without function) """
+        with self._lock:
+            self.requests_count += 1
+
+        if kvp_func == codec.KVP_FUNCTION_READ:
+            _varValue = self.getVar(args[0])
+            if _varValue is None:
+                return codec.packValueReply(b"", codec.KVP_RESULTFAIL)
+            return codec.packValueReply(_varValue, codec.KVP_RESULTOK)
+
+        if kvp_func == codec.KVP_FUNCTION_WRITE:
+            varName, varValue = args
+            self.setVar(varName, varValue)
+            return codec.packValueReply(varValue, codec.KVP_RESULTOK)
+
+        if kvp_func == codec.KVP_FUNCTION_READARRAY:
+            _varValues = self.getArray(args[0])
+            if _varValues is None:
+                return codec.packReadArrayReply((), codec.KVP_RESULTFAIL)
+            return codec.packReadArrayReply(_varValues, codec.KVP_RESULTOK)
+
+        if kvp_func == codec.KVP_FUNCTION_WRITEARRAY:
+            varName, varValues = args
+            if codec.parseArrayRangeName(varName) is None:
+                self.setArray(varName, varValues)
+            elif not self.setArrayRange(varName, varValues):
+                return codec.packValueReply(b"", codec.KVP_RESULTFAIL)
+            return codec.packValueReply(varName.encode("utf-8"), codec.KVP_RESULTOK)
+
+        if kvp_func == codec.KVP_FUNCTION_DISCOVER:
+            return codec.packDiscoverReply(self.robotIPs, codec.KVP_RESULTOK)
+
+        if kvp_func == codec.KVP_FUNCTION_SETROBOTIP:
+            if not args[0] in self.robotIPs:
+                return codec.packSetRobotIPReply(codec.KVP_RESULTFAIL)
+            self.robotIP = args[0]
+            return codec.packSetRobotIPReply(codec.KVP_RESULTOK)
+
+        raise codec.KvpProtocolError("unknown function %d"%kvp_func)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "KUKAVARPROXY stand-in server")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 7000)
+    parser.add_argument("--latency", type = float, default = 0.0, help = "reply delay in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "maximum random delay added to latency in seconds")
+    parser.add_argument("--drop-connection", type = float, default = 0.0, help = "probability of closing the connection")
+    parser.add_argument("--mismatched-id", type = float, default = 0.0, help = "probability of replying with a wrong message id")
+    parser.add_argument("--truncated-reply", type = float, default = 0.0, help = "probability of sending a truncated reply")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    faults = None
+    if args.drop_connection > 0 or args.mismatched_id > 0 or args.truncated_reply > 0:
+        faults = FaultInjection(args.drop_connection, args.mismatched_id, args.truncated_reply, args.seed)
+
+    server = KukaVarProxyServer(args.host, args.port, latency = args.latency, jitter = args.jitter, faults = faults, seed = args.seed)
+    print("KUKAVARPROXY stand-in listening on %s:%d"%server.address)
+    try:
+        server.serveForever()
+    except KeyboardInterrupt:
+        pass
+    server.stop()
@@ -0,0 +1,335 @@
+"""
+    Author: Davide Rosa
+    Description: Thread safe KUKAVARPROXY client, shared by many threads over a single connection.
+
+    The message IDs are allocated atomically, a single reader thread receives the replies and routes them
+    to the waiting callers by message ID, so that the calls of different threads can be in flight together.
+    Every call accepts a timeout, a late reply is discarded without dropping the connection.
+    The socket is non blocking: a send that doesn't complete within the timeout of its call
+    fails the call and closes the connection (the stream would carry a partial frame).
+
+    i.e.
+        kvp = SharedKukaVarProxyClient('127.0.0.1', 7000)
+        #from any thread
+        value = kvp.readVar("$AXIS_ACT", timeout = 0.5)
+"""
+
+import select
+import socket
+import threading
+import time
+import traceback
+
+import py_kukavarproxy4_codec as codec
+from py_kukavarproxy4_client import KukaVarProxyClient, _bigEndianShorts, _callName, _encodeRequest
+
+
+class _PendingCall():
+    __slots__ = ("msg_id", "kvp_func", "event", "body", "error")
+
+    def __init__(self, kvp_func):
+        self.msg_id = None
+        self.kvp_func = kvp_func
+        self.event = threading.Event()
+        self.body = None
+        self.error = None
+
+
+class SharedKukaVarProxyClient(KukaVarProxyClient):
+    """ KukaVarProxyClient that can be used by many threads at the same time.
+        max_pipeline_depth bounds the number of calls in flight over all the threads
+    """
+
+    def __init__(self, _host, _port, _sockTimeout = 3.0, _maxPipelineDepth = 64, _transportProfile = None, _instrumentation = None, _cache = None):
+        self._lock = threading.RLock() #connection state, message ids and pending calls
+        self._sendLock = threading.Lock()
+        self._pending = {} #message id -> _PendingCall
+        self._readerThread = None
+        self._inFlight = threading.BoundedSemaphore(max(1, min(_maxPipelineDepth, 0x7fff)))
+        KukaVarProxyClient.__init__(self, _host, _port, _sockTimeout, _maxPipelineDepth, _transportProfile, _instrumentation, _cache)
+
+    def connect(self):
+        """ Opens the connection and starts the reader thread, returns True if connected """
+        with self._lock:
+            if not self.sock is None:
+                return True
+            if not KukaVarProxyClient.connect(self):
+                return False
+            #the timeouts are per call: the reader thread and the senders wait with select
+            self.sock.setblocking(False)
+            self._readerThread = threading.Thread(target = self._readLoop, args = (self.sock,), daemon = True)
+            self._readerThread.start()
+            return True
+
+    def disconnect(self):
+        """ Closes the connection, the calls in flight fail """
+        with self._lock:
+            if not self.sock is None:
+                try:
+                    #wakes up the reader thread
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            KukaVarProxyClient.disconnect(self)
+            _pending = list(self._pending.values())
+            self._pending.clear()
+        for call in _pending:
+            self._fail(call, "connection lost")
+
+    def _fail(self, call, error):
+        call.error = error
+        self._inFlight.release()
+        call.event.set()
+
+    def _recvExactly(self, sock, view):
+        received = 0
+        while received < len(view):
+            try:
+                _n = sock.recv_into(view[received:])
+            except (BlockingIOError, InterruptedError):
+                select.select([sock], [], [])
+                continue
+            if _n < 1:
+                return False
+            received += _n
+        return True
+
+    def _sendAll(self, sock, data, deadline):
+        """ Sends the whole frame before the deadline (time.monotonic()), raises TimeoutError if expired """
+        _view = memoryview(data)
+        sent = 0
+        while sent < len(_view):
+            try:
+                sent += sock.send(_view[sent:])
+                continue
+            except (BlockingIOError, InterruptedError):
+                pass
+            _remaining = deadline - time.monotonic()
+            if _remaining <= 0:
+                raise TimeoutError("send timeout, %d of %d bytes sent"%(sent, len(_view)))
+            select.select([], [sock], [], _remaining)
+
+    def _readLoop(self, sock):
+        _buffer = bytearray(codec.KVP_HEADERSIZE + codec.KVP_MAXBODYSIZE)
+        _view = memoryview(_buffer)
+        try:
+            while True:
+                if not self._recvExactly(sock, _view[:codec.KVP_HEADERSIZE]):
+                    break
+                _msgID, _msgSize = codec.unpackHeader(_buffer)
+                if not self._recvExactly(sock, _view[codec.KVP_HEADERSIZE:codec.KVP_HEADERSIZE + _msgSize]):
+                    break
+
+                with self._lock:
+                    call = self._pending.pop(_msgID, None)
+                if call is None:
+                    #the caller timed out
+                    print("SharedKukaVarProxyClient - unexpected message id %d"%_msgID)
+                    continue
+                call.body = bytes(_view[codec.KVP_HEADERSIZE:codec.KVP_HEADERSIZE + _msgSize])
+                self._inFlight.release()
+                call.event.set()
+        except (OSError, ValueError): #closed by disconnect
+            pass
+        except:
+            traceback.print_exc()
+
+        with self._lock:
+            if self.sock is sock:
+                self.disconnect()
+
+    def submit(self, kvp_func, dataToSend, funcName = "submit", varName = None, timeout = None):
+        """ Sends a request without waiting for the reply
+
+            Returns the pending call to pass to complete(), None if the request couldn't be sent
+        """
+        _deadline = time.monotonic() + (self.sock_timeout if timeout is None else timeout)
+        if not isinstance(dataToSend, codec.RequestTemplate):
+            #encoded before taking a slot, only the message ID is stamped once it is allocated
+            try:
+                dataToSend = codec.RequestTemplate(kvp_func, dataToSend)
+            except codec.KvpProtocolError as e:
+                print("%s - %s"%(_callName(funcName, varName), e))
+                return None
+        if not self._inFlight.acquire(timeout = self.sock_timeout if timeout is None else timeout):
+            print("%s - too many calls in flight"%_callName(funcName, varName))
+            return None
+
+        call = _PendingCall(kvp_func)
+        with self._lock:
+            if self.sock is None and not self.connect():
+                self._inFlight.release()
+                return None
+            #atomic message id allocation, the ids of the calls in flight are skipped
+            while True:
+                self.KVP_IDCOUNTER = self.KVP_IDCOUNTER + 1
+                if self.KVP_IDCOUNTER==0xffff:
+                    self.KVP_IDCOUNTER = 0
+                if not self.KVP_IDCOUNTER in self._pending:
+                    break
+            _msgID = call.msg_id = self.KVP_IDCOUNTER
+            self._pending[_msgID] = call
+            sock = self.sock
+
+        if not self._sendLock.acquire(timeout = max(0.0, _deadline - time.monotonic())):
+            #another sender is stuck, it closes the connection when its own timeout expires
+            print("%s - send timeout"%_callName(funcName, varName))
+            with self._lock:
+                _owned = self._pending.pop(_msgID, None) is call
+            if _owned:
+                self._inFlight.release()
+            return None
+        try:
+            if not self.sock is sock:
+                raise ConnectionError("connection lost")
+            #the frame of a prepared request is patched in place, under the send lock
+            self._sendAll(sock, dataToSend.stamp(_msgID), _deadline)
+        except Exception as e:
+            print("%s - %s"%(_callName(funcName, varName), e))
+            with self._lock:
+                _owned = self._pending.pop(_msgID, None) is call
+                if self.sock is sock:
+                    self.disconnect()
+            if _owned:
+                self._inFlight.release()
+            return None
+        finally:
+            self._sendLock.release()
+        return call
+
+    def complete(self, call, funcName = "complete", varName = None, timeout = None):
+        """ Waits for the reply of a submitted call
+
+            Returns (True, value) if success otherwise (False, None), see KukaVarProxyClient.transact
+        """
+        if not call.event.wait(self.sock_timeout if timeout is None else timeout):
+            with self._lock:
+                _owned = self._pending.pop(call.msg_id, None) is call
+            if _owned:
+                self._inFlight.release()
+                print("%s - timeout"%_callName(funcName, varName))
+                if self.instrumentation.enabled:
+                    self.instrumentation.onError(funcName, varName, "timeout")
+                return False, None
+            #the reply arrived in the meantime
+            call.event.wait()
+
+        if call.body is None:
+            print("%s - %s"%(_callName(funcName, varName), call.error))
+            if self.instrumentation.enabled:
+                self.instrumentation.onError(funcName, varName, call.error)
+            return False, None
+        try:
+            _value, result = codec.unpackReply(call.kvp_func, call.body)
+        except codec.KvpProtocolError as e:
+            print("%s - %s"%(_callName(funcName, varName), e))
+            if self.instrumentation.enabled:
+                self.instrumentation.onError(funcName, varName, e)
+            return False, None
+        if not result == self.KVP_RESULTOK:
+            print("%s - result not OK"%_callName(funcName, varName))
+            return False, None
+        return True, _value
+
+    def transact(self, kvp_func, dataToSend, funcName, varName = None, timeout = None):
+        """ Sends a request and waits for its reply, see KukaVarProxyClient.transact """
+        _instr = self.instrumentation if self.instrumentation.enabled else None
+        if not _instr is None:
+            _instr.onRequest(funcName, varName)
+            _t0 = time.perf_counter()
+
+        call = self.submit(kvp_func, dataToSend, funcName, varName, timeout)
+        if call is None:
+            return False, None
+        if not _instr is None:
+            _t1 = time.perf_counter()
+
+        _success, _value = self.complete(call, funcName, varName, timeout)
+        if not _instr is None and not call.body is None:
+            #the body is received by the reader thread, the wait time is accounted as header time
+            _instr.onReply(funcName, varName, _success, codec.KVP_HEADERSIZE + codec.KVP_FUNCTIONSIZE + len(dataToSend), codec.KVP_HEADERSIZE + len(call.body),
+                           _t1 - _t0, time.perf_counter() - _t1, 0.0)
+        return _success, _value
+
+    def transactMany(self, requests, funcName = "transactMany", varNames = None, timeout = None):
+        """ Sends the requests pipelined and waits for all the replies
+
+            Returns the list of reply bodies (function byte included), None for the failed requests
+        """
+        calls = [self.submit(kvp_func, dataToSend, funcName, None if varNames is None else varNames[i], timeout) for i, (kvp_func, dataToSend) in enumerate(requests)]
+        results = []
+        _deadline = time.monotonic() + (self.sock_timeout if timeout is None else timeout)
+        for i, call in enumerate(calls):
+            if call is None:
+                results.append(None)
+                continue
+            _varName = None if varNames is None else varNames[i]
+            if not call.event.wait(max(0.0, _deadline - time.monotonic())):
+                self.complete(call, funcName, _varName, 0.0) #discards the call
+                results.append(None)
+                continue
+            results.append(call.body)
+        return results
+
+    def readVar(self, varName, timeout = None):
+        """ Returns the variable value if success otherwise None """
+        if not self.cache is None:
+            _hit, _varValue, _token = self.cache.lookup(self.KVP_FUNCTION_READ, varName)
+            if _hit:
+                return _varValue
+        _request = _encodeRequest(_callName("readVar", varName), codec.packReadRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValue = self.transact(self.KVP_FUNCTION_READ, _request, "readVar", varName, timeout)
+        if _success and not self.cache is None:
+            self.cache.store(self.KVP_FUNCTION_READ, varName, _varValue, _token)
+        return _varValue
+
+    def readArray(self, varName, timeout = None):
+        """ varName (str): the variable name with [] at the end. i.e. MYARRAY[]
+            Returns the array('H') of shorts (2 bytes) if success otherwise None """
+        if not self.cache is None:
+            _hit, _varValues, _token = self.cache.lookup(self.KVP_FUNCTION_READARRAY, varName)
+            if _hit:
+                return _varValues
+        _request = _encodeRequest(_callName("readArray", varName), codec.packReadArrayRequest, varName)
+        if _request is None:
+            return None
+        _success, _varValues = self.transact(self.KVP_FUNCTION_READARRAY, _request, "readArray", varName, timeout)
+        if _success and not self.cache is None:
+            self.cache.store(self.KVP_FUNCTION_READARRAY, varName, _varValues, _token)
+        return _varValues
+
+    def writeVar(self, varName, varValue, timeout = None):
+        """ Returns True if success """
+        if len(varName) > 0xffff or len(varValue) > 0xffff:
+            print("writeVar - var name or value too long")
+            return False
+
+        _success, _varValue = self.transact(self.KVP_FUNCTION_WRITE, codec.packWriteRequest(varName, varValue), "writeVar", varName, timeout)
+        if not self.cache is None:
+            self.cache.invalidate(varName)
+        return _success
+
+    def writeArray(self, varName, varValues, timeout = None):
+        """ Returns True if success, see KukaVarProxyClient.writeArray """
+        _data = _bigEndianShorts(varValues)
+        if codec.KVP_FUNCTIONSIZE + 2*codec.KVP_BLOCKSIZE + len(varName.encode("utf-8")) + len(_data) > codec.KVP_MAXBODYSIZE:
+            #too large for a single message
+            return self.writeArrayChunked(varName, _data)
+        _success, _varValue = self.transact(self.KVP_FUNCTION_WRITEARRAY, codec.packWriteArrayRawRequest(varName, _data), "writeArray", varName, timeout)
+        if not self.cache is None:
+            self.cache.invalidate(varName)
+        return _success
+
+    def discoverRobots(self, timeout = None):
+        """ Returns the IPs of the available robots  """
+        _success, ipList = self.transact(self.KVP_FUNCTION_DISCOVER, codec.packDiscoverRequest(), "discoverRobots", None, timeout)
+        if not _success:
+            return []
+        return ipList
+
+    def setRobotIP(self, ip, timeout = None):
+        """ Sets the ip of the server robot, ip (list) = list of 4 ip bytes """
+        _success, _value = self.transact(self.KVP_FUNCTION_SETROBOTIP, codec.packSetRobotIPRequest(ip), "setRobotIP", None, timeout)
+        return _success
@@ -0,0 +1,243 @@
+"""
+    Author: Davide Rosa
+    Description: Latest state of the robots in shared memory, for many local consumer processes.
+
+    A single publisher process keeps the connections to the robots and writes the latest decoded values
+    into a multiprocessing.shared_memory block, as fixed layout float64 records. Every record is protected by a
+    seqlock: the publisher makes the sequence number odd while writing and even when done, the readers retry
+    when the number is odd or changed during the read, so that they never see a torn record.
+    The readers don't open any socket, a read is a couple of struct.unpack_from on the mapped memory.
+
+    Block layout (native byte order):
+        header: [8 bytes MAGIC][4 bytes SLOTS COUNT][4 bytes MAX FIELDS]
+        directory, one entry per slot: [48 bytes KEY][16 bytes TYPE NAME][4 bytes FIELDS COUNT][4 bytes padding]
+        records, one per slot: [8 bytes SEQUENCE][8 bytes TIMESTAMP (double)][8 bytes * MAX FIELDS (double)]
+
+    i.e.
+        #publisher
+        board = StateBoardPublisher("cell1", [("R1/$AXIS_ACT", E6AXIS), ("R1/$POS_ACT", E6POS), ("R1/$OV_PRO", None)])
+        board.run(kvp, period = 0.004, robot = "R1")
+
+        #any other process
+        board = StateBoardReader("cell1")
+        timestamp, axes = board.read("R1/$AXIS_ACT")
+"""
+
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_subscription import SubscriptionEngine
+from py_kukavarproxy4_types import RECORD_TYPES
+
+MAGIC = b"KVPBOARD"
+MAX_FIELDS = 16
+
+_header = struct.Struct("=8sII")
+_directoryEntry = struct.Struct("=48s16sI4x")
+_sequence = struct.Struct("=Q")
+_stamp = struct.Struct("=Qd")
+
+#boards created by this process, the resource tracker already knows them
+_published = set()
+
+
+def _recordSize(maxFields):
+    return _stamp.size + 8 * maxFields
+
+def _scalarValues(value):
+    """ Decodes a numeric (or boolean) KRL scalar into a 1 field tuple """
+    return (float(krl.parseKrl(value)),)
+
+
+class _StateBoard():
+    """ Layout of the board, shared by the publisher and the readers """
+
+    def _layout(self):
+        _magic, self.slotsCount, self.maxFields = _header.unpack_from(self._buffer, 0)
+        if _magic != MAGIC:
+            raise ValueError("%s is not a state board"%self.name)
+        self.slots = {} #key -> (record offset, record type or None, fields count, values struct)
+        _recordsOffset = _header.size + self.slotsCount * _directoryEntry.size
+        for i in range(self.slotsCount):
+            _key, _typeName, _fieldsCount = _directoryEntry.unpack_from(self._buffer, _header.size + i * _directoryEntry.size)
+            _key = _key.rstrip(b"\0").decode("utf-8")
+            _typeName = _typeName.rstrip(b"\0").decode("utf-8")
+            self.slots[_key] = (_recordsOffset + i * _recordSize(self.maxFields), RECORD_TYPES.get(_typeName), _fieldsCount,
+                                struct.Struct("=%dd"%_fieldsCount))
+
+    def keys(self):
+        return list(self.slots)
+
+    def fields(self, key):
+        """ Returns the field names of a slot """
+        _offset, recordType, _count, _values = self.slots[key]
+        return recordType.FIELDS if not recordType is None else ("VALUE",)
+
+
+class StateBoardPublisher(_StateBoard):
+    """ Creates the board and writes the latest values, there must be a single publisher per board
+
+        name (str): the shared memory name, known by the readers
+        slots (list): (key, record type) couples, record type is a KrlRecord class (i.e. E6AXIS)
+            or None for a numeric scalar. Keys are usually "robot/variable"
+        maxFields (int): fields of every record
+    """
+
+    def __init__(self, name, slots, maxFields = MAX_FIELDS):
+        self.name = name
+        #the slots are validated before creating the block, a wrong slot doesn't leave a block behind
+        _entries = []
+        self._decoders = {}
+        for key, recordType in slots:
+            _fieldsCount = 1 if recordType is None else len(recordType.FIELDS)
+            if _fieldsCount > maxFields:
+                raise ValueError("%s has more than %d fields"%(key, maxFields))
+            _key = key.encode("utf-8")
+            if len(_key) > 48:
+                raise ValueError("key too long: %s"%key)
+            _entries.append((_key, (b"" if recordType is None else recordType.TYPE_NAME.encode("utf-8")), _fieldsCount))
+            self._decoders[key] = _scalarValues if recordType is None else recordType.decodeValues
+        _size = _header.size + len(slots) * (_directoryEntry.size + _recordSize(maxFields))
+        self._shm = shared_memory.SharedMemory(name, create = True, size = _size)
+        _published.add(self._shm.name)
+        self._buffer = self._shm.buf
+        self._buffer[:_size] = bytes(_size)
+        for i, _entry in enumerate(_entries):
+            _directoryEntry.pack_into(self._buffer, _header.size + i * _directoryEntry.size, *_entry)
+        #the magic is written last, the readers can't attach to a half written directory
+        _header.pack_into(self._buffer, 0, MAGIC, len(slots), maxFields)
+        self._layout()
+        self.published = 0
+        self.skipped = 0 #values that couldn't be decoded
+        self._reported = set() #slots whose decoding failure was already printed
+
+    def publish(self, key, values, timestamp = None):
+        """ Writes the field values (tuple in the FIELDS order, or KrlRecord) of a slot """
+        _offset, recordType, _count, _values = self.slots[key]
+        if hasattr(values, "asTuple"):
+            values = values.asTuple()
+        _sequenceNumber = _sequence.unpack_from(self._buffer, _offset)[0]
+        _stamp.pack_into(self._buffer, _offset, _sequenceNumber + 1, time.time() if timestamp is None else timestamp) #odd: writing
+        _values.pack_into(self._buffer, _offset + _stamp.size, *values)
+        _sequence.pack_into(self._buffer, _offset, _sequenceNumber + 2) #even: done
+        self.published += 1
+
+    def publishRaw(self, key, value, timestamp = None):
+        """ Decodes and writes a raw value as returned by readVar, None and the values that can't be decoded
+            (i.e. an enum in a numeric slot) are skipped. Returns True if published
+        """
+        if value is None:
+            return False
+        try:
+            _values = self._decoders[key](value)
+        except (ValueError, TypeError) as e: #KrlParseError included
+            self.skipped += 1
+            if not key in self._reported:
+                #only the first failure of a slot, the next ones are counted in skipped
+                self._reported.add(key)
+                print("StateBoardPublisher - %s: %s"%(key, e))
+            return False
+        self.publish(key, _values, timestamp)
+        return True
+
+    def run(self, client, period, robot = None, duration = None):
+        """ Polls the slots of a robot with a SubscriptionEngine and publishes them,
+            the keys are "robot/variable" (just "variable" if robot is None).
+            Runs for duration seconds (None runs forever), returns the engine statistics
+        """
+        _prefix = "" if robot is None else robot + "/"
+        _keys = {key[len(_prefix):]: key for key in self.slots if key.startswith(_prefix)}
+        engine = SubscriptionEngine(client)
+        for varName in _keys:
+            engine.subscribe(varName, period)
+        for sample in engine.samples(duration):
+            self.publishRaw(_keys[sample.name], sample.value, sample.timestamp)
+        return engine.statistics()
+
+    def runFleet(self, fleet, period, duration = None):
+        """ Polls a FleetPoller and publishes the "robot/variable" slots, runs for duration seconds (None runs forever) """
+        for timestamp, results in fleet.samples(period, duration):
+            for robot, values in results.items():
+                for varName, value in values.items():
+                    key = "%s/%s"%(robot, varName)
+                    if key in self.slots:
+                        self.publishRaw(key, value, timestamp)
+
+    def statistics(self):
+        return {
+            "published": self.published,
+            "skipped": self.skipped,
+        }
+
+    def close(self, unlink = True):
+        """ Releases the board, unlink removes it (the readers attached keep their mapping) """
+        self._buffer = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+            _published.discard(self._shm.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StateBoardReader(_StateBoard):
+    """ Attaches to a board created by a StateBoardPublisher
+
+        name (str): the shared memory name
+        maxRetries (int): read attempts while the record is being written
+    """
+
+    def __init__(self, name, maxRetries = 1000):
+        self.name = name
+        self.maxRetries = maxRetries
+        self._shm = shared_memory.SharedMemory(name)
+        if not self._shm.name in _published:
+            #the board belongs to the publisher, it must not be removed when the reader exits
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._buffer = self._shm.buf
+        self._layout()
+
+    def read(self, key):
+        """ Returns (timestamp, tuple of the field values) of a slot, timestamp is 0.0 if never published.
+            Raises TimeoutError if the record stays busy for maxRetries attempts
+        """
+        _offset, recordType, _count, _values = self.slots[key]
+        _buffer = self._buffer
+        for i in range(self.maxRetries):
+            _before, timestamp = _stamp.unpack_from(_buffer, _offset)
+            if not _before & 1:
+                values = _values.unpack_from(_buffer, _offset + _stamp.size)
+                if _sequence.unpack_from(_buffer, _offset)[0] == _before:
+                    return timestamp, values
+            if i >= 8:
+                #lets the publisher complete the write
+                time.sleep(0)
+        raise TimeoutError("%s is busy"%key)
+
+    def readRecord(self, key):
+        """ Returns (timestamp, KrlRecord) of a slot, the scalars are returned as float """
+        timestamp, values = self.read(key)
+        recordType = self.slots[key][1]
+        if recordType is None:
+            return timestamp, values[0]
+        return timestamp, recordType(*(fieldType(value) for fieldType, value in zip(recordType.FIELD_TYPES, values)))
+
+    def sequence(self, key):
+        """ Returns the number of updates of a slot, to detect new values without reading them """
+        return _sequence.unpack_from(self._buffer, self.slots[key][0])[0] >> 1
+
+    def close(self):
+        self._buffer = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,201 @@
+"""
+    Author: Davide Rosa
+    Description: Fixed rate polling of variables.
+
+    The variables are subscribed with a target period. At every tick, the subscriptions that are due
+    are read together with a single pipelined burst (KukaVarProxyClient.readMany). The schedule is drift free:
+    the next due time is computed from the previous due time, not from the time of the read.
+    Every subscription keeps the statistics of the achieved rate, of the jitter and of the missed deadlines.
+
+    i.e.
+        engine = SubscriptionEngine(kvp)
+        engine.subscribe("$AXIS_ACT", 0.004)
+        engine.subscribe("$OV_PRO", 0.1)
+        for sample in engine.samples(duration = 10.0):
+            print(sample.timestamp, sample.name, sample.value)
+"""
+
+import collections
+import math
+import time
+
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_deadband import ChangeDetector
+
+#timestamp: wall clock time (time.time()) of the request
+#latency: duration in seconds of the burst that read the value
+#tick: number of the tick that produced the sample
+Sample = collections.namedtuple("Sample", ["name", "value", "timestamp", "latency", "tick"])
+
+
+class Subscription():
+    """ A variable polled with a target period (seconds).
+        decode (callable): optional function applied to the raw value (bytes), i.e. E6AXIS.decode
+        onlyChanges (bool): delivers the value only when it changes, identical raw replies are not decoded
+        deadband (float or dict): numeric deadband of the fields (see ChangeDetector), implies onlyChanges.
+            Without decode the value is decoded with krl.parseKrl
+    """
+
+    def __init__(self, varName, period, decode = None, onlyChanges = False, deadband = None):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        self.varName = varName
+        self.period = period
+        self.decode = decode
+        self.nextDue = None
+
+        self.changes = None
+        if onlyChanges or not deadband is None:
+            if decode is None and not deadband is None:
+                decode = krl.parseKrl
+            self.changes = ChangeDetector(deadband, decode)
+
+        #statistics
+        self.samples = 0
+        self.errors = 0
+        self.missed = 0
+        self.unchanged = 0
+        self._firstTime = None
+        self._lastTime = None
+        self._jitterCount = 0
+        self._jitterMean = 0.0
+        self._jitterM2 = 0.0
+        self.jitter_max = 0.0
+
+    def _recordJitter(self, jitter):
+        #Welford running mean and variance
+        self._jitterCount += 1
+        _delta = jitter - self._jitterMean
+        self._jitterMean += _delta / self._jitterCount
+        self._jitterM2 += _delta * (jitter - self._jitterMean)
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+
+    def statistics(self):
+        """ Returns a dictionary with the achieved rate (Hz), the jitter (seconds) and the counters """
+        _rate = None
+        if self.samples > 1 and self._lastTime > self._firstTime:
+            _rate = (self.samples - 1) / (self._lastTime - self._firstTime)
+        return {
+            "period": self.period,
+            "target_rate": 1.0 / self.period,
+            "achieved_rate": _rate,
+            "samples": self.samples,
+            "errors": self.errors,
+            "missed_deadlines": self.missed,
+            "unchanged": self.unchanged,
+            "jitter_mean": self._jitterMean,
+            "jitter_std": math.sqrt(self._jitterM2 / self._jitterCount) if self._jitterCount > 1 else 0.0,
+            "jitter_max": self.jitter_max,
+        }
+
+
+class SubscriptionEngine():
+    """ Polls the subscribed variables with a KukaVarProxyClient
+
+        client (KukaVarProxyClient): the client used to read, must implement readMany
+        groupWindow (float): the subscriptions due within this time (seconds) from the tick are read in the same burst
+        callback (callable): optional function f(sample) called by run() for every sample
+    """
+
+    def __init__(self, client, groupWindow = 0.0005, callback = None):
+        self.client = client
+        self.groupWindow = groupWindow
+        self.callback = callback
+        self.subscriptions = {}
+        self.ticks = 0
+        self._running = False
+
+    def subscribe(self, varName, period, decode = None, onlyChanges = False, deadband = None):
+        """ Adds (or replaces) the subscription of a variable, returns the Subscription """
+        subscription = Subscription(varName, period, decode, onlyChanges, deadband)
+        self.subscriptions[varName] = subscription
+        return subscription
+
+    def unsubscribe(self, varName):
+        self.subscriptions.pop(varName, None)
+
+    def nextDueTime(self):
+        """ Returns the time.monotonic() time of the next tick, None if there are no subscriptions """
+        if len(self.subscriptions) == 0:
+            return None
+        now = time.monotonic()
+        for subscription in self.subscriptions.values():
+            if subscription.nextDue is None:
+                subscription.nextDue = now
+        return min(subscription.nextDue for subscription in self.subscriptions.values())
+
+    def poll(self):
+        """ Waits for the next tick, reads the due subscriptions and returns the list of samples """
+        _due = self.nextDueTime()
+        if _due is None:
+            return []
+        _wait = _due - time.monotonic()
+        if _wait > 0:
+            time.sleep(_wait)
+
+        now = time.monotonic()
+        _group = [subscription for subscription in self.subscriptions.values() if subscription.nextDue <= now + self.groupWindow]
+        self.ticks += 1
+
+        _timestamp = time.time()
+        _start = time.monotonic()
+        _values = self.client.readMany([subscription.varName for subscription in _group])
+        _latency = time.monotonic() - _start
+
+        samples = []
+        for subscription, value in zip(_group, _values):
+            subscription._recordJitter(max(0.0, _start - subscription.nextDue))
+
+            #drift free schedule, the periods already elapsed are skipped and counted as missed
+            subscription.nextDue += subscription.period
+            if subscription.nextDue <= _start:
+                _skipped = int((_start - subscription.nextDue) / subscription.period) + 1
+                subscription.missed += _skipped
+                subscription.nextDue += _skipped * subscription.period
+
+            if value is None:
+                subscription.errors += 1
+                continue
+
+            changed = True
+            try:
+                if not subscription.changes is None:
+                    changed, value = subscription.changes.update(value)
+                elif not subscription.decode is None:
+                    value = subscription.decode(value)
+            except Exception:
+                #a value that can't be decoded is lost and counted in errors, the other subscriptions go on
+                subscription.errors += 1
+                continue
+
+            subscription.samples += 1
+            if subscription._firstTime is None:
+                subscription._firstTime = _start
+            subscription._lastTime = _start
+            if not changed:
+                subscription.unchanged += 1
+                continue
+            samples.append(Sample(subscription.varName, value, _timestamp, _latency, self.ticks))
+        return samples
+
+    def samples(self, duration = None):
+        """ Generator of the samples, stops after duration seconds (None runs until stop()) """
+        self._running = True
+        _end = None if duration is None else time.monotonic() + duration
+        while self._running and (_end is None or time.monotonic() < _end):
+            for sample in self.poll():
+                yield sample
+        self._running = False
+
+    def run(self, duration = None):
+        """ Calls the callback for every sample, stops after duration seconds (None runs until stop()) """
+        for sample in self.samples(duration):
+            self.callback(sample)
+
+    def stop(self):
+        self._running = False
+
+    def statistics(self):
+        """ Returns the statistics of every subscription """
+        return {varName: subscription.statistics() for varName, subscription in self.subscriptions.items()}
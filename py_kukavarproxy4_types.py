@@ -0,0 +1,218 @@
+"""
+    Author: Davide Rosa
+    Description: Typed decoding of the standard KRL position types (AXIS, E6AXIS, FRAME, POS, E6POS)
+                 into compact slotted records, and accumulation of samples into NumPy structured arrays.
+                 The records are encoded back to KRL literals with compiled templates.
+
+    i.e.
+        axis = E6AXIS.decode(kvp.readVar("$AXIS_ACT"))
+        print(axis.A1)
+
+        batch = SampleBatch(E6AXIS)
+        batch.appendValue(kvp.readVar("$AXIS_ACT"))
+        batch.array()["A1"]
+
+        kvp.writeVar("$TARGET", E6POS(*values).encode())
+"""
+
+import re
+import time
+
+import py_kukavarproxy4_krl as krl
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class KrlRecord():
+    """ Base class of the typed records, the subclasses define TYPE_NAME, FIELDS and FIELD_TYPES.
+        The values are stored in __slots__, no dictionary is allocated per record
+    """
+    __slots__ = ()
+
+    TYPE_NAME = None
+    FIELDS = ()
+    FIELD_TYPES = ()
+
+    _regex = None
+
+    def __init__(self, *values):
+        if len(values) != len(self.FIELDS):
+            raise TypeError("%s expects %d values, %d given"%(self.TYPE_NAME, len(self.FIELDS), len(values)))
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def regex(cls):
+        """ Returns the compiled regex matching the KRL literal of the type with the fields in the standard order """
+        if cls._regex is None:
+            _fieldPatterns = [r'\s*%s\s+([^\s,{}"]+)\s*'%name for name in cls.FIELDS]
+            cls._regex = re.compile(r'\s*\{\s*%s\s*:%s\}\s*'%(cls.TYPE_NAME, ','.join(_fieldPatterns)))
+        return cls._regex
+
+    @classmethod
+    def decodeValues(cls, value):
+        """ Returns the tuple of the field values of a KRL literal (str or bytes) of this type """
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value).decode("utf-8", "replace")
+
+        _match = cls.regex().fullmatch(value)
+        if not _match is None:
+            try:
+                return tuple(fieldType(float(v)) for fieldType, v in zip(cls.FIELD_TYPES, _match.groups()))
+            except ValueError:
+                pass
+
+        #different fields order or missing fields, the generic parser is used
+        resultDict = krl.parseKrl(value)
+        if not isinstance(resultDict, dict):
+            raise krl.KrlParseError("%s struct expected"%cls.TYPE_NAME)
+        return tuple(fieldType(resultDict.get(name, 0)) for name, fieldType in zip(cls.FIELDS, cls.FIELD_TYPES))
+
+    @classmethod
+    def decode(cls, value):
+        """ Returns the record of a KRL literal (str or bytes, as returned by readVar) """
+        return cls(*cls.decodeValues(value))
+
+    @classmethod
+    def fromDict(cls, valuesDict):
+        """ Returns the record from a dictionary (as returned by toPythonDict), the missing fields are 0 """
+        return cls(*(fieldType(valuesDict.get(name, 0)) for name, fieldType in zip(cls.FIELDS, cls.FIELD_TYPES)))
+
+    @classmethod
+    def template(cls, precision = krl.DEFAULT_PRECISION):
+        """ Returns the cached krl.StructTemplate writing the type with the fields in the standard order """
+        return krl.structTemplate(cls.TYPE_NAME, cls.FIELDS,
+                                  [krl.KIND_INT if fieldType is int else krl.KIND_NUMBER for fieldType in cls.FIELD_TYPES], precision)
+
+    def encode(self, precision = krl.DEFAULT_PRECISION):
+        """ Returns the KRL literal of the record, to be written with writeVar """
+        return self.template(precision).formatString % self.asTuple()
+
+    @classmethod
+    def encodeMany(cls, rows, precision = krl.DEFAULT_PRECISION):
+        """ Returns the KRL literals of many values: records, tuples, NumPy 2D array or structured array (i.e. SampleBatch.array()) """
+        return cls.template(precision).formatMany(rows)
+
+    def asTuple(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __iter__(self):
+        return iter(self.asTuple())
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.asTuple() == other.asTuple()
+
+    def __repr__(self):
+        return "%s(%s)"%(self.TYPE_NAME, ", ".join("%s=%r"%(name, getattr(self, name)) for name in self.FIELDS))
+
+    @classmethod
+    def dtype(cls, timestamp = True):
+        """ Returns the NumPy dtype of the type, with a leading float64 't' field if timestamp """
+        if np is None:
+            raise ImportError("numpy is required for %s.dtype"%cls.__name__)
+        _fields = [("t", np.float64)] if timestamp else []
+        _fields += [(name, np.int32 if fieldType is int else np.float64) for name, fieldType in zip(cls.FIELDS, cls.FIELD_TYPES)]
+        return np.dtype(_fields)
+
+
+_AXES = ("A1", "A2", "A3", "A4", "A5", "A6")
+_EXTERNAL_AXES = ("E1", "E2", "E3", "E4", "E5", "E6")
+_FRAME = ("X", "Y", "Z", "A", "B", "C")
+_STATUS_TURN = ("S", "T")
+
+class AXIS(KrlRecord):
+    TYPE_NAME = "AXIS"
+    FIELDS = _AXES
+    FIELD_TYPES = (float,)*len(FIELDS)
+    __slots__ = FIELDS
+
+class E6AXIS(KrlRecord):
+    TYPE_NAME = "E6AXIS"
+    FIELDS = _AXES + _EXTERNAL_AXES
+    FIELD_TYPES = (float,)*len(FIELDS)
+    __slots__ = FIELDS
+
+class FRAME(KrlRecord):
+    TYPE_NAME = "FRAME"
+    FIELDS = _FRAME
+    FIELD_TYPES = (float,)*len(FIELDS)
+    __slots__ = FIELDS
+
+class POS(KrlRecord):
+    TYPE_NAME = "POS"
+    FIELDS = _FRAME + _STATUS_TURN
+    FIELD_TYPES = (float,)*len(_FRAME) + (int, int)
+    __slots__ = FIELDS
+
+class E6POS(KrlRecord):
+    TYPE_NAME = "E6POS"
+    FIELDS = _FRAME + _STATUS_TURN + _EXTERNAL_AXES
+    FIELD_TYPES = (float,)*len(_FRAME) + (int, int) + (float,)*len(_EXTERNAL_AXES)
+    __slots__ = FIELDS
+
+
+#struct type name -> record class
+RECORD_TYPES = {recordType.TYPE_NAME: recordType for recordType in (AXIS, E6AXIS, FRAME, POS, E6POS)}
+
+def decodeRecord(value):
+    """ Returns the typed record of a KRL literal of one of the RECORD_TYPES, None for the other types """
+    recordType = RECORD_TYPES.get(krl.krlTypeName(value))
+    if recordType is None:
+        return None
+    return recordType.decode(value)
+
+
+class SampleBatch():
+    """ Accumulates timestamped samples of a record type into a preallocated NumPy structured array.
+        When full, the capacity is doubled
+    """
+
+    def __init__(self, recordType, initialCapacity = 1024):
+        if np is None:
+            raise ImportError("numpy is required for SampleBatch")
+        self.recordType = recordType
+        self._data = np.zeros(max(1, initialCapacity), dtype = recordType.dtype())
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def _grow(self):
+        _data = np.zeros(len(self._data)*2, dtype = self._data.dtype)
+        _data[:self._count] = self._data[:self._count]
+        self._data = _data
+
+    def append(self, values, timestamp = None):
+        """ values (KrlRecord or tuple): the field values in the FIELDS order
+            timestamp (float): defaults to time.time()
+        """
+        if self._count == len(self._data):
+            self._grow()
+        if timestamp is None:
+            timestamp = time.time()
+        self._data[self._count] = (timestamp,) + tuple(values)
+        self._count += 1
+
+    def appendValue(self, value, timestamp = None):
+        """ Decodes and appends a KRL literal (str or bytes, as returned by readVar), without creating a record """
+        self.append(self.recordType.decodeValues(value), timestamp)
+
+    def array(self):
+        """ Returns a view of the filled part of the array """
+        return self._data[:self._count]
+
+    def clear(self):
+        self._count = 0
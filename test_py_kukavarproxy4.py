@@ -0,0 +1,207 @@
+"""
+    Author: Davide Rosa
+    Description: Regression tests of the clients against the stand-in server (py_kukavarproxy4_server).
+
+    python -m pytest -q
+"""
+
+import socket
+import threading
+import time
+from array import array
+
+import pytest
+
+import py_kukavarproxy4_codec as codec
+import py_kukavarproxy4_krl as krl
+from py_kukavarproxy4_client import KukaVarProxyClient
+from py_kukavarproxy4_server import FaultInjection, KukaVarProxyServer
+
+
+@pytest.fixture
+def server():
+    with KukaVarProxyServer(port = 0, arrays = {"SMALL[]": [0] * 4, "BIG[]": [0] * 40000}) as _server:
+        yield _server
+
+@pytest.fixture
+def kvp(server):
+    _client = KukaVarProxyClient(*server.address, _sockTimeout = 1.0)
+    assert _client.connect()
+    yield _client
+    _client.disconnect()
+
+
+""" Codec """
+
+@pytest.mark.parametrize("kvp_func, dataToSend", [
+    (codec.KVP_FUNCTION_READ, codec.packReadRequest("$OV_PRO")),
+    (codec.KVP_FUNCTION_WRITE, codec.packWriteRequest("$OV_PRO", "50")),
+    (codec.KVP_FUNCTION_READARRAY, codec.packReadArrayRequest("MYARRAY[]")),
+    (codec.KVP_FUNCTION_WRITEARRAY, codec.packWriteArrayRequest("MYARRAY[]", [1, 2, 0xffff])),
+    (codec.KVP_FUNCTION_DISCOVER, codec.packDiscoverRequest()),
+    (codec.KVP_FUNCTION_SETROBOTIP, codec.packSetRobotIPRequest([172, 17, 255, 1])),
+])
+def test_codec_request_round_trip(kvp_func, dataToSend):
+    _frame = codec.packMessage(0x1234, kvp_func, dataToSend)
+    _msgID, _msgSize = codec.unpackHeader(_frame)
+    assert _msgID == 0x1234
+    assert _msgSize == len(_frame) - codec.KVP_HEADERSIZE
+    assert codec.unpackRequest(_frame[codec.KVP_HEADERSIZE:])[0] == kvp_func
+
+def test_codec_reply_round_trip():
+    _body = bytes((codec.KVP_FUNCTION_READ,)) + codec.packValueReply(b"{E6AXIS: A1 1.0}", codec.KVP_RESULTOK)
+    assert codec.unpackReply(codec.KVP_FUNCTION_READ, _body) == (b"{E6AXIS: A1 1.0}", codec.KVP_RESULTOK)
+
+    _body = bytes((codec.KVP_FUNCTION_READARRAY,)) + codec.packReadArrayReply([1, 2, 0xffff], codec.KVP_RESULTOK)
+    _values, result = codec.unpackReply(codec.KVP_FUNCTION_READARRAY, _body)
+    assert _values == array("H", [1, 2, 0xffff])
+    assert result == codec.KVP_RESULTOK
+
+    _body = bytes((codec.KVP_FUNCTION_DISCOVER,)) + codec.packDiscoverReply([(172, 17, 255, 1)], codec.KVP_RESULTOK)
+    _ips, result = codec.unpackReply(codec.KVP_FUNCTION_DISCOVER, _body)
+    assert [list(ip) for ip in _ips] == [[172, 17, 255, 1]]
+
+def test_codec_rejects_oversized_and_malformed():
+    with pytest.raises(codec.KvpProtocolError):
+        codec.packMessage(1, codec.KVP_FUNCTION_WRITE, b"x" * codec.KVP_MAXBODYSIZE)
+    with pytest.raises(codec.KvpProtocolError):
+        codec.unpackReply(codec.KVP_FUNCTION_READ, bytes((codec.KVP_FUNCTION_WRITE,)) + codec.packValueReply(b"1", codec.KVP_RESULTOK))
+    with pytest.raises(codec.KvpProtocolError):
+        codec.unpackReply(codec.KVP_FUNCTION_READ, bytes((codec.KVP_FUNCTION_READ, 0, 10)))
+
+
+""" Single and pipelined calls """
+
+def test_read_write_var(kvp, server):
+    assert kvp.readVar("$OV_PRO") == b"100"
+    assert kvp.writeVar("$OV_PRO", "50")
+    assert server.getVar("$OV_PRO") == b"50"
+    assert kvp.readVar("$OV_PRO") == b"50"
+
+def test_read_many_write_many(kvp, server):
+    _pairs = [("VAR%d"%i, str(i)) for i in range(40)]
+    assert kvp.writeMany(_pairs) == [True] * len(_pairs)
+    assert kvp.readMany([varName for varName, varValue in _pairs]) == [varValue.encode() for varName, varValue in _pairs]
+
+def test_read_many_keeps_the_order_of_writes(kvp, server):
+    kvp.writeMany([("X", str(i)) for i in range(8)])
+    assert server.getVar("X") == b"7"
+
+def test_read_many_oversize_entry_fails_alone(kvp):
+    _values = kvp.readMany(["$OV_PRO", "Y" * 70000, "$MODE_OP"])
+    assert _values == [b"100", None, b"#T1"]
+    assert kvp.writeMany([("A", "1"), ("B", "x" * 70000), ("C", "3")]) == [True, False, True]
+
+def _reversingServer(replies):
+    """ Returns (address, thread) of a server that answers a burst of len(replies) requests in reverse order,
+        replies (list of bytes): the reply bodies (function included) in request order
+    """
+    _listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _listener.bind(("127.0.0.1", 0))
+    _listener.listen(1)
+
+    def serve():
+        sock, _address = _listener.accept()
+        _ids = []
+        _buffer = b""
+        while len(_ids) < len(replies):
+            _buffer += sock.recv(65536)
+            while len(_buffer) >= codec.KVP_HEADERSIZE:
+                _msgID, _msgSize = codec.unpackHeader(_buffer)
+                if len(_buffer) < codec.KVP_HEADERSIZE + _msgSize:
+                    break
+                _ids.append(_msgID)
+                _buffer = _buffer[codec.KVP_HEADERSIZE + _msgSize:]
+        for _msgID, _body in reversed(list(zip(_ids, replies))):
+            sock.sendall(codec.packMessage(_msgID, _body[0], _body[1:]))
+        sock.close()
+        _listener.close()
+
+    thread = threading.Thread(target = serve, daemon = True)
+    thread.start()
+    return _listener.getsockname(), thread
+
+def test_read_many_demultiplexes_by_message_id():
+    _values = [b"value%d"%i for i in range(5)]
+    _address, thread = _reversingServer([bytes((codec.KVP_FUNCTION_READ,)) + codec.packValueReply(_value, codec.KVP_RESULTOK) for _value in _values])
+    client = KukaVarProxyClient(*_address, _sockTimeout = 1.0)
+    assert client.readMany(["V%d"%i for i in range(5)]) == _values
+    client.disconnect()
+    thread.join()
+
+
+""" Fault injection """
+
+def test_error_reply(kvp):
+    assert kvp.readVar("$NOT_DEFINED") is None
+    assert kvp.readArray("NOT_DEFINED[]") is None
+    assert not kvp.setRobotIP([10, 0, 0, 1])
+    #the connection is still usable
+    assert kvp.readVar("$OV_PRO") == b"100"
+
+def test_delay(server, kvp):
+    server.latency = 0.05
+    _t0 = time.monotonic()
+    assert kvp.readVar("$OV_PRO") == b"100"
+    assert time.monotonic() - _t0 >= 0.05
+
+def test_delay_beyond_timeout(server):
+    server.latency = 0.3
+    client = KukaVarProxyClient(*server.address, _sockTimeout = 0.1)
+    assert client.readVar("$OV_PRO") is None
+    server.latency = 0.0
+    #a new connection, the late reply of the previous one is not misread
+    assert client.readVar("$OV_PRO") == b"100"
+    client.disconnect()
+
+@pytest.mark.parametrize("fault", ["drop_connection", "mismatched_id", "truncated_reply"])
+def test_faults_fail_the_call_and_reconnect(server, kvp, fault):
+    server.faults = FaultInjection(**{fault: 1.0})
+    assert kvp.readVar("$OV_PRO") is None
+    server.faults = None
+    assert kvp.readVar("$OV_PRO") == b"100"
+
+def test_dropped_connection_fails_the_pipeline(server, kvp):
+    server.faults = FaultInjection(drop_connection = 1.0)
+    assert kvp.readMany(["$OV_PRO", "$MODE_OP"]) == [None, None]
+    server.faults = None
+    assert kvp.readMany(["$OV_PRO", "$MODE_OP"]) == [b"100", b"#T1"]
+
+
+""" Arrays """
+
+def test_read_write_array(kvp, server):
+    assert kvp.writeArray("SMALL[]", [5, 6, 7])
+    assert kvp.readArray("SMALL[]") == array("H", [5, 6, 7])
+
+def test_write_array_bytes_are_big_endian_shorts(kvp, server):
+    #the same meaning of bytes on the single message and the chunked paths
+    assert kvp.writeArray("SMALL[]", b"\x00\x01\x00\x02")
+    assert server.getArray("SMALL[]") == [1, 2]
+    _data = array("H", range(40000))
+    _data.byteswap()
+    assert kvp.writeArray("BIG[]", _data.tobytes())
+    assert server.getArray("BIG[]") == list(range(40000))
+
+def test_chunked_array_round_trip(kvp, server):
+    _values = array("H", (i * 7 & 0xffff for i in range(40000)))
+    assert kvp.writeArray("BIG[]", _values)
+    assert server.getArray("BIG[]") == list(_values)
+    assert kvp.readArrayChunked("BIG[]", len(_values), chunkSize = 10000) == _values
+
+def test_chunked_empty_array(kvp):
+    assert kvp.writeArray("EMPTY[]", [])
+    assert kvp.writeArrayChunked("EMPTY[]", [])
+
+
+""" KRL parser """
+
+def test_parse_krl_does_not_depend_on_the_parse_history():
+    krl.clearSchemaCache()
+    assert krl.parseKrl("{T: A #X, B 1}") == {"A": "#X", "B": 1.0}
+    assert krl.parseKrl("{T: A 5, B 1}") == {"A": 5.0, "B": 1.0}
+
+def test_parse_krl_nested(kvp):
+    _load = krl.parseKrl(kvp.readVar("$LOAD"))
+    assert _load["M"] == 2.5
+    assert _load["CM"]["Z"] == 60.0